@@ -0,0 +1,169 @@
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, IO, List, Optional, Set, Tuple
+
+import pandas as pd
+
+from burden.parquet_writer import ParquetTableWriter, get_float32_columns
+from general_utilities.association_resources import build_transcript_table
+
+# Cache VEP tables as Arrow/feather files so that each chromosome can be re-read quickly (memory-mapped) by every
+# runner / phenotype. Without pyarrow we just re-read the original tsv.
+try:
+    from pyarrow import feather
+    HAS_PYARROW = True
+except ImportError:
+    HAS_PYARROW = False
+
+
+# Shared annotation of gene and marker results. Gene results are joined to a single cached copy of the transcripts
+# table. Marker results are joined to the per-chromosome VEP tables one chromosome at a time, so peak memory is
+# that of a single chromosome rather than the whole exome.
+class AnnotationEngine:
+
+    def __init__(self, threads: int, vep_dir: Path = Path('filtered_bgen/')):
+
+        self._threads = threads
+        self._vep_dir = vep_dir
+        self._transcripts_table: Optional[pd.DataFrame] = None
+        self._cached_chromosomes = set()
+        self._join_lock = threading.Lock()
+
+    # The transcripts table is only built once per job. Callers must not modify the returned table in place.
+    def get_transcripts(self) -> pd.DataFrame:
+        if self._transcripts_table is None:
+            self._transcripts_table = build_transcript_table()
+        return self._transcripts_table
+
+    def _vep_path(self, chromosome: str) -> Path:
+        return self._vep_dir / f'{chromosome}.filtered.vep.tsv.gz'
+
+    def _feather_path(self, chromosome: str) -> Path:
+        return self._vep_dir / f'{chromosome}.filtered.vep.feather'
+
+    def _read_vep(self, chromosome: str) -> pd.DataFrame:
+        return pd.read_csv(self._vep_path(chromosome), sep="\t", dtype={'SIFT': str, 'POLYPHEN': str})
+
+    def _cache_vep(self, chromosome: str) -> None:
+        if not self._feather_path(chromosome).exists():
+            feather.write_feather(self._read_vep(chromosome), self._feather_path(chromosome))
+
+    # Convert all requested VEP tables to feather in parallel (a no-op for chromosomes that are already cached)
+    def prepare(self, chromosomes: List[str]) -> None:
+
+        if not HAS_PYARROW:
+            return
+        to_cache = [chromosome for chromosome in chromosomes if chromosome not in self._cached_chromosomes]
+        with ThreadPoolExecutor(max_workers=max(1, self._threads)) as executor:
+            list(executor.map(self._cache_vep, to_cache))
+        self._cached_chromosomes.update(to_cache)
+
+    # Returns the VEP table for one chromosome, indexed on varID
+    def get_variant_index(self, chromosome: str) -> pd.DataFrame:
+
+        if HAS_PYARROW:
+            self.prepare([chromosome])
+            variant_index = feather.read_table(self._feather_path(chromosome), memory_map=True).to_pandas()
+        else:
+            variant_index = self._read_vep(chromosome)
+        return variant_index.set_index('varID')
+
+    # Left-join one chromosome's marker results onto its VEP annotation. VEP tables are already position-ordered, so
+    # the result normally needs no sorting. Joins are done one at a time (even when called from several threads), so
+    # peak memory stays that of a single chromosome.
+    def annotate_markers(self, chromosome: str, marker_table: pd.DataFrame) -> pd.DataFrame:
+
+        with self._join_lock:
+            annotated = pd.merge(self.get_variant_index(chromosome), marker_table, on='varID', how="left")
+            if not annotated['POS'].is_monotonic_increasing:
+                annotated = annotated.sort_values(by=['CHROM', 'POS'], kind='stable')
+            return annotated
+
+    # Left-join marker results onto the VEP annotation chromosome by chromosome and write a single, position-sorted,
+    # tab-delimited table to 'marker_out' (any writable file-like object). 'load_markers' returns the marker results for
+    # a chromosome – only that chromosome's rows, so that each join (and the memory it needs) covers one chromosome.
+    #
+    # Marker results for the next chromosome are loaded in the background while the current one is joined. Runners
+    # that produce marker results one chromosome at a time should add them to a MarkerSpill as they finish instead.
+    def write_annotated_markers(self, chromosomes: List[str], load_markers: Callable[[str], pd.DataFrame],
+                                marker_out: IO, parquet_path: Optional[str] = None) -> None:
+
+        self.prepare(chromosomes)
+        marker_spill = MarkerSpill(self, parquet_path)
+        with ThreadPoolExecutor(max_workers=1) as prefetcher:
+            next_markers = prefetcher.submit(load_markers, chromosomes[0]) if len(chromosomes) > 0 else None
+            for chromosome_number, chromosome in enumerate(chromosomes):
+                marker_table = next_markers.result()
+                if chromosome_number + 1 < len(chromosomes):
+                    next_markers = prefetcher.submit(load_markers, chromosomes[chromosome_number + 1])
+                marker_spill.add(chromosome, marker_table)
+                del marker_table
+        marker_spill.write(marker_out)
+
+
+# Annotated marker results for one output, collected a chromosome at a time (in any order, from any thread) as the
+# per-chromosome tests finish. Each chromosome is joined to its VEP annotation straight away and spilled to disk, so
+# all that is left once every chromosome is in is a cheap merge: write() reads the spilled chromosomes back in
+# chromosome order, only once the dtype of every column across ALL chromosomes is known, so the output is identical to
+# joining and sorting the concatenated tables in one go.
+#
+# With a 'parquet_path', write() also writes the table as Parquet (see ParquetTableWriter). Which columns can be stored
+# as float32 is worked out as chromosomes are added, so that every chromosome is written with the same schema.
+class MarkerSpill:
+
+    def __init__(self, annotation_engine: AnnotationEngine, parquet_path: Optional[str] = None):
+
+        self._annotation_engine = annotation_engine
+        self._parquet_path = parquet_path
+        self._spill_dir = Path(tempfile.mkdtemp(dir='.'))
+        self._lock = threading.Lock()
+        self._spilled_chromosomes: List[Tuple[str, Path]] = []
+        self._empty_tables: List[pd.DataFrame] = []
+        self._float32_columns: Optional[Set[str]] = None
+
+    def add(self, chromosome: str, marker_table: pd.DataFrame) -> None:
+
+        annotated = self._annotation_engine.annotate_markers(chromosome, marker_table)
+        spill_path = self._spill_dir / f'{chromosome}.pkl'
+        if len(annotated) > 0:
+            annotated.to_pickle(spill_path)
+        float32_columns = get_float32_columns(annotated) if self._parquet_path is not None else set()
+        with self._lock:
+            self._float32_columns = float32_columns if self._float32_columns is None else \
+                self._float32_columns & float32_columns
+            self._empty_tables.append(annotated.iloc[:0])
+            if len(annotated) > 0:
+                self._spilled_chromosomes.append((annotated['CHROM'].iloc[0], spill_path))
+
+    # Write every chromosome added so far to 'marker_out' (and the Parquet output) and remove the spilled files
+    def write(self, marker_out: IO) -> None:
+
+        parquet_out = None
+        if self._parquet_path is not None:
+            parquet_out = ParquetTableWriter(self._parquet_path, 'CHROM',
+                                             set() if self._float32_columns is None else self._float32_columns)
+        try:
+            if len(self._empty_tables) == 0:
+                # No chromosomes were added, so there are not even columns to write
+                return
+            column_dtypes: Dict[str, object] = pd.concat(self._empty_tables).dtypes.to_dict()
+            spilled_chromosomes = sorted(self._spilled_chromosomes, key=lambda spilled: spilled[0])
+            if len(spilled_chromosomes) == 0:
+                empty_table = pd.concat(self._empty_tables)
+                empty_table.to_csv(path_or_buf=marker_out, index=False, sep="\t", na_rep='NA')
+                if parquet_out is not None:
+                    parquet_out.write(empty_table)
+            for spill_number, (_, spill_path) in enumerate(spilled_chromosomes):
+                annotated = pd.read_pickle(spill_path).astype(column_dtypes)
+                annotated.to_csv(path_or_buf=marker_out, index=False, sep="\t", na_rep='NA',
+                                 header=spill_number == 0)
+                if parquet_out is not None:
+                    parquet_out.write(annotated)
+                spill_path.unlink()
+        finally:
+            if parquet_out is not None:
+                parquet_out.close()
+            shutil.rmtree(self._spill_dir, ignore_errors=True)
@@ -0,0 +1,289 @@
+import struct
+import zlib
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterator, List, Optional, Set, Tuple, Union
+
+import dxpy
+import numpy as np
+
+# Header flags: zlib-compressed genotype blocks (1), layout 2 (2 << 2), sample identifiers present (1 << 31)
+BGEN_FLAGS = 1 | (2 << 2) | (1 << 31)
+BGEN_MAGIC = b'bgen'
+
+COMPRESSION_NONE = 0
+COMPRESSION_ZLIB = 1
+COMPRESSION_ZSTD = 2
+
+
+# A single variant as stored in a BGEN. The genotype data is kept exactly as read (still compressed) so that variants we
+# do not need to modify can be copied straight through.
+@dataclass
+class BGENVariant:
+    variant_id: str
+    rsid: str
+    chromosome: str
+    position: int
+    alleles: List[str]
+    genotype_data: bytes
+    uncompressed_length: int
+
+
+# Streaming reader for BGEN v1.2 (layout 2) files. Variants are read one at a time, so memory use only depends on the
+# number of samples.
+class BGENReader:
+
+    def __init__(self, path: Union[str, Path]):
+
+        self._path = Path(path)
+        self._handle = self._path.open('rb')
+
+        offset, header_length, self.n_variants, self.n_samples = struct.unpack('<IIII', self._handle.read(16))
+        magic = self._handle.read(4)
+        if magic != BGEN_MAGIC and magic != b'\x00\x00\x00\x00':
+            raise dxpy.AppError(f'{self._path} is not a BGEN file!')
+        self._handle.seek(4 + header_length - 4)
+        flags = struct.unpack('<I', self._handle.read(4))[0]
+        self.compression = flags & 3
+        self.layout = (flags >> 2) & 0xf
+        if self.layout != 2:
+            raise dxpy.AppError(f'{self._path} uses BGEN layout {self.layout}; only layout 2 (BGEN v1.2+) is supported')
+
+        self.samples: Optional[List[str]] = None
+        if flags >> 31:
+            self._handle.read(8)
+            self.samples = [self._read_string() for _ in range(self.n_samples)]
+
+        self._handle.seek(offset + 4)
+
+    def _read_string(self, length_format: str = '<H') -> str:
+        length = struct.unpack(length_format, self._handle.read(struct.calcsize(length_format)))[0]
+        return self._handle.read(length).decode()
+
+    def __iter__(self) -> Iterator[BGENVariant]:
+
+        for _ in range(self.n_variants):
+            variant_id = self._read_string()
+            rsid = self._read_string()
+            chromosome = self._read_string()
+            position, n_alleles = struct.unpack('<IH', self._handle.read(6))
+            alleles = [self._read_string('<I') for _ in range(n_alleles)]
+
+            block_length = struct.unpack('<I', self._handle.read(4))[0]
+            if self.compression == COMPRESSION_NONE:
+                uncompressed_length = block_length
+                genotype_data = self._handle.read(block_length)
+            else:
+                uncompressed_length = struct.unpack('<I', self._handle.read(4))[0]
+                genotype_data = self._handle.read(block_length - 4)
+
+            yield BGENVariant(variant_id, rsid, chromosome, position, alleles, genotype_data, uncompressed_length)
+
+    def decompress(self, variant: BGENVariant) -> bytes:
+
+        if self.compression == COMPRESSION_NONE:
+            return variant.genotype_data
+        elif self.compression == COMPRESSION_ZLIB:
+            return zlib.decompress(variant.genotype_data)
+        else:
+            try:
+                import zstandard
+            except ImportError:
+                raise dxpy.AppError(f'{self._path} is zstd compressed but the python zstandard module is not '
+                                    f'available!')
+            return zstandard.ZstdDecompressor().decompress(variant.genotype_data,
+                                                           max_output_size=variant.uncompressed_length)
+
+    def close(self) -> None:
+        self._handle.close()
+
+    def __enter__(self) -> 'BGENReader':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+
+# Convert an array of (0-2) dosages of the FIRST allele into 8-bit BGEN (layout 2, unphased, diploid) probability
+# data. A dosage cannot uniquely define three genotype probabilities, so we use the usual convention of putting all
+# probability mass on the two genotypes either side of the dosage. NaN dosages are written as missing.
+def dosages_to_probabilities(dosages: np.ndarray) -> bytes:
+
+    n_samples = len(dosages)
+    missing = np.isnan(dosages)
+    dosages = np.where(missing, 0, np.clip(dosages, 0, 2))
+
+    # Stored probabilities are P(first/first) and P(first/second); P(second/second) is implied
+    prob_hom = np.where(dosages >= 1, np.rint((dosages - 1) * 255), 0)
+    prob_het = np.where(dosages >= 1, 255 - prob_hom, np.rint(dosages * 255))
+    probabilities = np.empty(n_samples * 2, dtype=np.uint8)
+    probabilities[0::2] = np.where(missing, 0, prob_hom)
+    probabilities[1::2] = np.where(missing, 0, prob_het)
+
+    ploidy = np.where(missing, 0x82, 0x02).astype(np.uint8)
+
+    return struct.pack('<IHBB', n_samples, 2, 2, 2) + ploidy.tobytes() + struct.pack('<BB', 0, 8) + \
+        probabilities.tobytes()
+
+
+# Subset (and if necessary re-quantise to 8 bits) the uncompressed genotype data of one bi-allelic, unphased, diploid
+# variant down to the samples at 'keep_index'. Data that is already 8-bit is subset byte-for-byte.
+def subset_probabilities(genotypes: bytes, keep_index: np.ndarray) -> bytes:
+
+    n_samples, n_alleles, min_ploidy, max_ploidy = struct.unpack('<IHBB', genotypes[:8])
+    if n_alleles != 2 or min_ploidy != 2 or max_ploidy != 2:
+        raise dxpy.AppError('Only bi-allelic, diploid BGEN variants can be rewritten')
+
+    ploidy = np.frombuffer(genotypes, dtype=np.uint8, count=n_samples, offset=8)
+    phased, bits = struct.unpack('<BB', genotypes[8 + n_samples:10 + n_samples])
+    if phased:
+        raise dxpy.AppError('Phased BGEN variants cannot be rewritten')
+    probability_offset = 10 + n_samples
+
+    kept_ploidy = ploidy[keep_index]
+    if bits == 8:
+        probabilities = np.frombuffer(genotypes, dtype=np.uint8, count=n_samples * 2, offset=probability_offset)
+        kept_probabilities = probabilities.reshape(n_samples, 2)[keep_index]
+    else:
+        packed = np.frombuffer(genotypes, dtype=np.uint8, offset=probability_offset)
+        unpacked = np.unpackbits(packed, bitorder='little')[:n_samples * 2 * bits].reshape(n_samples * 2, bits)
+        values = unpacked.astype(np.uint64) @ (np.uint64(1) << np.arange(bits, dtype=np.uint64))
+        probabilities = values.reshape(n_samples, 2)[keep_index] / ((1 << bits) - 1)
+        kept_probabilities = _quantise_probabilities(probabilities)
+        kept_probabilities[(kept_ploidy & 0x80) > 0] = 0
+
+    return struct.pack('<IHBB', len(keep_index), 2, 2, 2) + kept_ploidy.tobytes() + struct.pack('<BB', 0, 8) + \
+        np.ascontiguousarray(kept_probabilities, dtype=np.uint8).tobytes()
+
+
+# Round probabilities to 8 bits using the BGEN spec's method so the three genotype probabilities still sum to 255:
+# floor everything, then give the remaining units to the genotypes with the largest remainders.
+def _quantise_probabilities(probabilities: np.ndarray) -> np.ndarray:
+
+    all_probabilities = np.column_stack([probabilities, 1 - probabilities.sum(axis=1)]) * 255
+    floored = np.floor(all_probabilities)
+    deficit = np.rint(255 - floored.sum(axis=1)).astype(np.int64)
+    remainder_rank = np.argsort(np.argsort(-(all_probabilities - floored), axis=1), axis=1)
+    floored += remainder_rank < deficit[:, np.newaxis]
+    return floored[:, :2].astype(np.uint8)
+
+
+# Streaming writer for BGEN v1.2 files with 8-bit, zlib-compressed, bi-allelic variants. The variant count in the header
+# is only known at the end, so it is patched in when the file is closed.
+class BGENWriter:
+
+    def __init__(self, path: Union[str, Path], samples: List[str], compression_level: int = 6):
+
+        self._handle = Path(path).open('wb')
+        self._n_samples = len(samples)
+        self._n_variants = 0
+        self._compression_level = compression_level
+
+        sample_block = b''.join(struct.pack('<H', len(sample.encode())) + sample.encode() for sample in samples)
+        sample_block = struct.pack('<II', len(sample_block) + 8, self._n_samples) + sample_block
+        header_length = 20
+
+        self._handle.write(struct.pack('<I', header_length + len(sample_block)))
+        self._handle.write(struct.pack('<III', header_length, 0, self._n_samples) + BGEN_MAGIC +
+                           struct.pack('<I', BGEN_FLAGS))
+        self._handle.write(sample_block)
+
+    @staticmethod
+    def _pack_string(value: str, length_format: str = '<H') -> bytes:
+        value = value.encode()
+        return struct.pack(length_format, len(value)) + value
+
+    # 'dosages' are of allele1; BOLT (and plink 'ref-first') treat the first listed allele as the counted allele
+    def write_variant(self, variant_id: str, rsid: str, chromosome: str, position: int, allele1: str, allele2: str,
+                      dosages: np.ndarray) -> None:
+
+        if len(dosages) != self._n_samples:
+            raise dxpy.AppError(f'Variant {variant_id} has {len(dosages)} dosages for {self._n_samples} samples')
+
+        self.write_genotypes(variant_id, rsid, chromosome, position, [allele1, allele2],
+                             dosages_to_probabilities(dosages))
+
+    # Write already-encoded (uncompressed) layout 2 genotype data for one variant
+    def write_genotypes(self, variant_id: str, rsid: str, chromosome: str, position: int, alleles: List[str],
+                        genotypes: bytes) -> None:
+
+        compressed = zlib.compress(genotypes, self._compression_level)
+        self._handle.write(self._pack_string(variant_id) +
+                           self._pack_string(rsid) +
+                           self._pack_string(chromosome) +
+                           struct.pack('<IH', position, len(alleles)) +
+                           b''.join(self._pack_string(allele, '<I') for allele in alleles) +
+                           struct.pack('<II', len(compressed) + 4, len(genotypes)) +
+                           compressed)
+        self._n_variants += 1
+
+    def close(self) -> None:
+
+        if self._handle.closed:
+            return
+        # Variant count lives just after the offset and header length fields
+        self._handle.seek(8)
+        self._handle.write(struct.pack('<I', self._n_variants))
+        self._handle.close()
+
+    def __enter__(self) -> 'BGENWriter':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+
+# Write an Oxford-format .sample file to accompany a BGEN
+def write_sample_file(path: Union[str, Path], samples: List[str]) -> None:
+
+    with Path(path).open('w') as sample_file:
+        sample_file.write('ID_1 ID_2 missing sex\n')
+        sample_file.write('0 0 0 D\n')
+        for sample in samples:
+            sample_file.write(f'{sample} {sample} 0 NA\n')
+
+
+# Read an Oxford-format .sample file and work out which samples (by ID_1, as for plink --keep-fam) to keep. Returns the
+# two header lines, the sample lines we keep, and the index of those samples in the file.
+def read_sample_file(path: Union[str, Path], keep_samples: Set[str]) -> Tuple[List[str], List[str], np.ndarray]:
+
+    with Path(path).open('r') as sample_file:
+        header = [sample_file.readline(), sample_file.readline()]
+        kept_lines = []
+        keep_index = []
+        for sample_index, line in enumerate(sample_file):
+            if line.split()[0] in keep_samples:
+                kept_lines.append(line)
+                keep_index.append(sample_index)
+
+    return header, kept_lines, np.array(keep_index, dtype=np.int64)
+
+
+# Rewrite one or more BGENs (each paired with its .sample file and an ID suffix) into a single 8-bit BGEN restricted to
+# 'keep_samples', with every variant ID (and rsID) renamed to '<ID>-<suffix>'. All inputs must contain the same samples
+# in the same order, which is the case for the per-mask BGENs from a collapsevariants run. This is done in a single
+# streaming pass over each input.
+def rewrite_bgens(inputs: List[Tuple[Path, Path, str]], keep_samples: Set[str],
+                  output_bgen: Path, output_sample: Path) -> int:
+
+    header, kept_lines, keep_index = read_sample_file(inputs[0][1], keep_samples)
+    output_samples = [line.split()[1] for line in kept_lines]
+    with output_sample.open('w') as sample_file:
+        sample_file.writelines(header + kept_lines)
+
+    n_variants = 0
+    with BGENWriter(output_bgen, output_samples) as writer:
+        for bgen_path, sample_path, suffix in inputs:
+            _, current_lines, current_index = read_sample_file(sample_path, keep_samples)
+            if current_lines != kept_lines:
+                raise dxpy.AppError(f'Samples in {sample_path} do not match {inputs[0][1]}, cannot merge BGENs')
+
+            with BGENReader(bgen_path) as reader:
+                for variant in reader:
+                    new_id = f'{variant.rsid}-{suffix}'
+                    genotypes = subset_probabilities(reader.decompress(variant), current_index)
+                    writer.write_genotypes(new_id, new_id, variant.chromosome, variant.position, variant.alleles,
+                                           genotypes)
+                    n_variants += 1
+
+    return n_variants
@@ -0,0 +1,157 @@
+import struct
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
+from pathlib import Path
+from typing import Deque, List, Optional, Union
+
+# BGZF is a series of gzip members, each holding at most 64KiB of uncompressed data, with the compressed block size
+# stored in a 'BC' extra field. This is what bgzip writes and what tabix / BOLT / htslib expect to read.
+BGZF_BLOCK_SIZE = 0xff00
+BGZF_MAX_COMPRESSED_SIZE = 0x10000
+
+# An empty block marks a complete (not truncated) BGZF file
+BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+
+# Compress a single (<= BGZF_BLOCK_SIZE) chunk of data into a complete BGZF block. With the default level this gives
+# the same bytes as htslib's bgzf (and therefore bgzip) when both are built against zlib.
+def compress_block(data: bytes, level: int = 6) -> bytes:
+
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    compressed = compressor.compress(data) + compressor.flush()
+    if len(compressed) + 26 > BGZF_MAX_COMPRESSED_SIZE:
+        # Incompressible data – store it instead, which is always small enough
+        compressor = zlib.compressobj(0, zlib.DEFLATED, -15)
+        compressed = compressor.compress(data) + compressor.flush()
+
+    header = struct.pack('<4BI2BH2BHH', 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, ord('B'), ord('C'), 2,
+                         len(compressed) + 25)
+    footer = struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data))
+    return header + compressed + footer
+
+
+# A write-only, file-like BGZF writer. Data is split into full BGZF_BLOCK_SIZE blocks exactly as bgzip does, so the
+# output matches 'bgzip <file>'. With threads > 1 blocks are compressed on a thread pool (zlib releases the GIL) while
+# the caller keeps writing; blocks are still written to disk in order and the number in flight is bounded.
+#
+# If given a TabixIndex, every complete line written is passed to it along with its BGZF virtual offset, and the .tbi
+# is written alongside the output on close() – equivalent to running 'tabix' on the finished file.
+class BGZFWriter:
+
+    def __init__(self, path: Union[str, Path], level: int = 6, threads: int = 1,
+                 index: Optional['TabixIndex'] = None):
+
+        self._path = Path(path)
+        self._handle = self._path.open('wb')
+        self._level = level
+        self._buffer = bytearray()
+
+        self._executor = ThreadPoolExecutor(max_workers=threads) if threads > 1 else None
+        self._max_in_flight = threads * 4
+        self._in_flight: Deque[Future] = deque()
+
+        # Compressed address of every block written so far, for virtual offsets
+        self._block_addresses: List[int] = []
+        self._compressed_offset = 0
+        self._uncompressed_offset = 0
+
+        self._index = index
+        self._partial_line = b''
+        self._pending_lines: Deque[tuple] = deque()
+
+    def write(self, data: Union[str, bytes]) -> int:
+
+        if isinstance(data, str):
+            data = data.encode()
+        if self._index is not None:
+            self._queue_lines(data)
+        self._uncompressed_offset += len(data)
+
+        self._buffer.extend(data)
+        while len(self._buffer) >= BGZF_BLOCK_SIZE:
+            self._submit_block(bytes(self._buffer[:BGZF_BLOCK_SIZE]))
+            del self._buffer[:BGZF_BLOCK_SIZE]
+        return len(data)
+
+    # Split written data into lines, remembering the uncompressed offset at the end of each. Lines are only handed to
+    # the index once the block they end in has been written, as only then is the virtual offset known.
+    def _queue_lines(self, data: bytes) -> None:
+
+        line_start = 0
+        data_offset = self._uncompressed_offset
+        while True:
+            line_end = data.find(b'\n', line_start)
+            if line_end == -1:
+                self._partial_line += data[line_start:]
+                break
+            line = self._partial_line + data[line_start:line_end]
+            self._partial_line = b''
+            self._pending_lines.append((line, data_offset + line_end + 1))
+            line_start = line_end + 1
+
+    def _submit_block(self, block: bytes) -> None:
+
+        if self._executor is None:
+            self._write_block(compress_block(block, self._level))
+        else:
+            self._in_flight.append(self._executor.submit(compress_block, block, self._level))
+            while len(self._in_flight) > self._max_in_flight:
+                self._write_block(self._in_flight.popleft().result())
+
+    def _write_block(self, compressed: bytes) -> None:
+
+        self._block_addresses.append(self._compressed_offset)
+        self._handle.write(compressed)
+        self._compressed_offset += len(compressed)
+        self._index_pending_lines(final=False)
+
+    def _virtual_offset(self, uncompressed_offset: int, final: bool) -> int:
+
+        block, within_block = divmod(uncompressed_offset, BGZF_BLOCK_SIZE)
+        if final and uncompressed_offset == self._uncompressed_offset and within_block != 0:
+            # htslib reports the end of the last block as the start of the next (EOF) block
+            block, within_block = block + 1, 0
+        if block < len(self._block_addresses):
+            return (self._block_addresses[block] << 16) | within_block
+        else:
+            return self._compressed_offset << 16
+
+    def _index_pending_lines(self, final: bool) -> None:
+
+        if self._index is None:
+            return
+        written_up_to = len(self._block_addresses) * BGZF_BLOCK_SIZE
+        while len(self._pending_lines) > 0 and (final or self._pending_lines[0][1] < written_up_to):
+            line, line_end = self._pending_lines.popleft()
+            self._index.add_line(line.decode(), self._virtual_offset(line_end, final))
+
+    def close(self) -> None:
+
+        if self._handle.closed:
+            return
+        if len(self._buffer) > 0:
+            self._submit_block(bytes(self._buffer))
+            self._buffer.clear()
+        while len(self._in_flight) > 0:
+            self._write_block(self._in_flight.popleft().result())
+        if self._executor is not None:
+            self._executor.shutdown()
+
+        if self._index is not None:
+            if len(self._partial_line) > 0:
+                self._pending_lines.append((self._partial_line, self._uncompressed_offset))
+            self._index_pending_lines(final=True)
+            self._index.finish(self._compressed_offset << 16)
+
+        self._handle.write(BGZF_EOF)
+        self._handle.close()
+
+        if self._index is not None:
+            self._index.save(Path(f'{self._path}.tbi'))
+
+    def __enter__(self) -> 'BGZFWriter':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
@@ -4,6 +4,10 @@ from typing import TypedDict, Dict, List, Optional
 
 import dxpy
 
+from burden.checkpoint import CheckpointStore
+from burden.derived_cache import DerivedCache
+from burden.job_history import JobHistory
+from burden.null_model_store import NullModelStore
 from runassociationtesting.association_pack import AssociationPack, ProgramArgs
 
 
@@ -22,6 +26,21 @@ class BurdenProgramArgs(ProgramArgs):
     sparse_grm_sample: dxpy.DXFile
     bolt_non_infinite: bool
     regenie_smaller_snps: Optional[dxpy.DXFile]
+    stream_tarballs: bool
+    resource_cache_dir: Optional[str]
+    resource_cache_max_gb: float
+    dosage_bgen: bool
+    null_model: Optional[dxpy.DXFile]
+    combine_masks: bool
+    derived_cache_max_gb: float
+    profile_python: bool
+    checkpoint_dir: Optional[str]
+    checkpoint_folder: Optional[str]
+    parquet_outputs: bool
+    glm_screen_threshold: float
+    glm_process_pool: bool
+    staar_worker_pool: bool
+    staar_job_timeout_hours: Optional[float]
 
 
 # A TypedDict holding information about each chromosome's available genetic data
@@ -42,7 +61,11 @@ class BurdenAssociationPack(AssociationPack):
 
     def __init__(self, association_pack: AssociationPack, tarball_prefixes: List[str],
                  bgen_dict: Dict[str, BGENInformation], dosage_dict: Dict[str, DosageInformation],
-                 run_marker_tests: bool, is_bolt_non_infinite: bool, regenie_snps_file: Optional[Path]):
+                 run_marker_tests: bool, is_bolt_non_infinite: bool, regenie_snps_file: Optional[Path],
+                 is_dosage_bgen: bool, null_model_store: NullModelStore, combine_masks: bool,
+                 derived_cache: DerivedCache, job_history: JobHistory, checkpoint_store: CheckpointStore,
+                 parquet_outputs: bool, glm_screen_threshold: float, glm_process_pool: bool,
+                 staar_worker_pool: bool, staar_job_timeout_hours: Optional[float]):
 
         super().__init__(association_pack.pheno_files, association_pack.inclusion_found,
                          association_pack.exclusion_found, association_pack.additional_covariates_found,
@@ -57,3 +80,14 @@ class BurdenAssociationPack(AssociationPack):
         self.is_bolt_non_infinite = is_bolt_non_infinite
         self.regenie_snps_file = regenie_snps_file
         self.is_dosage = bgen_dict is None
+        self.is_dosage_bgen = is_dosage_bgen
+        self.null_model_store = null_model_store
+        self.combine_masks = combine_masks
+        self.derived_cache = derived_cache
+        self.job_history = job_history
+        self.checkpoint_store = checkpoint_store
+        self.parquet_outputs = parquet_outputs
+        self.glm_screen_threshold = glm_screen_threshold
+        self.glm_process_pool = glm_process_pool
+        self.staar_worker_pool = staar_worker_pool
+        self.staar_job_timeout_hours = staar_job_timeout_hours
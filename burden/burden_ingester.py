@@ -1,12 +1,27 @@
+import hashlib
+import json
 import tarfile
 
-from os.path import exists
+from functools import partial
 from pathlib import Path
-from typing import Optional, Dict
+from typing import Optional, Dict, Union
 
 from burden.burden_association_pack import BurdenAssociationPack, BGENInformation, \
     BurdenProgramArgs, DosageInformation
+from burden.checkpoint import CheckpointStore
+from burden.derived_cache import DerivedCache
+from burden.job_history import JobHistory, JOB_HISTORY_FILE
+from burden.null_model_store import NullModelStore
+from burden.parquet_writer import HAS_PYARROW
+from burden.resource_cache import ResourceCache
+from burden.tarball_extractor import stream_extract_tarball, TARBALL_SUFFIXES
+from burden.transfer_manager import TransferManager
 from runassociationtesting.ingest_data import *
+from burden.profiler import run_cmd
+
+
+FILTERED_GENETICS_PREFIX = 'genetics/UKBB_470K_Autosomes_QCd_WBA'
+PLINK_SUFFIXES = ['bed', 'bim', 'fam']
 
 
 class BurdenIngestData(IngestData):
@@ -15,20 +30,60 @@ class BurdenIngestData(IngestData):
         super().__init__(parsed_options)
 
         # Put additional options/covariate processing required by this specific package here
+        # Multiple phenotypes are run in 'batch' mode – all genetic data below is ingested once and shared by every
+        # phenotype.
         if len(self.get_association_pack().pheno_names) > 1:
-            raise dxpy.AppError('The burden module currently only allows for running one phenotype at a time!')
+            print(f'Running {len(self.get_association_pack().pheno_names)} phenotypes in batch mode')
+
+        # Check this before anything is downloaded, rather than failing once all the tests have been run
+        if parsed_options.parquet_outputs and not HAS_PYARROW:
+            raise dxpy.AppError('--parquet_outputs requires pyarrow, which is not installed!')
+
+        # All downloads go through a single transfer manager. We queue the large genetic resources first so they
+        # download in the background while tarballs are being processed, and only wait on them when they are needed.
+        # If requested, the manager checks a persistent cache before transferring anything.
+        if parsed_options.resource_cache_dir is not None:
+            resource_cache = ResourceCache(parsed_options.resource_cache_dir,
+                                           int(parsed_options.resource_cache_max_gb * 1024 ** 3))
+        else:
+            resource_cache = None
+        self._transfer_manager = TransferManager(max_workers=max(1, min(self.get_association_pack().threads, 8)),
+                                                 cache=resource_cache)
+
+        # The raw array data is only used to make the sample-filtered (_WBA) plink files. If we already have those
+        # cached for this exact set of inputs and samples, we never need to download the raw data at all.
+        filtered_genetics_key = self._get_filtered_genetics_key(self._transfer_manager,
+                                                                parsed_options.array_bed_file,
+                                                                parsed_options.array_fam_file,
+                                                                parsed_options.array_bim_file)
+        found_filtered_genetics = resource_cache is not None and \
+            resource_cache.fetch(filtered_genetics_key, {f'filtered.{suffix}': f'{FILTERED_GENETICS_PREFIX}.{suffix}'
+                                                         for suffix in PLINK_SUFFIXES})
+        self._ingest_genetic_data(self._transfer_manager,
+                                  parsed_options.array_bed_file,
+                                  parsed_options.array_fam_file,
+                                  parsed_options.array_bim_file,
+                                  parsed_options.low_MAC_list,
+                                  parsed_options.sparse_grm,
+                                  parsed_options.sparse_grm_sample,
+                                  download_array_data=not found_filtered_genetics)
 
-        is_snp_tar, is_gene_tar, tarball_prefixes = self._ingest_tarballs(parsed_options.association_tarballs)
+        is_snp_tar, is_gene_tar, tarball_prefixes, tarball_keys = \
+            self._ingest_tarballs(self._transfer_manager,
+                                  parsed_options.association_tarballs,
+                                  parsed_options.tool,
+                                  parsed_options.stream_tarballs,
+                                  self.get_association_pack().threads)
         if is_snp_tar or is_gene_tar:
             raise dxpy.AppError('The burden module is not compatible with SNP or GENE masks!')
 
         if parsed_options.bgen_index:
-            bgen_dict = self._ingest_bgen(parsed_options.bgen_index)
+            bgen_dict = self._ingest_bgen(self._transfer_manager, parsed_options.bgen_index)
             dosage_dict = None
         elif parsed_options.dosage_index:
             if parsed_options.tool == "bolt":
                 bgen_dict = None
-                dosage_dict = self._ingest_dosage(parsed_options.dosage_index)
+                dosage_dict = self._ingest_dosage(self._transfer_manager, parsed_options.dosage_index)
             else:
                 raise dxpy.AppError('Dosage file format is currently only compatible with BOLT-LMM!')
 
@@ -37,78 +92,152 @@ class BurdenIngestData(IngestData):
         else:
             raise dxpy.AppError('Either --bgen_index or --dosage_index MUST be supplied!')
 
-        self._ingest_genetic_data(parsed_options.array_bed_file,
-                                  parsed_options.array_fam_file,
-                                  parsed_options.array_bim_file,
-                                  parsed_options.low_MAC_list,
-                                  parsed_options.sparse_grm,
-                                  parsed_options.sparse_grm_sample)
+        if found_filtered_genetics:
+            print('Using cached sample-filtered plink files')
+        else:
+            self._generate_filtered_genetic_data(self._transfer_manager, resource_cache, filtered_genetics_key)
+        self._print_filtered_sample_count()
+        regenie_snps_file = self._process_regenie_snps(self._transfer_manager, parsed_options.regenie_smaller_snps)
+        null_model_store = self._ingest_null_model(self._transfer_manager, resource_cache, parsed_options)
+
+        # Phenotype-independent files derived from the tarballs are cached separately (with their own size limit) so
+        # that they cannot evict the downloaded resources they are built from
+        if parsed_options.resource_cache_dir is not None:
+            derived_cache = DerivedCache(ResourceCache(Path(parsed_options.resource_cache_dir) / 'derived',
+                                                       int(parsed_options.derived_cache_max_gb * 1024 ** 3)),
+                                         tarball_keys)
+        else:
+            derived_cache = DerivedCache(None, tarball_keys)
 
-        self._generate_filtered_genetic_data()
-        regenie_snps_file = self._process_regenie_snps(parsed_options.regenie_smaller_snps)
+        # Run times of previous jobs are kept alongside the cache, so that jobs sharing a cache learn from each other
+        if parsed_options.resource_cache_dir is not None:
+            job_history = JobHistory(Path(parsed_options.resource_cache_dir) / JOB_HISTORY_FILE)
+        else:
+            job_history = JobHistory(None)
+
+        checkpoint_store = self._ingest_checkpoints(self._transfer_manager, parsed_options)
+
+        # Tools expect every resource to be on disk before they start, so make sure nothing is still in flight
+        self._transfer_manager.wait_all()
+        self._transfer_manager.shutdown()
 
         # Put additional covariate processing specific to this module here
         self.set_association_pack(BurdenAssociationPack(self.get_association_pack(),
                                                         tarball_prefixes, bgen_dict, dosage_dict,
                                                         parsed_options.run_marker_tests,
-                                                        parsed_options.bolt_non_infinite, regenie_snps_file))
+                                                        parsed_options.bolt_non_infinite, regenie_snps_file,
+                                                        parsed_options.dosage_bgen, null_model_store,
+                                                        parsed_options.combine_masks, derived_cache,
+                                                        job_history, checkpoint_store,
+                                                        parsed_options.parquet_outputs,
+                                                        parsed_options.glm_screen_threshold,
+                                                        parsed_options.glm_process_pool,
+                                                        parsed_options.staar_worker_pool,
+                                                        parsed_options.staar_job_timeout_hours))
 
     # Need to grab the tarball file for associations...
     # This was generated by the applet mrcepid-collapsevariants
     # Ingest the list file into this AWS instance
     @staticmethod
-    def _ingest_tarballs(association_tarballs: dxpy.DXFile) -> Tuple[bool, bool, List[str]]:
+    def _ingest_tarballs(transfer_manager: TransferManager, association_tarballs: dxpy.DXFile, tool: str,
+                         stream_tarballs: bool, threads: int) -> Tuple[bool, bool, List[str], Dict[str, str]]:
 
         is_snp_tar = False
         is_gene_tar = False
         tarball_prefixes = []
-        if '.tar.gz' in association_tarballs.describe()['name']:
+        # Checksum-based key of each tarball, used to cache files derived from it
+        tarball_keys = {}
+        tarball_description = transfer_manager.describe(association_tarballs)
+        tarball_name = tarball_description['name']
+        if tarball_name.endswith(TARBALL_SUFFIXES):
             # likely to be a single tarball, download, check, and extract:
-            tarball_name = association_tarballs.describe()['name']
-            dxpy.download_dxfile(association_tarballs, tarball_name)
-            if tarfile.is_tarfile(tarball_name):
-                tarball_prefix = tarball_name.replace(".tar.gz", "")
-                tarball_prefixes.append(tarball_prefix)
-                tar = tarfile.open(tarball_name, "r:gz")
-                tar.extractall()
-                if exists(tarball_prefix + ".SNP.BOLT.bgen"):
-                    is_snp_tar = True
-                elif exists(tarball_prefix + ".GENE.BOLT.bgen"):
-                    is_gene_tar = True
-            else:
-                raise dxpy.AppError(f'Provided association tarball ({association_tarballs.describe()["id"]}) '
-                                    f'is not a tar.gz file')
+            tarball_prefix = BurdenIngestData._get_tarball_prefix(tarball_name)
+            tarball_prefixes.append(tarball_prefix)
+            tarball_keys[tarball_prefix] = transfer_manager.get_cache_key(tarball_description)
+            BurdenIngestData._queue_tarball(transfer_manager, association_tarballs, tarball_name, tool,
+                                            stream_tarballs, threads)
+            member_names = BurdenIngestData._extract_tarball(transfer_manager, tarball_name, stream_tarballs,
+                                                             threads)
+            if tarball_prefix + ".SNP.BOLT.bgen" in member_names:
+                is_snp_tar = True
+            elif tarball_prefix + ".GENE.BOLT.bgen" in member_names:
+                is_gene_tar = True
         else:
             # Likely to be a list of tarballs, download and extract...
-            dxpy.download_dxfile(association_tarballs, "tarball_list.txt")
+            transfer_manager.queue(association_tarballs, "tarball_list.txt")
+            transfer_manager.wait("tarball_list.txt")
+
+            # Queue every tarball at once so that they download concurrently...
+            tarball_names = []
             with open("tarball_list.txt", "r") as tarball_reader:
                 for association_tarball in tarball_reader:
                     association_tarball = association_tarball.rstrip()
-                    tarball = dxpy.DXFile(association_tarball)
-                    tarball_name = tarball.describe()['name']
-                    dxpy.download_dxfile(tarball, tarball_name)
-
-                    # Need to get the prefix on the tarball to access resources within:
-                    # All files within SHOULD have the same prefix as this file
-                    tarball_prefix = tarball_name.rstrip('.tar.gz')
-                    tarball_prefixes.append(tarball_prefix)
-                    tar = tarfile.open(tarball_name, "r:gz")
-                    tar.extractall()
-                    if exists(tarball_prefix + ".SNP.BOLT.bgen"):
-                        raise dxpy.AppError(f'Cannot run masks from a SNP list ({association_tarballs.describe()["id"]}) '
-                                            f'when running tarballs as batch...')
-                    elif exists(tarball_prefix + ".GENE.BOLT.bgen"):
-                        raise dxpy.AppError(f'Cannot run masks from a GENE list ({association_tarballs.describe()["id"]}) '
-                                            f'when running tarballs as batch...')
-
-        return is_snp_tar, is_gene_tar, tarball_prefixes
+                    tarball_description = transfer_manager.describe(association_tarball)
+                    tarball_name = tarball_description['name']
+                    tarball_keys[BurdenIngestData._get_tarball_prefix(tarball_name)] = \
+                        transfer_manager.get_cache_key(tarball_description)
+                    BurdenIngestData._queue_tarball(transfer_manager, association_tarball, tarball_name, tool,
+                                                    stream_tarballs, threads)
+                    tarball_names.append(tarball_name)
+
+            # ... and then extract them in order as soon as each one arrives
+            for tarball_name in tarball_names:
+                member_names = BurdenIngestData._extract_tarball(transfer_manager, tarball_name, stream_tarballs,
+                                                                 threads)
+
+                # Need to get the prefix on the tarball to access resources within:
+                # All files within SHOULD have the same prefix as this file
+                tarball_prefix = BurdenIngestData._get_tarball_prefix(tarball_name)
+                tarball_prefixes.append(tarball_prefix)
+                if tarball_prefix + ".SNP.BOLT.bgen" in member_names:
+                    raise dxpy.AppError(f'Cannot run masks from a SNP list ({association_tarballs.describe()["id"]}) '
+                                        f'when running tarballs as batch...')
+                elif tarball_prefix + ".GENE.BOLT.bgen" in member_names:
+                    raise dxpy.AppError(f'Cannot run masks from a GENE list ({association_tarballs.describe()["id"]}) '
+                                        f'when running tarballs as batch...')
+
+        return is_snp_tar, is_gene_tar, tarball_prefixes, tarball_keys
+
+    @staticmethod
+    def _get_tarball_prefix(tarball_name: str) -> str:
+        for suffix in TARBALL_SUFFIXES:
+            if tarball_name.endswith(suffix):
+                return tarball_name[:-len(suffix)]
+        return tarball_name
+
+    # In streaming mode the tarball is never written to disk – it is decompressed on the fly and only the members
+    # required by 'tool' are extracted. Otherwise, download the whole thing and extract every member.
+    @staticmethod
+    def _queue_tarball(transfer_manager: TransferManager, tarball: Union[dxpy.DXFile, str], tarball_name: str,
+                       tool: str, stream_tarballs: bool, threads: int) -> None:
+        if stream_tarballs:
+            transfer_manager.queue_stream(tarball,
+                                          partial(stream_extract_tarball, tool=tool, threads=threads),
+                                          tarball_name, content_errors=(tarfile.ReadError,))
+        else:
+            transfer_manager.queue(tarball, tarball_name)
+
+    # Returns the names of every member in the tarball
+    @staticmethod
+    def _extract_tarball(transfer_manager: TransferManager, tarball_name: str, stream_tarballs: bool,
+                         threads: int) -> List[str]:
+        try:
+            if stream_tarballs:
+                return transfer_manager.wait(tarball_name)[0]
+            else:
+                transfer_manager.wait(tarball_name)
+                with Path(tarball_name).open('rb') as tarball_reader:
+                    return stream_extract_tarball(tarball_reader, tool=None, threads=threads)
+        except tarfile.ReadError as read_error:
+            raise dxpy.AppError(f'Provided association tarball ({tarball_name}) is not a tar file: {read_error}')
 
     # Grab the entire WES variant data in bgen format
     @staticmethod
-    def _ingest_bgen(bgen_index: dxpy.DXFile) -> Dict[str, BGENInformation]:
+    def _ingest_bgen(transfer_manager: TransferManager, bgen_index: dxpy.DXFile) -> Dict[str, BGENInformation]:
 
         # Ingest the INDEX of bgen files:
-        dxpy.download_dxfile(bgen_index.get_id(), "bgen_locs.tsv")
+        transfer_manager.queue(bgen_index, "bgen_locs.tsv")
+        transfer_manager.wait("bgen_locs.tsv")
         # and load it into a dict:
         os.mkdir("filtered_bgen/")  # For downloading later...
         bgen_index_csv = csv.DictReader(open("bgen_locs.tsv", "r"), delimiter="\t")
@@ -121,10 +250,12 @@ class BurdenIngestData(IngestData):
         return bgen_dict
 
     @staticmethod
-    def _ingest_dosage(dosage_index: dxpy.DXFile) -> Dict[str, DosageInformation]:
+    def _ingest_dosage(transfer_manager: TransferManager,
+                       dosage_index: dxpy.DXFile) -> Dict[str, DosageInformation]:
 
         # Ingest the INDEX of Dosage files:
-        dxpy.download_dxfile(dosage_index.get_id(), "dosage_locs.tsv")
+        transfer_manager.queue(dosage_index, "dosage_locs.tsv")
+        transfer_manager.wait("dosage_locs.tsv")
         # And load it into a dict – unlike with bgen, we can d/l now since the file size is much smaller:
         dosage_dir = Path("filtered_dosage/")
         dosage_dir.mkdir()
@@ -135,38 +266,43 @@ class BurdenIngestData(IngestData):
             dosage_path = dosage_dir.joinpath(Path(f'{line["chrom"]}.dosage'))
             sample_path = dosage_dir.joinpath(Path(f'{line["chrom"]}.sample'))
             info_path = dosage_dir.joinpath(Path(f'{line["chrom"]}.info'))
-            dxpy.download_dxfile(dxpy.DXFile(line['dosage_dxid']).get_id(), f'{dosage_path.resolve()}')
-            dxpy.download_dxfile(dxpy.DXFile(line['sample_dxid']).get_id(), f'{sample_path.resolve()}')
-            dxpy.download_dxfile(dxpy.DXFile(line['info_dxid']).get_id(), f'{info_path.resolve()}')
+            # These are only queued here – BOLT does not need them until after ingestion has finished
+            transfer_manager.queue(line['dosage_dxid'], dosage_path.resolve())
+            transfer_manager.queue(line['sample_dxid'], sample_path.resolve())
+            transfer_manager.queue(line['info_dxid'], info_path.resolve())
             dosage_dict[line['chrom']] = {'dosage': dosage_path,
                                           'sample': sample_path,
                                           'info': info_path}
 
         return dosage_dict
 
+    # This only queues the downloads. Files are waited on by _generate_filtered_genetic_data() (plink files) or at the
+    # end of ingestion (everything else).
     @staticmethod
-    def _ingest_genetic_data(bed_file: dxpy.DXFile, fam_file: dxpy.DXFile, bim_file: dxpy.DXFile,
+    def _ingest_genetic_data(transfer_manager: TransferManager,
+                             bed_file: dxpy.DXFile, fam_file: dxpy.DXFile, bim_file: dxpy.DXFile,
                              low_mac_list: dxpy.DXFile,
-                             sparse_grm: dxpy.DXFile, sparse_grm_sample: dxpy.DXFile) -> None:
+                             sparse_grm: dxpy.DXFile, sparse_grm_sample: dxpy.DXFile,
+                             download_array_data: bool) -> None:
         # Now grab all genetic data that I have in the folder /project_resources/genetics/
-        os.mkdir("genetics/")  # This is for legacy reasons to make sure all tests work...
-        dxpy.download_dxfile(bed_file.get_id(), 'genetics/UKBB_470K_Autosomes_QCd.bed')
-        dxpy.download_dxfile(bim_file.get_id(), 'genetics/UKBB_470K_Autosomes_QCd.bim')
-        dxpy.download_dxfile(fam_file.get_id(), 'genetics/UKBB_470K_Autosomes_QCd.fam')
-        dxpy.download_dxfile(low_mac_list.get_id(), 'genetics/UKBB_470K_Autosomes_QCd.low_MAC.snplist')
+        Path("genetics/").mkdir(exist_ok=True)  # This is for legacy reasons to make sure all tests work...
+        if download_array_data:
+            transfer_manager.queue(bed_file, 'genetics/UKBB_470K_Autosomes_QCd.bed')
+            transfer_manager.queue(bim_file, 'genetics/UKBB_470K_Autosomes_QCd.bim')
+            transfer_manager.queue(fam_file, 'genetics/UKBB_470K_Autosomes_QCd.fam')
+        transfer_manager.queue(low_mac_list, 'genetics/UKBB_470K_Autosomes_QCd.low_MAC.snplist')
         # This is the sparse matrix
-        dxpy.download_dxfile(sparse_grm.get_id(),
-                             'genetics/sparseGRM_470K_Autosomes_QCd.sparseGRM.mtx')
-        dxpy.download_dxfile(sparse_grm_sample.get_id(),
-                             'genetics/sparseGRM_470K_Autosomes_QCd.sparseGRM.mtx.sampleIDs.txt')
+        transfer_manager.queue(sparse_grm, 'genetics/sparseGRM_470K_Autosomes_QCd.sparseGRM.mtx')
+        transfer_manager.queue(sparse_grm_sample, 'genetics/sparseGRM_470K_Autosomes_QCd.sparseGRM.mtx.sampleIDs.txt')
 
     @staticmethod
-    def _process_regenie_snps(snp_qc_file: dxpy.DXFile) -> Optional[Path]:
+    def _process_regenie_snps(transfer_manager: TransferManager, snp_qc_file: dxpy.DXFile) -> Optional[Path]:
 
         if snp_qc_file is None:
             return None
         else:
-            dxpy.download_dxfile(snp_qc_file.get_id(), 'genetics/ukb_snp_qc.txt')
+            transfer_manager.queue(snp_qc_file, 'genetics/ukb_snp_qc.txt')
+            transfer_manager.wait('genetics/ukb_snp_qc.txt')
             with Path('genetics/ukb_snp_qc.txt').open('r') as snp_qc_reader,\
                     Path('genetics/rel_snps.txt').open('w') as rel_snps_writer:
                 snp_qc_csv = csv.DictReader(snp_qc_reader, delimiter=" ")
@@ -178,8 +314,88 @@ class BurdenIngestData(IngestData):
 
             return Path('genetics/rel_snps.txt')
 
+    # Null models and checkpoints are keyed (in part) on every genetic input that could go into a null fit, so that a
+    # cached or user-provided null model is never used with different array data, GRM, or SNP lists
+    @staticmethod
+    def _get_genetics_key(transfer_manager: TransferManager, parsed_options: BurdenProgramArgs) -> str:
+
+        genetics_hash = hashlib.sha256()
+        for genetic_file in [parsed_options.array_bed_file, parsed_options.array_bim_file,
+                             parsed_options.array_fam_file, parsed_options.low_MAC_list,
+                             parsed_options.sparse_grm, parsed_options.sparse_grm_sample,
+                             parsed_options.regenie_smaller_snps]:
+            if genetic_file is not None:
+                genetics_hash.update(transfer_manager.get_cache_key(transfer_manager.describe(genetic_file)).encode())
+        return genetics_hash.hexdigest()
+
+    # Checkpoints are keyed on everything about this run that changes the result of a unit of work but is not covered
+    # by the unit itself: the tool and its options, the samples, and the genetic data. Phenotypes and covariates are
+    # covered by the keys of the null models that units depend on, and masks by the checksums of their tarballs.
+    def _ingest_checkpoints(self, transfer_manager: TransferManager,
+                            parsed_options: BurdenProgramArgs) -> CheckpointStore:
+
+        if parsed_options.checkpoint_dir is None and parsed_options.checkpoint_folder is None:
+            return CheckpointStore(None, '')
+
+        run_hash = hashlib.sha256()
+        run_hash.update(json.dumps({'tool': parsed_options.tool,
+                                    'bolt_non_infinite': parsed_options.bolt_non_infinite,
+                                    'combine_masks': parsed_options.combine_masks,
+                                    'dosage_bgen': parsed_options.dosage_bgen,
+                                    'genetics': self._get_genetics_key(transfer_manager, parsed_options)}).encode())
+        for index_file in [parsed_options.bgen_index, parsed_options.dosage_index]:
+            if index_file is not None:
+                run_hash.update(transfer_manager.get_cache_key(transfer_manager.describe(index_file)).encode())
+        with Path('SAMPLES_Include.txt').open('rb') as sample_file:
+            run_hash.update(sample_file.read())
+
+        checkpoint_dir = Path(parsed_options.checkpoint_dir if parsed_options.checkpoint_dir is not None
+                              else 'checkpoints/')
+        return CheckpointStore(checkpoint_dir, run_hash.hexdigest(), parsed_options.checkpoint_folder)
+
+    # Null models are keyed (in part) on every genetic input that could go into a null fit (see _get_genetics_key())
+    def _ingest_null_model(self, transfer_manager: TransferManager, resource_cache: Optional[ResourceCache],
+                           parsed_options: BurdenProgramArgs) -> NullModelStore:
+
+        input_bundle_dir = None
+        if parsed_options.null_model is not None:
+            transfer_manager.queue(parsed_options.null_model, 'null_models.input.tar.gz')
+            transfer_manager.wait('null_models.input.tar.gz')
+            input_bundle_dir = Path('null_models_input/')
+            try:
+                with tarfile.open('null_models.input.tar.gz', 'r:*') as null_model_tar:
+                    null_model_tar.extractall(input_bundle_dir)
+            except tarfile.ReadError:
+                raise dxpy.AppError('Provided --null_model is not a null model bundle from a previous run')
+
+        association_pack = self.get_association_pack()
+        return NullModelStore(resource_cache, self._get_genetics_key(transfer_manager, parsed_options),
+                              association_pack.is_binary, association_pack.sex,
+                              association_pack.found_quantitative_covariates,
+                              association_pack.found_categorical_covariates,
+                              input_bundle_dir)
+
+    # The filtered plink files depend only on the raw array data and the samples we keep, so key on the checksums of
+    # the former and the content of SAMPLES_Include.txt
     @staticmethod
-    def _generate_filtered_genetic_data():
+    def _get_filtered_genetics_key(transfer_manager: TransferManager, bed_file: dxpy.DXFile, fam_file: dxpy.DXFile,
+                                   bim_file: dxpy.DXFile) -> str:
+
+        filtered_hash = hashlib.sha256()
+        for genetic_file in [bed_file, bim_file, fam_file]:
+            filtered_hash.update(transfer_manager.get_cache_key(transfer_manager.describe(genetic_file)).encode())
+        with Path('SAMPLES_Include.txt').open('rb') as sample_file:
+            filtered_hash.update(sample_file.read())
+
+        return f'filtered_genetics.{filtered_hash.hexdigest()}'
+
+    @staticmethod
+    def _generate_filtered_genetic_data(transfer_manager: TransferManager, resource_cache: Optional[ResourceCache],
+                                        filtered_genetics_key: str):
+
+        transfer_manager.wait('genetics/UKBB_470K_Autosomes_QCd.bed',
+                              'genetics/UKBB_470K_Autosomes_QCd.bim',
+                              'genetics/UKBB_470K_Autosomes_QCd.fam')
 
         # Generate a plink file to use that only has included individuals:
         cmd = "plink2 " \
@@ -187,11 +403,16 @@ class BurdenIngestData(IngestData):
               "--out /test/genetics/UKBB_470K_Autosomes_QCd_WBA"
         run_cmd(cmd, True)
 
-        # I have to do this to recover the sample information from plink
-        cmd = "docker run -v /home/dnanexus/:/test/ egardner413/mrcepid-associationtesting plink2 " \
-              "--bfile /test/genetics/UKBB_470K_Autosomes_QCd_WBA " \
-              "--validate | grep samples"
-        proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        stdout, stderr = proc.communicate()
+        # And save for any future run (with any tool) using the same data / samples
+        if resource_cache is not None:
+            resource_cache.store(filtered_genetics_key, {f'filtered.{suffix}': f'{FILTERED_GENETICS_PREFIX}.{suffix}'
+                                                         for suffix in PLINK_SUFFIXES})
+
+    # Each line of a .fam file is one sample, so we don't need plink (or docker) to count them
+    @staticmethod
+    def _print_filtered_sample_count():
+
+        with Path(f'{FILTERED_GENETICS_PREFIX}.fam').open('r') as fam_file:
+            n_samples = sum(1 for _ in fam_file)
 
-        print(f'{"Plink individuals written":{65}}: {stdout.decode("utf-8").rstrip(" loaded from")}')
+        print(f'{"Plink individuals written":{65}}: {n_samples} samples')
@@ -0,0 +1,223 @@
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import tarfile
+import threading
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import dxpy
+
+CHECKPOINT_MANIFEST = 'manifest.jsonl'
+# Each unit uploaded to --checkpoint_folder is a single tar of its directory, named
+# '<run key prefix>.<unit key>.checkpoint.tar' so that a restart only downloads the units of the same run
+CHECKPOINT_SUFFIX = '.checkpoint.tar'
+CHECKPOINT_RUN_PREFIX_LENGTH = 16
+# Copy of a unit's manifest entry, stored inside its uploaded tar
+CHECKPOINT_UNIT_FILE = 'unit.json'
+
+
+# Marks a TaskGraph task as a unit of work that can be checkpointed. 'files' are the files the task writes (name in
+# the checkpoint -> path in the working directory), 'inputs' anything else the result depends on that is not covered
+# by the run or the task's dependencies (e.g. the checksums of the tarballs it reads), and 'save_result' whether the
+# task's return value (e.g. a parsed gene table) is saved as well.
+@dataclass
+class Checkpoint:
+    files: Dict[str, str] = field(default_factory=dict)
+    inputs: List[str] = field(default_factory=list)
+    save_result: bool = False
+
+
+def _hash_file(path: Path) -> str:
+    file_hash = hashlib.sha256()
+    with path.open('rb') as hash_file:
+        for chunk in iter(lambda: hash_file.read(1024 * 1024), b''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+# Saves each completed unit of work (e.g. a step 1 model, a chromosome's step 2 results, a parsed gene table) to a
+# directory on persistent storage as soon as it finishes, so that a run that is restarted (e.g. after a spot instance
+# is preempted) with the same --checkpoint_dir only redoes unfinished work.
+#
+# Each unit is identified by a key that hashes:
+#
+# 1. The run – the tool, samples, genetic data, and options that change results (see BurdenIngestData)
+# 2. The task's name and its Checkpoint 'inputs'
+# 3. The keys of every task it depends on, so anything downstream of a changed input is redone
+#
+# A unit's files are saved under 'units/<key>/' and it is then added to 'manifest.jsonl' along with the sha256 of every
+# file. Units are only restored if all of their files are present and match the manifest.
+#
+# A local directory does not survive the instance it is on, so with a 'remote_folder' (--checkpoint_folder, a DNAnexus
+# folder as '[project-xxxx:]/path') each unit is also uploaded there, as one tar, as soon as it is saved. A restarted
+# job given the same folder downloads the units of its run into 'directory' before anything is restored. DNAnexus
+# files only become visible once closed, so a unit whose upload was cut short is simply not found.
+class CheckpointStore:
+
+    def __init__(self, directory: Optional[Path], run_key: str, remote_folder: Optional[str] = None):
+
+        self._directory = directory
+        self._run_key = run_key
+        self._lock = threading.Lock()
+        self._manifest: Dict[str, dict] = {}
+        self._remote_project: Optional[str] = None
+        self._remote_folder: Optional[str] = None
+
+        if directory is not None:
+            (directory / 'units').mkdir(parents=True, exist_ok=True)
+            manifest_path = directory / CHECKPOINT_MANIFEST
+            if manifest_path.exists():
+                with manifest_path.open('r') as manifest_file:
+                    for line in manifest_file:
+                        try:
+                            unit = json.loads(line)
+                            self._manifest[unit['key']] = unit
+                        except (ValueError, KeyError):
+                            # A partial line from a run that was stopped while writing – that unit is just redone
+                            continue
+
+            if remote_folder is not None:
+                self._remote_project, self._remote_folder = self._parse_remote_folder(remote_folder)
+                self._download_remote_units()
+            print(f'Found {len(self._manifest)} checkpointed units in {directory}')
+
+    # Split '[project-xxxx:]/path' into a project and folder. Without a project, the folder is in the project the job
+    # was launched from (not the job's temporary workspace, which is gone once the job is).
+    @staticmethod
+    def _parse_remote_folder(remote_folder: str) -> Tuple[str, str]:
+
+        if ':' in remote_folder:
+            project, folder = remote_folder.split(':', 1)
+        else:
+            project, folder = dxpy.PROJECT_CONTEXT_ID, remote_folder
+        if project is None:
+            raise dxpy.AppError(f'No project given for --checkpoint_folder {remote_folder}')
+        return project, '/' + folder.strip('/')
+
+    def _get_remote_name(self, key: str) -> str:
+        return f'{self._run_key[:CHECKPOINT_RUN_PREFIX_LENGTH]}.{key}{CHECKPOINT_SUFFIX}'
+
+    # Download and unpack every unit of this run in the remote folder that is not already in the local directory
+    def _download_remote_units(self) -> None:
+
+        found = dxpy.find_data_objects(classname='file', state='closed', project=self._remote_project,
+                                       folder=self._remote_folder, recurse=False,
+                                       name=self._get_remote_name('*'), name_mode='glob',
+                                       describe={'fields': {'name': True}})
+        downloaded = 0
+        for remote_file in found:
+            remote_name = remote_file['describe']['name']
+            key = remote_name[:-len(CHECKPOINT_SUFFIX)].split('.', 1)[1]
+            if key in self._manifest:
+                continue
+
+            local_tar = self._directory / remote_name
+            dxpy.download_dxfile(remote_file['id'], str(local_tar), project=self._remote_project)
+            unit_dir = self._directory / 'units' / key
+            unit_dir.mkdir(parents=True, exist_ok=True)
+            with tarfile.open(local_tar, 'r') as unit_tar:
+                # Units only ever hold plain files at their top level
+                unit_tar.extractall(unit_dir, members=[member for member in unit_tar.getmembers()
+                                                       if member.isfile() and '/' not in member.name])
+            local_tar.unlink()
+            with (unit_dir / CHECKPOINT_UNIT_FILE).open('r') as unit_file:
+                unit = json.load(unit_file)
+            self._add_to_manifest(unit)
+            downloaded += 1
+        print(f'Downloaded {downloaded} checkpointed units from {self._remote_project}:{self._remote_folder}')
+
+    # Upload a saved unit to the remote folder. A failed upload is not fatal – the unit is just redone on restart.
+    def _upload_unit(self, unit: dict) -> None:
+
+        unit_dir = self._directory / 'units' / unit['key']
+        with (unit_dir / CHECKPOINT_UNIT_FILE).open('w') as unit_file:
+            json.dump(unit, unit_file)
+        local_tar = self._directory / self._get_remote_name(unit['key'])
+        with tarfile.open(local_tar, 'w') as unit_tar:
+            for stored_path in sorted(unit_dir.iterdir()):
+                unit_tar.add(stored_path, arcname=stored_path.name)
+        try:
+            dxpy.upload_local_file(str(local_tar), name=local_tar.name, project=self._remote_project,
+                                   folder=self._remote_folder, parents=True, wait_on_close=True)
+        except dxpy.DXError as upload_error:
+            print(f'Could not upload the checkpoint for {unit["task"]}: {upload_error}')
+        finally:
+            local_tar.unlink()
+
+    def _add_to_manifest(self, unit: dict) -> None:
+
+        with self._lock:
+            with (self._directory / CHECKPOINT_MANIFEST).open('a') as manifest_file:
+                manifest_file.write(json.dumps(unit) + '\n')
+                manifest_file.flush()
+                os.fsync(manifest_file.fileno())
+            self._manifest[unit['key']] = unit
+
+    @property
+    def enabled(self) -> bool:
+        return self._directory is not None
+
+    def get_key(self, name: Any, inputs: Iterable[str], dependency_keys: Iterable[str]) -> str:
+
+        key_hash = hashlib.sha256(json.dumps({'run': self._run_key,
+                                              'task': repr(name),
+                                              'inputs': list(inputs),
+                                              'dependencies': sorted(dependency_keys)}).encode())
+        return key_hash.hexdigest()
+
+    # Copy a unit's files back into place and load its result. Returns whether the unit was restored, and its result.
+    def restore(self, key: str, checkpoint: Checkpoint) -> Tuple[bool, Any]:
+
+        if key not in self._manifest:
+            return False, None
+
+        unit = self._manifest[key]
+        if set(unit['files']) != set(checkpoint.files) or (checkpoint.save_result and unit['result'] is None):
+            return False, None
+        unit_dir = self._directory / 'units' / key
+        stored_files = dict(unit['files'])
+        if checkpoint.save_result:
+            stored_files['result.pkl'] = unit['result']
+        for name, file_hash in stored_files.items():
+            stored_path = unit_dir / name
+            if not stored_path.exists() or _hash_file(stored_path) != file_hash:
+                print(f'Checkpoint for {unit["task"]} is incomplete or corrupt, redoing it')
+                return False, None
+
+        for name, destination in checkpoint.files.items():
+            shutil.copyfile(unit_dir / name, destination)
+        result = None
+        if checkpoint.save_result:
+            with (unit_dir / 'result.pkl').open('rb') as result_file:
+                result = pickle.load(result_file)
+        return True, result
+
+    # Save a finished unit. Files are copied in first and the unit is only added to the manifest once they are all in
+    # place, so a unit interrupted part-way through saving is never restored.
+    def save(self, key: str, name: Any, checkpoint: Checkpoint, result: Any) -> None:
+
+        unit_dir = self._directory / 'units' / key
+        unit_dir.mkdir(parents=True, exist_ok=True)
+        file_hashes = {}
+        for file_name, source in checkpoint.files.items():
+            temporary = unit_dir / f'{file_name}.tmp'
+            shutil.copyfile(source, temporary)
+            file_hashes[file_name] = _hash_file(temporary)
+            os.replace(temporary, unit_dir / file_name)
+
+        result_hash = None
+        if checkpoint.save_result:
+            with (unit_dir / 'result.pkl.tmp').open('wb') as result_file:
+                pickle.dump(result, result_file)
+            result_hash = _hash_file(unit_dir / 'result.pkl.tmp')
+            os.replace(unit_dir / 'result.pkl.tmp', unit_dir / 'result.pkl')
+
+        unit = {'key': key, 'task': repr(name), 'files': file_hashes, 'result': result_hash, 'time': int(time.time())}
+        self._add_to_manifest(unit)
+        if self._remote_folder is not None:
+            self._upload_unit(unit)
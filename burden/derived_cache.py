@@ -0,0 +1,64 @@
+import hashlib
+import json
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+from burden.resource_cache import ResourceCache
+
+# Bump the version of an artifact whenever the code (or the docker image tool) that builds it changes, so that stale
+# cached copies are never used
+DERIVED_ARTIFACT_VERSIONS = {'bolt_masks': 1,
+                             'regenie_masks': 1,
+                             'saige_inputs': 1,
+                             'glm_genotypes': 2}
+
+
+# A cache of phenotype-independent files derived from mask tarballs (renamed / subset BOLT bgens, REGENIE annotation
+# files, SAIGE group files and sample-subset bcfs, GLM genotype packs). Entries are keyed on the checksums of the
+# tarballs they were built from, the samples being tested, the artifact version, and anything else that changes the
+# output (e.g. --combine_masks). Storage, size limits, and eviction are handled by a ResourceCache.
+#
+# With no cache every lookup is a miss and the artifact is just built, so runners can use this unconditionally.
+class DerivedCache:
+
+    def __init__(self, cache: Optional[ResourceCache], tarball_keys: Dict[str, str]):
+
+        self._cache = cache
+        self._tarball_keys = tarball_keys
+        self._samples_hash = None
+        if cache is not None:
+            with Path('SAMPLES_Include.txt').open('rb') as sample_file:
+                self._samples_hash = hashlib.sha256(sample_file.read()).hexdigest()
+
+    @property
+    def enabled(self) -> bool:
+        return self._cache is not None
+
+    # Checksum-based keys of the given tarballs, also used to key checkpoints
+    def get_tarball_keys(self, tarball_prefixes: List[str]) -> List[str]:
+        return [self._tarball_keys[tarball_prefix] for tarball_prefix in tarball_prefixes]
+
+    def get_key(self, artifact: str, tarball_prefixes: List[str], chromosome: Optional[str], options: dict) -> str:
+
+        derived_hash = hashlib.sha256(json.dumps({'artifact': artifact,
+                                                  'version': DERIVED_ARTIFACT_VERSIONS[artifact],
+                                                  'tarballs': [[tarball_prefix, self._tarball_keys[tarball_prefix]]
+                                                               for tarball_prefix in tarball_prefixes],
+                                                  'chromosome': chromosome,
+                                                  'samples': self._samples_hash,
+                                                  'options': options}).encode())
+        return f'derived.{artifact}.{derived_hash.hexdigest()}'
+
+    # Link the files named in 'files' (name in the cache -> path in the working directory) out of the cache, or run
+    # 'build' to create them and add them to the cache. Safe to call from multiple threads.
+    def load_or_build(self, artifact: str, tarball_prefixes: List[str], chromosome: Optional[str],
+                      files: Dict[str, str], build: Callable[[], None], options: Optional[dict] = None) -> None:
+
+        if self._cache is None:
+            build()
+            return
+
+        key = self.get_key(artifact, tarball_prefixes, chromosome, {} if options is None else options)
+        if not self._cache.fetch(key, files):
+            build()
+            self._cache.store(key, files)
@@ -0,0 +1,93 @@
+from typing import Dict, Optional
+
+import dxpy
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+# Arrays making up a saved GenotypePack, each stored as <prefix>.<name>.npy
+GENOTYPE_PACK_ARRAYS = ['genes', 'samples', 'indptr', 'indices', 'dosages', 'index_names']
+
+
+# The genotypes of one mask as a CSR (genes x samples) carrier matrix, in place of the (ENST, sample)-indexed table
+# returned by load_tarball_linear_model(), which takes tens of GB across many masks at 470K samples:
+#
+# genes       – gene IDs, in row order
+# samples     – sample IDs, in column order
+# indptr      – row offsets: carriers of genes[i] are at indptr[i]:indptr[i + 1]
+# indices     – the int32 column (sample) of each carrier
+# dosages     – the uint8 genotype ('gt') of each carrier
+#
+# Packs are saved as plain .npy files (so they can be kept in the derived cache and reused across runs) and loaded
+# memory-mapped, so only the parts that are used are ever read into memory.
+class GenotypePack:
+
+    def __init__(self, arrays: Dict[str, np.ndarray]):
+
+        self._arrays = arrays
+        self.genes = pd.Index(arrays['genes'])
+        self.samples = pd.Index(arrays['samples'])
+        self._index_names = list(arrays['index_names'])
+
+    @classmethod
+    def from_table(cls, genotype_table: pd.DataFrame) -> 'GenotypePack':
+
+        gene_index = genotype_table.index.remove_unused_levels()
+        samples = gene_index.levels[1]
+        genotypes = genotype_table['gt'].to_numpy()
+        dosages = genotypes.astype(np.uint8)
+        if not np.array_equal(dosages, genotypes):
+            raise dxpy.AppError('GLM genotypes must be whole numbers between 0 and 255!')
+
+        carrier_matrix = sparse.csr_matrix((dosages, (gene_index.codes[0], gene_index.codes[1])),
+                                           shape=(len(gene_index.levels[0]), len(samples)), dtype=np.uint8)
+        carrier_matrix.sort_indices()
+        return cls({'genes': cls._to_array(gene_index.levels[0]),
+                    'samples': cls._to_array(samples),
+                    'indptr': carrier_matrix.indptr.astype(np.int64),
+                    'indices': carrier_matrix.indices.astype(np.int32),
+                    'dosages': carrier_matrix.data,
+                    'index_names': np.array([str(name) for name in gene_index.names])})
+
+    # IDs are saved as fixed-width strings (or numbers), so that packs can be loaded without pickle
+    @staticmethod
+    def _to_array(ids: pd.Index) -> np.ndarray:
+        return ids.to_numpy() if pd.api.types.is_numeric_dtype(ids.dtype) else ids.to_numpy().astype(str)
+
+    @staticmethod
+    def get_paths(prefix: str) -> Dict[str, str]:
+        return {name: f'{prefix}.{name}.npy' for name in GENOTYPE_PACK_ARRAYS}
+
+    def save(self, prefix: str) -> None:
+        for name, path in self.get_paths(prefix).items():
+            np.save(path, self._arrays[name])
+
+    @classmethod
+    def load(cls, prefix: str) -> 'GenotypePack':
+        return cls({name: np.load(path, mmap_mode='r') for name, path in cls.get_paths(prefix).items()})
+
+    # The (genes x samples) carrier matrix, with samples in the order of 'samples' if given (carriers not in 'samples'
+    # are dropped) and genotypes as float64, ready for matrix products
+    def get_matrix(self, samples: Optional[pd.Index] = None) -> sparse.csr_matrix:
+
+        indptr = np.asarray(self._arrays['indptr'])
+        indices = np.asarray(self._arrays['indices'])
+        dosages = np.asarray(self._arrays['dosages'], dtype=np.float64)
+        if samples is None:
+            return sparse.csr_matrix((dosages, indices, indptr), shape=(len(self.genes), len(self.samples)))
+
+        columns = samples.get_indexer(self.samples.astype(str))[indices]
+        found = columns >= 0
+        rows = np.repeat(np.arange(len(self.genes)), np.diff(indptr))
+        return sparse.csr_matrix((dosages[found], (rows[found], columns[found])),
+                                 shape=(len(self.genes), len(samples)))
+
+    # One gene's carriers as the (ENST, sample)-indexed table that run_linear_model() expects
+    def get_gene_table(self, gene: str) -> pd.DataFrame:
+
+        gene_row = self.genes.get_loc(gene)
+        start, end = self._arrays['indptr'][gene_row], self._arrays['indptr'][gene_row + 1]
+        carriers = self.samples[np.asarray(self._arrays['indices'][start:end])]
+        return pd.DataFrame({'gt': np.asarray(self._arrays['dosages'][start:end], dtype=np.float64)},
+                            index=pd.MultiIndex.from_arrays([np.repeat(gene, len(carriers)), carriers],
+                                                            names=self._index_names))
@@ -0,0 +1,139 @@
+from typing import Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+import patsy
+from scipy import sparse
+from scipy.stats import norm
+
+from general_utilities.linear_model.linear_model import LinearModelPack
+
+# Mirrors run_linear_model() – by default, genes with a p. value from the residual model below this are refit with the
+# full model (see --glm_screen_threshold)
+FULL_MODEL_P_THRESHOLD = 1e-4
+
+
+# The null formula is the full formula without its 'has_var' term. The term is removed from the parsed formula, so this
+# does not depend on how the formula is written.
+def get_null_formula(null_model: LinearModelPack) -> patsy.ModelDesc:
+
+    full_formula = patsy.ModelDesc.from_formula(null_model.model_formula)
+    has_var = patsy.Term([patsy.EvalFactor('has_var')])
+    return patsy.ModelDesc(full_formula.lhs_termlist, [term for term in full_formula.rhs_termlist if term != has_var])
+
+
+# The (response, covariate design) of a phenotype's null model as built by patsy, indexed on FID. Appending a genotype
+# column to the design gives the full model fit by run_linear_model(), with the genotype coefficient matching 'has_var'.
+def get_null_design(null_model: LinearModelPack) -> Tuple[pd.Series, pd.DataFrame]:
+
+    response, design = patsy.dmatrices(get_null_formula(null_model), data=null_model.phenotypes,
+                                       return_type='dataframe')
+    return response.iloc[:, 0], design
+
+
+# The response residuals of a phenotype's covariate-only model (indexed on FID). linear_model_null() has already fit
+# that model and kept its residuals in 'null_table' – the same residuals run_linear_model() tests for 'p_val_init'.
+def get_null_residuals(null_model: LinearModelPack) -> pd.Series:
+    return null_model.null_table['resid']
+
+
+# Holds null-model residuals (and raw phenotype values) for every phenotype being tested (one, or all in a batch) as
+# (samples x phenotypes) arrays on a common sample index. Residuals come from each phenotype's null model, so nothing
+# is refit here. Samples not used by a phenotype's null model are masked out for that phenotype, so a single set of
+# matrix products gives per-phenotype statistics for every gene.
+class ResidualMatrix:
+
+    def __init__(self, null_models: Dict[str, LinearModelPack]):
+
+        self.pheno_names = list(null_models.keys())
+        residuals = pd.DataFrame({phenoname: get_null_residuals(null_model)
+                                  for phenoname, null_model in null_models.items()})
+        residuals.index = residuals.index.astype(str)
+        self.samples = residuals.index
+
+        phenotypes = pd.DataFrame({phenoname: null_model.phenotypes[phenoname]
+                                   for phenoname, null_model in null_models.items()})
+        phenotypes.index = phenotypes.index.astype(str)
+        phenotypes = phenotypes.reindex(self.samples)
+
+        residual_values = residuals.to_numpy(dtype=np.float64)
+        self.observed = ~np.isnan(residual_values)
+        self.residuals = np.where(self.observed, residual_values, 0)
+        self.phenotypes = np.where(self.observed, phenotypes.to_numpy(dtype=np.float64), 0)
+
+        self.n_model = self.observed.sum(axis=0)
+        self.residual_sum = self.residuals.sum(axis=0)
+        self.residual_sq_sum = (self.residuals ** 2).sum(axis=0)
+        self.n_affected = self.phenotypes.sum(axis=0)
+
+
+# Test every gene in a mask against every phenotype at once. For each gene and phenotype this is the same simple
+# regression of null-model residuals on genotype that run_linear_model() uses for 'p_val_init', but done for all genes
+# as sparse (genes x samples) x dense (samples x phenotypes) products, with no per-gene model fit or index lookup.
+#
+# 'genotype_matrix' is the mask's GenotypePack matrix on the ResidualMatrix samples, with rows 'genes'. Returns rows (as
+# LinearModelResult.todict() would give them) for every gene / phenotype that does not pass 'screen_threshold', and
+# (gene row, phenotype index, row) for those that do, which must be refit with the full model to fill in 'p_val_full',
+# 'effect' and 'std_err'.
+def score_all_genes(residual_matrix: ResidualMatrix, genes: pd.Index, genotype_matrix: sparse.csr_matrix,
+                    mask_name: str, is_binary: bool,
+                    screen_threshold: float = FULL_MODEL_P_THRESHOLD) -> Tuple[List[dict], List[Tuple[int, int, dict]]]:
+
+    carrier_matrix = genotype_matrix.copy()
+    carrier_matrix.data = (carrier_matrix.data > 0).astype(np.float64)
+    observed = residual_matrix.observed.astype(np.float64)
+
+    # All (genes x phenotypes)
+    n_model = residual_matrix.n_model
+    n_car = carrier_matrix @ observed
+    sum_x = genotype_matrix @ observed
+    sum_xx = genotype_matrix.multiply(genotype_matrix) @ observed
+    sum_xr = genotype_matrix @ residual_matrix.residuals
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_x = sum_x / n_model
+        mean_r = residual_matrix.residual_sum / n_model
+        centered_xx = sum_xx - n_model * mean_x ** 2
+        centered_xr = sum_xr - n_model * mean_x * mean_r
+        centered_rr = residual_matrix.residual_sq_sum - n_model * mean_r ** 2
+        effect = centered_xr / centered_xx
+        scale = (centered_rr - effect * centered_xr) / (n_model - 2)
+        std_err = np.sqrt(scale / centered_xx)
+        p_val_init = 2 * norm.sf(np.abs(effect / std_err))
+
+    # Too few carriers to test – same cut-off as run_linear_model()
+    testable = n_car > 2
+    refit = testable & (p_val_init < screen_threshold)
+    if is_binary:
+        n_car_affected = carrier_matrix @ residual_matrix.phenotypes
+
+    results = []
+    refits = []
+    for gene_index, gene in enumerate(genes):
+        for pheno_index, phenoname in enumerate(residual_matrix.pheno_names):
+
+            is_testable = testable[gene_index, pheno_index]
+            gene_result = {'ENST': gene,
+                           'maskname': mask_name,
+                           'pheno_name': phenoname,
+                           'p_val_init': p_val_init[gene_index, pheno_index] if is_testable else float('nan'),
+                           'n_car': int(n_car[gene_index, pheno_index]),
+                           'cMAC': int(sum_x[gene_index, pheno_index]),
+                           'n_model': int(n_model[pheno_index]),
+                           'p_val_full': float('nan'),
+                           'effect': effect[gene_index, pheno_index] if is_testable else float('nan'),
+                           'std_err': std_err[gene_index, pheno_index] if is_testable else float('nan')}
+            if is_binary:
+                car_affected = int(n_car_affected[gene_index, pheno_index])
+                noncar_affected = int(residual_matrix.n_affected[pheno_index]) - car_affected
+                gene_result.update({'n_car_affected': car_affected,
+                                    'n_car_unaffected': int(n_car[gene_index, pheno_index]) - car_affected,
+                                    'n_noncar_affected': noncar_affected,
+                                    'n_noncar_unaffected': int(n_model[pheno_index] -
+                                                               n_car[gene_index, pheno_index]) - noncar_affected})
+            if refit[gene_index, pheno_index]:
+                refits.append((gene_index, pheno_index, gene_result))
+            else:
+                results.append(gene_result)
+
+    return results, refits
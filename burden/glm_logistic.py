@@ -0,0 +1,233 @@
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import statsmodels.api as sm
+from scipy import sparse
+from scipy.special import expit
+from scipy.stats import chi2, norm
+
+from burden.glm_batch import ResidualMatrix, get_null_design
+from general_utilities.linear_model.linear_model import LinearModelPack
+
+# Genes (of one phenotype) are fit together in batches of this many. Each batch holds a few (samples x batch) arrays.
+LOGISTIC_BATCH_SIZE = 16
+# IRLS stops once the deviance changes by less than this – as statsmodels' GLM.fit()
+LOGISTIC_TOLERANCE = 1e-8
+LOGISTIC_MAX_ITERATIONS = 25
+# Converged fits with a larger genotype effect (log odds ratio) have (quasi-)separated and are refit with Firth
+LOGISTIC_MAX_EFFECT = 10
+# Firth fits follow the defaults of R's logistf
+FIRTH_TOLERANCE = 1e-5
+FIRTH_MAX_ITERATIONS = 25
+FIRTH_MAX_STEP = 5
+FIRTH_MAX_HALVINGS = 25
+
+
+# A phenotype's null (covariate-only) logistic model:
+#
+# design          – the (samples x covariates) design matrix of the null model
+# response        – the 0 / 1 phenotype of each design row
+# to_design       – (ResidualMatrix samples x design rows) selection matrix, mapping genotypes onto design rows
+# coefficients    – maximum likelihood null coefficients, which every gene's fit starts from
+# firth_coefficients – the Firth-penalised null coefficients, which every gene's Firth fits start from
+@dataclass
+class LogisticNullModel:
+    design: np.ndarray
+    response: np.ndarray
+    to_design: sparse.csr_matrix
+    coefficients: np.ndarray
+    firth_coefficients: np.ndarray
+
+
+# Log likelihood of every column of linear predictors 'eta'
+def _log_likelihood(response: np.ndarray, eta: np.ndarray) -> np.ndarray:
+    return (response[:, np.newaxis] * eta - np.logaddexp(0, eta)).sum(axis=0)
+
+
+# Fisher information of the full model (covariates, then genotype) for one gene with IRLS weights 'weights'
+def _get_information(design: np.ndarray, genotypes: np.ndarray, weights: np.ndarray) -> np.ndarray:
+
+    weighted_design = design * weights[:, np.newaxis]
+    weighted_genotypes = weights * genotypes
+    information = np.empty((design.shape[1] + 1, design.shape[1] + 1))
+    information[:-1, :-1] = weighted_design.T @ design
+    information[:-1, -1] = information[-1, :-1] = design.T @ weighted_genotypes
+    information[-1, -1] = genotypes @ weighted_genotypes
+    return information
+
+
+# Fit a logistic model with Firth's penalised likelihood, as R's logistf: Newton steps on the modified score, capped at
+# FIRTH_MAX_STEP and halved until the penalised log likelihood does not decrease. Returns (coefficients, covariance,
+# penalised log likelihood).
+#
+# Only coefficients where 'free' is True are fit; the others stay at their 'start' values. As in logistf, the penalty
+# (and so the modified score) still comes from the whole design, so a fit with a coefficient fixed at 0 is the
+# restricted model of that coefficient's penalised likelihood ratio test.
+def fit_firth(design: np.ndarray, response: np.ndarray, start: np.ndarray,
+              free: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray, float]:
+
+    def penalise(coefficients: np.ndarray) -> Tuple[float, np.ndarray, np.ndarray, np.ndarray]:
+        eta = design @ coefficients
+        fitted = expit(eta)
+        fit_weights = fitted * (1 - fitted)
+        fit_information = (design * fit_weights[:, np.newaxis]).T @ design
+        _, log_determinant = np.linalg.slogdet(fit_information)
+        log_likelihood = (response * eta - np.logaddexp(0, eta)).sum() + 0.5 * log_determinant
+        return log_likelihood, fitted, fit_weights, fit_information
+
+    free = np.ones(design.shape[1], dtype=bool) if free is None else free
+    coefficients = start.astype(np.float64)
+    penalised_log_likelihood, mu, weights, information = penalise(coefficients)
+    for _ in range(FIRTH_MAX_ITERATIONS):
+        covariance = np.linalg.inv(information)
+        hat = weights * ((design @ covariance) * design).sum(axis=1)
+        score = (design.T @ (response - mu + hat * (0.5 - mu)))[free]
+        step = np.zeros(design.shape[1])
+        step[free] = np.linalg.solve(information[np.ix_(free, free)], score)
+        largest_step = np.abs(step).max()
+        if largest_step > FIRTH_MAX_STEP:
+            step *= FIRTH_MAX_STEP / largest_step
+
+        for _ in range(FIRTH_MAX_HALVINGS):
+            stepped = penalise(coefficients + step)
+            if stepped[0] >= penalised_log_likelihood:
+                break
+            step /= 2
+        coefficients = coefficients + step
+        penalised_log_likelihood, mu, weights, information = stepped
+        if np.abs(step).max() < FIRTH_TOLERANCE and np.abs(score).max() < FIRTH_TOLERANCE:
+            break
+
+    return coefficients, np.linalg.inv(information), penalised_log_likelihood
+
+
+# Refits binary-trait genes passing the screen (the Gaussian residual score test of glm_batch.score_all_genes(), which
+# treats the 0 / 1 phenotype as quantitative) with the full logistic model, many genes at a time, in place of one
+# statsmodels fit per gene:
+#
+# 1. Every fit starts from the null model coefficients (with a genotype effect of 0), so genes with a modest effect
+#    converge in a few IRLS iterations.
+# 2. IRLS runs for a batch of genes together – linear predictors, fitted values and scores are (samples x genes) array
+#    operations, leaving only the small per-gene information matrices to invert. 'effect', 'std_err' and 'p_val_full'
+#    are the Wald statistics of the converged fit, as from statsmodels.
+# 3. Genes that separate – all carriers affected or unaffected (from the confusion matrix fields) or a fit that does
+#    not converge or runs off to a huge effect – are refit with Firth's penalised likelihood instead, with 'p_val_full'
+#    from logistf's penalised likelihood ratio test: against a fit of the same design with the genotype effect fixed
+#    at 0, so that both likelihoods carry the same penalty.
+class BatchedLogisticRegression:
+
+    def __init__(self, residual_matrix: ResidualMatrix, null_models: Dict[str, LinearModelPack]):
+
+        self._null_models = []
+        for phenoname in residual_matrix.pheno_names:
+            response, design = get_null_design(null_models[phenoname])
+            design_values = design.to_numpy(dtype=np.float64)
+            response_values = response.to_numpy(dtype=np.float64)
+
+            sample_rows = pd.Index(design.index.astype(str)).get_indexer(residual_matrix.samples)
+            found = np.flatnonzero(sample_rows >= 0)
+            to_design = sparse.csr_matrix((np.ones(len(found)), (found, sample_rows[found])),
+                                          shape=(len(residual_matrix.samples), len(design)))
+
+            coefficients = sm.GLM(response_values, design_values, family=sm.families.Binomial()).fit().params
+            firth_coefficients, _, _ = fit_firth(design_values, response_values, coefficients)
+            self._null_models.append(LogisticNullModel(design_values, response_values, to_design, coefficients,
+                                                       firth_coefficients))
+
+    # Split the (gene row, phenotype index, row) refits of a mask into batches for fit_batch()
+    @staticmethod
+    def get_batches(refits: List[Tuple[int, int, dict]]) -> List[List[Tuple[int, int, dict]]]:
+
+        by_phenotype: Dict[int, List[Tuple[int, int, dict]]] = {}
+        for refit in refits:
+            by_phenotype.setdefault(refit[1], []).append(refit)
+        return [phenotype_refits[batch_start:batch_start + LOGISTIC_BATCH_SIZE]
+                for phenotype_refits in by_phenotype.values()
+                for batch_start in range(0, len(phenotype_refits), LOGISTIC_BATCH_SIZE)]
+
+    # Run IRLS for the 'active' columns of 'genotypes' together. Returns the coefficients and covariance of every gene,
+    # and whether it converged.
+    @staticmethod
+    def _fit_irls(null_model: LogisticNullModel, genotypes: np.ndarray,
+                  active: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+
+        design = null_model.design
+        n_genes = genotypes.shape[1]
+        coefficients = np.tile(np.append(null_model.coefficients, 0), (n_genes, 1))
+        covariance = np.full((n_genes, design.shape[1] + 1, design.shape[1] + 1), np.nan)
+        converged = np.zeros(n_genes, dtype=bool)
+        active = active.copy()
+
+        eta = design @ coefficients[:, :-1].T + genotypes * coefficients[:, -1]
+        deviance = -2 * _log_likelihood(null_model.response, eta)
+        for _ in range(LOGISTIC_MAX_ITERATIONS):
+            if not active.any():
+                break
+            mu = expit(eta[:, active])
+            residuals = null_model.response[:, np.newaxis] - mu
+            scores = np.vstack([design.T @ residuals, (genotypes[:, active] * residuals).sum(axis=0)])
+            weights = mu * (1 - mu)
+            for batch_index, gene_index in enumerate(np.flatnonzero(active)):
+                information = _get_information(design, genotypes[:, gene_index], weights[:, batch_index])
+                try:
+                    coefficients[gene_index] += np.linalg.solve(information, scores[:, batch_index])
+                except np.linalg.LinAlgError:
+                    coefficients[gene_index] = np.nan
+
+            stepped = np.isfinite(coefficients).all(axis=1)
+            active &= stepped
+            eta[:, active] = design @ coefficients[active, :-1].T + genotypes[:, active] * coefficients[active, -1]
+            new_deviance = -2 * _log_likelihood(null_model.response, eta)
+            finished = active & (np.abs(new_deviance - deviance) <= LOGISTIC_TOLERANCE)
+            converged |= finished
+            active &= ~finished
+            deviance = new_deviance
+
+        mu = expit(eta)
+        weights = mu * (1 - mu)
+        for gene_index in np.flatnonzero(converged):
+            try:
+                covariance[gene_index] = np.linalg.inv(_get_information(design, genotypes[:, gene_index],
+                                                                        weights[:, gene_index]))
+            except np.linalg.LinAlgError:
+                converged[gene_index] = False
+        return coefficients, covariance, converged
+
+    # Fit one batch from get_batches() and return its rows with 'effect', 'std_err' and 'p_val_full' filled in.
+    # 'genotype_matrix' is the mask's GenotypePack matrix on the ResidualMatrix samples.
+    def fit_batch(self, genotype_matrix: sparse.csr_matrix, batch: List[Tuple[int, int, dict]]) -> List[dict]:
+
+        null_model = self._null_models[batch[0][1]]
+        gene_rows = [gene_row for gene_row, _, _ in batch]
+        genotypes = (genotype_matrix[gene_rows] @ null_model.to_design).T.toarray()
+        separated = np.array([row['n_car_affected'] in (0, row['n_car']) for _, _, row in batch])
+
+        coefficients, covariance, converged = self._fit_irls(null_model, genotypes, ~separated)
+        rows = []
+        for gene_index, (_, _, row) in enumerate(batch):
+            effect = coefficients[gene_index, -1]
+            if converged[gene_index] and abs(effect) <= LOGISTIC_MAX_EFFECT:
+                std_err = np.sqrt(covariance[gene_index, -1, -1])
+                p_val_full = 2 * norm.sf(abs(effect / std_err))
+            else:
+                effect, std_err, p_val_full = self._fit_firth(null_model, genotypes[:, gene_index])
+            row.update({'effect': effect, 'std_err': std_err, 'p_val_full': p_val_full})
+            rows.append(row)
+        return rows
+
+    @staticmethod
+    def _fit_firth(null_model: LogisticNullModel, genotypes: np.ndarray) -> Tuple[float, float, float]:
+
+        full_design = np.column_stack([null_model.design, genotypes])
+        start = np.append(null_model.firth_coefficients, 0)
+        covariates = np.append(np.ones(null_model.design.shape[1], dtype=bool), False)
+        try:
+            firth_coefficients, firth_covariance, firth_log_likelihood = \
+                fit_firth(full_design, null_model.response, start)
+            _, _, restricted_log_likelihood = fit_firth(full_design, null_model.response, start, free=covariates)
+        except np.linalg.LinAlgError:
+            return float('nan'), float('nan'), float('nan')
+        likelihood_ratio = max(0.0, 2 * (firth_log_likelihood - restricted_log_likelihood))
+        return firth_coefficients[-1], np.sqrt(firth_covariance[-1, -1]), chi2.sf(likelihood_ratio, 1)
@@ -0,0 +1,132 @@
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, Future, as_completed
+from pathlib import Path
+from typing import Dict, Iterator, List, Tuple
+
+import dxpy
+import numpy as np
+import pandas as pd
+import statsmodels.api as sm
+from scipy import sparse
+
+from burden.glm_batch import ResidualMatrix, get_null_design
+from general_utilities.linear_model.linear_model import LinearModelPack
+
+# Full model fits are sent to workers in chunks of this many gene / phenotype pairs
+GLM_CHUNK_SIZE = 32
+
+# Arrays attached by this worker process, keyed by path. Set up by _init_worker().
+_WORKER_ARRAYS: Dict[str, np.ndarray] = {}
+_WORKER_PHENOTYPES: List[Tuple[str, str, str, object]] = []
+
+
+def _get_array(path: str) -> np.ndarray:
+    if path not in _WORKER_ARRAYS:
+        _WORKER_ARRAYS[path] = np.load(path, mmap_mode='r')
+    return _WORKER_ARRAYS[path]
+
+
+def _init_worker(phenotypes: List[Tuple[str, str, str, object]]) -> None:
+    _WORKER_PHENOTYPES.extend(phenotypes)
+
+
+# Fit the full model for a chunk of (gene row, phenotype index) pairs from one mask. Runs in a worker process, which
+# reads the design matrices and genotypes straight from the (memory-mapped) published arrays. Returns (effect,
+# std_err, p_val_full) for each pair.
+def _fit_chunk(mask_paths: Tuple[str, str, str], pairs: List[Tuple[int, int]]) -> List[Tuple[float, float, float]]:
+
+    data, indices, indptr = (_get_array(path) for path in mask_paths)
+    fits = []
+    for gene_row, pheno_index in pairs:
+        design_path, response_path, rows_path, family = _WORKER_PHENOTYPES[pheno_index]
+        design = _get_array(design_path)
+        sample_rows = _get_array(rows_path)
+
+        # The gene's genotype for every sample in this phenotype's model, 0 for non-carriers
+        genotypes = np.zeros(design.shape[0])
+        gene_rows = sample_rows[indices[indptr[gene_row]:indptr[gene_row + 1]]]
+        found = gene_rows >= 0
+        genotypes[gene_rows[found]] = data[indptr[gene_row]:indptr[gene_row + 1]][found]
+
+        results = sm.GLM(_get_array(response_path), np.column_stack([design, genotypes]), family=family).fit()
+        fits.append((results.params[-1], results.bse[-1], results.pvalues[-1]))
+    return fits
+
+
+# Runs the full-model GLM fits left after screening (see glm_batch.score_all_genes()) on a pool of processes rather
+# than threads, so fits are not serialised by the GIL.
+#
+# Nothing large is pickled per task. The covariate design matrix (built once by patsy from the null model formula),
+# phenotype vector, and sparse genotype (carrier) matrix of each mask are written once as .npy files and memory-mapped
+# by every worker, so they share a single copy in the page cache. Tasks are chunks of GLM_CHUNK_SIZE (gene row,
+# phenotype) pairs. The genotype is the last column of the design, so its coefficient matches 'has_var' in the
+# formula fit by run_linear_model().
+class GLMProcessPool:
+
+    def __init__(self, residual_matrix: ResidualMatrix, null_models: Dict[str, LinearModelPack], processes: int):
+
+        self._array_dir = Path(tempfile.mkdtemp(dir='.'))
+        self._futures: Dict[Future, List[dict]] = {}
+
+        # Nothing is left behind if the pool cannot be started
+        try:
+            phenotypes = []
+            for phenoname in residual_matrix.pheno_names:
+                null_model = null_models[phenoname]
+                response, design = get_null_design(null_model)
+                # Row of each ResidualMatrix sample in this phenotype's design, or -1 if the sample is not in the model
+                sample_rows = pd.Index(design.index.astype(str)).get_indexer(residual_matrix.samples)
+                phenotypes.append((self._publish(f'{phenoname}.design', design.to_numpy(dtype=np.float64)),
+                                   self._publish(f'{phenoname}.response', response.to_numpy(dtype=np.float64)),
+                                   self._publish(f'{phenoname}.rows', sample_rows),
+                                   null_model.model_family))
+
+            self._executor = ProcessPoolExecutor(max_workers=max(1, processes), initializer=_init_worker,
+                                                 initargs=(phenotypes,))
+        except BaseException:
+            shutil.rmtree(self._array_dir, ignore_errors=True)
+            raise
+
+    def _publish(self, name: str, array: np.ndarray) -> str:
+        path = self._array_dir / f'{name}.npy'
+        np.save(path, np.ascontiguousarray(array))
+        return str(path)
+
+    # Queue full fits for one mask. 'refits' are the (gene row, phenotype index, row) returned by score_all_genes().
+    def submit(self, mask_name: str, genotype_matrix: sparse.csr_matrix, refits: List[Tuple[int, int, dict]]) -> None:
+
+        if len(refits) == 0:
+            return
+        mask_paths = (self._publish(f'{mask_name}.data', genotype_matrix.data),
+                      self._publish(f'{mask_name}.indices', genotype_matrix.indices),
+                      self._publish(f'{mask_name}.indptr', genotype_matrix.indptr))
+        for chunk_start in range(0, len(refits), GLM_CHUNK_SIZE):
+            chunk = refits[chunk_start:chunk_start + GLM_CHUNK_SIZE]
+            future = self._executor.submit(_fit_chunk, mask_paths,
+                                           [(gene_row, pheno_index) for gene_row, pheno_index, _ in chunk])
+            self._futures[future] = [row for _, _, row in chunk]
+
+    # Yield each refit row, with the full model filled in, as its chunk finishes
+    def collect(self) -> Iterator[dict]:
+
+        for future in as_completed(self._futures):
+            try:
+                fits = future.result()
+            except Exception as fit_error:
+                raise dxpy.AppError(f'A GLM process failed: {fit_error}') from fit_error
+            for row, (effect, std_err, p_val_full) in zip(self._futures[future], fits):
+                row.update({'effect': effect, 'std_err': std_err, 'p_val_full': p_val_full})
+                yield row
+
+    def close(self) -> None:
+        for future in self._futures:
+            future.cancel()
+        self._executor.shutdown(wait=True)
+        shutil.rmtree(self._array_dir, ignore_errors=True)
+
+    def __enter__(self) -> 'GLMProcessPool':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
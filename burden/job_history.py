@@ -0,0 +1,100 @@
+import json
+import statistics
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+JOB_HISTORY_FILE = 'job_history.jsonl'
+
+# Estimates only use the most recent runs of each step, so they follow changes in tool versions and instance types
+MAX_HISTORY_RECORDS = 200
+
+# Converts job size into seconds for steps that have no history yet, for each unit jobs are measured in (see
+# get_work()). Only the relative size of jobs matters for ordering, so these only need to be roughly right (and roughly
+# consistent with each other) for the expected makespan to be meaningful.
+DEFAULT_SECONDS_PER_UNIT = {'variant_samples': 1e-6, 'input_bytes': 1e-5}
+
+
+# Records how long each scheduled job took, along with how big it was, to a local JSON-lines file (one job per line)
+# and uses those records to estimate how long future jobs will take. Jobs are described by a dict with:
+#
+# step        – e.g. 'saige.step_two'. Jobs are only compared to previous runs of the same step
+# chromosome  – the chromosome the job covers, if any
+# masks       – the number of masks covered
+# variants    – variants in those masks (None if unknown)
+# genes       – genes in those masks (None if unknown)
+# input_bytes – size of the mask files read
+# samples     – samples being tested
+#
+# With no path (no --resource_cache_dir) nothing is saved or loaded, and estimates come from job size alone.
+#
+# Records are kept by (step, unit of work), so a job is only ever estimated from previous runs of the same step that
+# were measured in the same unit.
+class JobHistory:
+
+    def __init__(self, path: Optional[Path]):
+
+        self._path = path
+        self._records: Dict[Tuple[str, Optional[str]], List[dict]] = {}
+        self._new_records: List[dict] = []
+
+        if path is not None and path.exists():
+            with path.open('r') as history_file:
+                for line in history_file:
+                    try:
+                        record = json.loads(line)
+                        self._records.setdefault(self._get_history_key(record), []).append(record)
+                    except (ValueError, KeyError):
+                        # A partial line from a job that was killed while writing – skip it
+                        continue
+
+    # The size of a job as (unit, amount): variants x samples ('variant_samples') when the variants in a job are known,
+    # otherwise the size of the (genotype) files it reads ('input_bytes'). (None, None) for jobs with no size.
+    @staticmethod
+    def get_work(job: dict) -> Tuple[Optional[str], Optional[float]]:
+
+        if job.get('variants') is not None:
+            return 'variant_samples', max(job['variants'], 1) * max(job.get('samples') or 1, 1)
+        elif job.get('input_bytes'):
+            return 'input_bytes', job['input_bytes']
+        else:
+            return None, None
+
+    def _get_history_key(self, job: dict) -> Tuple[str, Optional[str]]:
+        return job['step'], self.get_work(job)[0]
+
+    # Estimated run time of a job in seconds, or None if there is nothing to base an estimate on. Jobs of a known size
+    # are estimated from the median seconds per unit of work of previous runs of the same step, in the same unit. Jobs
+    # with no size (e.g. bgen downloads) use the median time of previous sizeless runs of the step on the same
+    # chromosome, or of the step in general.
+    def estimate(self, job: dict) -> Optional[float]:
+
+        records = self._records.get(self._get_history_key(job), [])[-MAX_HISTORY_RECORDS:]
+        unit, work = self.get_work(job)
+        if work is None:
+            chromosome_seconds = [record['seconds'] for record in records
+                                  if record.get('chromosome') == job.get('chromosome')]
+            step_seconds = chromosome_seconds if len(chromosome_seconds) > 0 else \
+                [record['seconds'] for record in records]
+            return statistics.median(step_seconds) if len(step_seconds) > 0 else None
+
+        rates = [record['seconds'] / self.get_work(record)[1] for record in records]
+        return work * (statistics.median(rates) if len(rates) > 0 else DEFAULT_SECONDS_PER_UNIT[unit])
+
+    def record(self, job: dict, seconds: float) -> None:
+
+        record = dict(job, seconds=round(seconds, 3), time=int(time.time()))
+        self._records.setdefault(self._get_history_key(job), []).append(record)
+        self._new_records.append(record)
+
+    # Append jobs recorded since the last save to the history file. Several jobs may share a history file, so new
+    # records are only ever appended.
+    def save(self) -> None:
+
+        if self._path is None or len(self._new_records) == 0:
+            return
+        self._path.parent.mkdir(parents=True, exist_ok=True)
+        with self._path.open('a') as history_file:
+            for record in self._new_records:
+                history_file.write(json.dumps(record) + '\n')
+        self._new_records = []
@@ -3,6 +3,7 @@ from typing import Type
 import dxpy
 from burden import burden_ingester
 from burden.burden_association_pack import BurdenProgramArgs, BurdenAssociationPack
+from burden.profiler import PROFILER
 from runassociationtesting.module_loader import ModuleLoader
 from burden.tool_runners.bolt_runner import BOLTRunner
 from burden.tool_runners.glm_runner import GLMRunner
@@ -27,7 +28,11 @@ class LoadModule(ModuleLoader):
         # every possible tool is a subclass of 'ToolRunner' with a required method of 'run_tool' we should be OK.
         current_tool = current_class(self.association_pack,
                                      self.output_prefix)
-        current_tool.run_tool()
+        with PROFILER.span(self.parsed_options.tool, 'tool'):
+            current_tool.run_tool()
+            current_tool.end_stage()
+        current_tool.bundle_null_models()
+        current_tool.write_profile()
 
         # Retrieve outputs – all tools _should_ append to the outputs object so they can be retrieved here.
         self.set_outputs(current_tool.get_outputs())
@@ -99,12 +104,94 @@ class LoadModule(ModuleLoader):
                                        "[typically located at /Bulk/Genotype Results/Genotype calls/ukb_snp_qc.txt].",
                                   type=self.dxfile_input, dest='regenie_smaller_snps', required=False,
                                   default='None')
+        self._parser.add_argument('--stream_tarballs',
+                                  help="Decompress association tarballs directly from the download stream and only "
+                                       "extract the files used by the selected --tool, rather than downloading and "
+                                       "extracting the entire tarball. Tarballs may be gzip, zstd, or uncompressed.",
+                                  dest='stream_tarballs', action='store_true')
+        self._parser.add_argument('--resource_cache_dir',
+                                  help="A directory (e.g. on a volume shared between jobs) in which to "
+                                       "persistently cache downloaded resources, keyed by file ID and checksum. Files "
+                                       "already in the cache are hardlinked (or, across filesystems, copied) into "
+                                       "place rather than downloaded again. Caching is off if not provided.",
+                                  type=str, dest='resource_cache_dir', required=False, default=None)
+        self._parser.add_argument('--resource_cache_max_gb',
+                                  help="Maximum size of --resource_cache_dir in GB. Least-recently-used files are "
+                                       "evicted once this is exceeded.",
+                                  type=float, dest='resource_cache_max_gb', required=False, default=250)
+        self._parser.add_argument('--dosage_bgen',
+                                  help="When running BOLT with --dosage_index, convert the sample-filtered dosage "
+                                       "files to 8-bit BGEN v1.2 rather than bgzipped text dosage files.",
+                                  dest='dosage_bgen', action='store_true')
+        self._parser.add_argument('--null_model',
+                                  help="A '<output_prefix>.null_models.tar.gz' bundle from a previous run. Null models "
+                                       "in the bundle are used instead of refitting them, provided they were fit to "
+                                       "the same phenotypes, covariates, samples, and genetic data as this run.",
+                                  type=self.dxfile_input, dest='null_model', required=False,
+                                  metavar=example_dxfile, default='None')
+        self._parser.add_argument('--combine_masks',
+                                  help="Test all masks on a chromosome in a single SAIGE / REGENIE step 2 run (one "
+                                       "merged bcf and group file for SAIGE, or one annotation, set list, and mask "
+                                       "file for REGENIE, per chromosome) rather than one run per mask and chromosome.",
+                                  dest='combine_masks', action='store_true')
+        self._parser.add_argument('--derived_cache_max_gb',
+                                  help="Maximum size in GB of the cache of phenotype-independent tool inputs built "
+                                       "from the association tarballs (kept in <resource_cache_dir>/derived). "
+                                       "Least-recently-used entries are evicted once this is exceeded.",
+                                  type=float, dest='derived_cache_max_gb', required=False, default=100)
+        self._parser.add_argument('--profile_python',
+                                  help="Also run the Python side of this module under cProfile and add the result "
+                                       "(<output_prefix>.python_profile.txt) to the outputs. This slows down "
+                                       "Python-heavy tools such as glm.",
+                                  dest='profile_python', action='store_true')
+        self._parser.add_argument('--checkpoint_dir',
+                                  help="A directory on persistent storage (e.g. a volume that outlives this job) to "
+                                       "save each completed unit of work to – step 1 models, per-chromosome step 2 "
+                                       "results, and parsed gene tables. A rerun with the same --checkpoint_dir (e.g. "
+                                       "after a spot instance is preempted) restores every unit whose inputs are "
+                                       "unchanged instead of redoing it. Only used by SAIGE, REGENIE, and STAAR.",
+                                  type=str, dest='checkpoint_dir', required=False, default=None)
+        self._parser.add_argument('--checkpoint_folder',
+                                  help="A DNAnexus folder ('[project-xxxx:]/path', in the job's project if no project "
+                                       "is given) to upload each completed unit of work to as soon as it is saved. A "
+                                       "restarted job given the same --checkpoint_folder downloads the units of the "
+                                       "same run from it, so checkpoints survive the loss of the instance. Implies a "
+                                       "local --checkpoint_dir of 'checkpoints/' if none is given.",
+                                  type=str, dest='checkpoint_folder', required=False, default=None)
+        self._parser.add_argument('--parquet_outputs',
+                                  help="Also write each per-gene and per-marker results table as Parquet "
+                                       "(<output_prefix>.genes.<TOOL>.stats.parquet), with a row group per "
+                                       "chromosome, dictionary-encoded ENST / MASK / MAF columns, and float32 columns "
+                                       "where that loses nothing. Requires pyarrow.",
+                                  dest='parquet_outputs', action='store_true')
+        self._parser.add_argument('--glm_screen_threshold',
+                                  help="When running glm, every gene is first tested with a fast residual model, and "
+                                       "only genes with a p. value below this threshold are refit with the full model "
+                                       "(p_val_full).",
+                                  type=float, dest='glm_screen_threshold', required=False, default=1e-4)
+        self._parser.add_argument('--glm_process_pool',
+                                  help="When running glm, run full model fits on a pool of processes (sharing "
+                                       "memory-mapped covariate and genotype matrices) rather than threads, so they "
+                                       "are not limited by Python's GIL.",
+                                  dest='glm_process_pool', action='store_true')
+        self._parser.add_argument('--staar_worker_pool',
+                                  help="When running staar, run gene tests on a fixed pool of long-lived R workers "
+                                       "that load the STAAR library and each null model once, rather than starting a "
+                                       "new Rscript for every mask and chromosome.",
+                                  dest='staar_worker_pool', action='store_true')
+        self._parser.add_argument('--staar_job_timeout_hours',
+                                  help="With --staar_worker_pool, the hours a worker has to finish one mask and "
+                                       "chromosome before it is treated as hung, killed, and the job retried. Jobs "
+                                       "are never timed out if not given.",
+                                  type=float, dest='staar_job_timeout_hours', required=False, default=None)
 
     def _parse_options(self) -> BurdenProgramArgs:
         return BurdenProgramArgs(**vars(self._parser.parse_args(self._input_args.split())))
 
     def _ingest_data(self, parsed_options: BurdenProgramArgs) -> BurdenAssociationPack:
-        ingested_data = burden_ingester.BurdenIngestData(parsed_options)
+        PROFILER.start(parsed_options.profile_python)
+        with PROFILER.span('ingest', 'stage'):
+            ingested_data = burden_ingester.BurdenIngestData(parsed_options)
         return ingested_data.get_association_pack()
 
     # Just defines possible tools usable by this module
@@ -0,0 +1,134 @@
+import hashlib
+import json
+import shutil
+import tarfile
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+import dxpy
+
+from burden.resource_cache import ResourceCache
+
+NULL_MODEL_MANIFEST = 'null_models.json'
+
+
+# Saves and restores fitted null models (SAIGE step 1, REGENIE step 1, STAAR and GLM null fits) so that rerunning the
+# same phenotype(s) against new masks does not refit them. A null model is identified by a hash of everything that
+# goes into the fit:
+#
+# 1. The tool and the phenotype(s) fit
+# 2. The phenotype and covariate values (every column of the formatted phenotype/covariate file except OTHER
+#    phenotypes)
+# 3. The sample inclusion list, trait type, sex and the covariates selected
+# 4. The genetic inputs (array data, sparse GRM, SNP lists) – see BurdenIngestData
+#
+# Null models are looked up in (in order) a bundle provided by the user with --null_model and the persistent resource
+# cache. Every null model used by a run is written to '<output_prefix>.null_models.tar.gz' so it can be passed back in
+# to a later run.
+class NullModelStore:
+
+    def __init__(self, cache: Optional[ResourceCache], genetics_key: str, is_binary: bool, sex: int,
+                 quantitative_covariates: List[str], categorical_covariates: List[str],
+                 input_bundle_dir: Optional[Path] = None):
+
+        self._cache = cache
+        self._genetics_key = genetics_key
+        self._is_binary = is_binary
+        self._sex = sex
+        self._quantitative_covariates = quantitative_covariates
+        self._categorical_covariates = categorical_covariates
+
+        self._input_bundle_dir = input_bundle_dir
+        self._input_manifest = {}
+        if input_bundle_dir is not None:
+            with (input_bundle_dir / NULL_MODEL_MANIFEST).open('r') as manifest_file:
+                self._input_manifest = json.load(manifest_file)
+
+        # key -> {'tool': str, 'phenonames': List[str], 'files': {name: path}} for every null model used by this run
+        self._used_models: Dict[str, dict] = {}
+
+    @staticmethod
+    def _hash_phenotypes(phenonames: List[str], all_phenonames: List[str], pheno_hash) -> None:
+
+        with Path('phenotypes_covariates.formatted.txt').open('r') as pheno_file:
+            header = pheno_file.readline().split()
+            keep = [column_number for column_number, column in enumerate(header)
+                    if column in phenonames or column not in all_phenonames]
+            pheno_hash.update(' '.join(header[column_number] for column_number in keep).encode())
+            for line in pheno_file:
+                fields = line.split()
+                pheno_hash.update(b'\n' + ' '.join(fields[column_number] for column_number in keep).encode())
+
+    def get_key(self, tool: str, phenonames: List[str], all_phenonames: List[str]) -> str:
+
+        pheno_hash = hashlib.sha256()
+        pheno_hash.update(json.dumps({'tool': tool,
+                                      'phenonames': phenonames,
+                                      'is_binary': self._is_binary,
+                                      'sex': self._sex,
+                                      'quantitative_covariates': sorted(self._quantitative_covariates),
+                                      'categorical_covariates': sorted(self._categorical_covariates),
+                                      'genetics': self._genetics_key}).encode())
+        with Path('SAMPLES_Include.txt').open('rb') as sample_file:
+            pheno_hash.update(sample_file.read())
+        self._hash_phenotypes(phenonames, all_phenonames, pheno_hash)
+
+        return f'null_model.{tool}.{pheno_hash.hexdigest()}'
+
+    def _restore_from_bundle(self, key: str, tool: str, phenonames: List[str], files: Dict[str, str]) -> bool:
+
+        if key in self._input_manifest:
+            for name, destination in files.items():
+                shutil.copyfile(self._input_bundle_dir / key / name, destination)
+            return True
+
+        # A bundle that has a model for this tool/phenotype, but not THIS model, was almost certainly made with
+        # different covariates / samples / genetic data. Refitting silently would hide that, so stop instead.
+        for bundled in self._input_manifest.values():
+            if bundled['tool'] == tool and bundled['phenonames'] == phenonames:
+                raise dxpy.AppError(f'The {tool} null model provided for {",".join(phenonames)} with --null_model '
+                                    f'was fit to different phenotypes, covariates, samples, or genetic data than '
+                                    f'this run. Remove --null_model to refit it.')
+        return False
+
+    # Restore the null model files named in 'files' (name in the store -> path in the working directory) if we have
+    # them, and otherwise run 'fit' to create them and save the result.
+    def load_or_fit(self, tool: str, phenonames: List[str], all_phenonames: List[str], files: Dict[str, str],
+                    fit: Callable[[], None]) -> None:
+
+        key = self.get_key(tool, phenonames, all_phenonames)
+        if self._restore_from_bundle(key, tool, phenonames, files):
+            print(f'Using provided {tool} null model for {",".join(phenonames)}')
+        elif self._cache is not None and self._cache.fetch(key, files):
+            print(f'Using cached {tool} null model for {",".join(phenonames)}')
+        else:
+            fit()
+            if self._cache is not None:
+                self._cache.store(key, files)
+
+        self._used_models[key] = {'tool': tool, 'phenonames': phenonames, 'files': files}
+
+    # Include a null model in the bundle written by write_bundle(). load_or_fit() does this itself; this is for null
+    # models restored some other way (e.g. from a checkpoint).
+    def mark_used(self, tool: str, phenonames: List[str], all_phenonames: List[str], files: Dict[str, str]) -> None:
+        self._used_models[self.get_key(tool, phenonames, all_phenonames)] = {'tool': tool, 'phenonames': phenonames,
+                                                                             'files': files}
+
+    # Write every null model used by this run to a single tarball that can be passed to --null_model. Returns None if
+    # no null models were used (e.g. for BOLT).
+    def write_bundle(self, output_prefix: str) -> Optional[str]:
+
+        if len(self._used_models) == 0:
+            return None
+
+        bundle_path = f'{output_prefix}.null_models.tar.gz'
+        manifest = {key: {'tool': model['tool'], 'phenonames': model['phenonames'], 'files': list(model['files'])}
+                    for key, model in self._used_models.items()}
+        Path(NULL_MODEL_MANIFEST).write_text(json.dumps(manifest, indent=2))
+        with tarfile.open(bundle_path, 'w:gz') as bundle:
+            bundle.add(NULL_MODEL_MANIFEST)
+            for key, model in self._used_models.items():
+                for name, path in model['files'].items():
+                    bundle.add(path, arcname=f'{key}/{name}')
+
+        return bundle_path
@@ -0,0 +1,94 @@
+import gzip
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+
+import pandas as pd
+
+# pyarrow's csv reader is multi-threaded and columnar, so use it when it is installed. pandas' C reader (restricted to
+# the columns we need) is the fallback.
+try:
+    from pyarrow import csv as pyarrow_csv
+    HAS_PYARROW = True
+except ImportError:
+    HAS_PYARROW = False
+
+
+# Known dtypes of raw tool output columns. Setting these stops the readers from having to infer types and keeps ID-like
+# columns as strings. Only columns that are always floating point are typed as numbers, so values are written back out
+# exactly as pandas would have inferred them.
+COLUMN_DTYPES = {'SNP': str, 'CHR': str, 'ID': str, 'CHROM': str, 'MarkerID': str, 'Region': str, 'Group': str,
+                 'TEST': str, 'ALLELE0': str, 'ALLELE1': str, 'Allele1': str, 'Allele2': str, 'EXTRA': str,
+                 'A1FREQ': 'float64', 'F_MISS': 'float64', 'BETA': 'float64', 'SE': 'float64',
+                 'P_BOLT_LMM_INF': 'float64', 'P_BOLT_LMM': 'float64', 'LOG10P': 'float64', 'CHISQ': 'float64'}
+
+PYARROW_DTYPES = {str: 'string', 'int64': 'int64', 'float64': 'float64'}
+
+
+def _open_text(path: Path):
+    return gzip.open(path, 'rt') if path.suffix == '.gz' else path.open('r')
+
+
+# Read the header of a delimited file, skipping (and counting) leading '#' comment lines such as REGENIE's ##MASKS
+def read_header(path: Union[str, Path], sep: str) -> Tuple[List[str], int]:
+
+    with _open_text(Path(path)) as table_file:
+        skip_rows = 0
+        for line in table_file:
+            if line.startswith('#'):
+                skip_rows += 1
+            else:
+                return line.rstrip('\n').split(sep), skip_rows
+    return [], skip_rows
+
+
+# Read a raw tool output table, loading only columns NOT in 'drop' and using explicit dtypes for the columns we know
+# about. The returned table is identical to reading the whole file with pandas and then dropping 'drop'.
+def read_table(path: Union[str, Path], sep: str, drop: Optional[List[str]] = None,
+               dtypes: Optional[Dict[str, Union[type, str]]] = None) -> pd.DataFrame:
+
+    path = Path(path)
+    header, skip_rows = read_header(path, sep)
+    drop = set() if drop is None else set(drop)
+    columns = [column for column in header if column not in drop]
+    column_dtypes = {column: dtype for column, dtype in {**COLUMN_DTYPES, **(dtypes or {})}.items()
+                     if column in columns}
+
+    if HAS_PYARROW:
+        table = pyarrow_csv.read_csv(path,
+                                     read_options=pyarrow_csv.ReadOptions(skip_rows=skip_rows, use_threads=True),
+                                     parse_options=pyarrow_csv.ParseOptions(delimiter=sep),
+                                     convert_options=pyarrow_csv.ConvertOptions(
+                                         include_columns=columns,
+                                         column_types={column: PYARROW_DTYPES[dtype]
+                                                       for column, dtype in column_dtypes.items()}))
+        return table.to_pandas()
+    else:
+        return pd.read_csv(path, sep=sep, skiprows=skip_rows, usecols=columns, dtype=column_dtypes,
+                           engine='c')[columns]
+
+
+# Read several tables at once. Both readers release the GIL while parsing, so threads give a real speed-up when there
+# are many per-mask / per-chromosome files. Tables are returned in the same order as 'paths'.
+def read_tables(paths: List[Union[str, Path]], sep: str, threads: int, drop: Optional[List[str]] = None,
+                dtypes: Optional[Dict[str, Union[type, str]]] = None) -> List[pd.DataFrame]:
+
+    with ThreadPoolExecutor(max_workers=max(1, threads)) as executor:
+        return list(executor.map(lambda path: read_table(path, sep, drop, dtypes), paths))
+
+
+# Read a BOLT stats file and split it into per-gene (IDs containing 'ENST') and per-marker (IDs containing ':') rows.
+# The SNP column is classified once and the marker table is only built if asked for.
+def read_bolt_stats(path: Union[str, Path], drop: Optional[List[str]] = None,
+                    split_markers: bool = True) -> Tuple[pd.DataFrame, Optional[pd.DataFrame]]:
+
+    bolt_table = read_table(path, '\t', drop)
+    is_gene = bolt_table['SNP'].str.contains('ENST', regex=False)
+    gene_table = bolt_table[is_gene].reset_index(drop=True)
+
+    marker_table = None
+    if split_markers:
+        not_gene = bolt_table[~is_gene]
+        marker_table = not_gene[not_gene['SNP'].str.contains(':', regex=False)].reset_index(drop=True)
+
+    return gene_table, marker_table
@@ -0,0 +1,110 @@
+from pathlib import Path
+from typing import List, Optional, Set, Union
+
+import numpy as np
+import pandas as pd
+
+# Parquet outputs (--parquet_outputs) need pyarrow, which is otherwise optional
+try:
+    import pyarrow as pa
+    from pyarrow import compute as pc
+    from pyarrow import parquet as pq
+    HAS_PYARROW = True
+except ImportError:
+    HAS_PYARROW = False
+
+# Columns with few distinct values, stored dictionary-encoded (as categoricals) rather than as one string per row
+CATEGORICAL_COLUMNS = ['ENST', 'MASK', 'MAF', 'chrom', 'CHROM']
+
+
+# Numeric columns that can be stored as float32 without losing anything:
+#
+# 1. Integer-valued columns (e.g. counts, or positions) only if every value is exactly representable – float32 rounds
+#    integers above 2^24
+# 2. Other columns only if float32 gives back every value exactly as it was written, i.e. float32's shortest decimal
+#    form of each value parses back to the same float64. Statistics read back from tool output are written with at
+#    most ~7 significant digits and pass; values computed here to full float64 precision (or out of float32's range,
+#    e.g. p-values below ~1e-45) do not, and stay float64.
+def get_float32_columns(table: pd.DataFrame) -> Set[str]:
+
+    float32_columns = set()
+    for column in table.select_dtypes(include='number').columns:
+        values = table[column].to_numpy(dtype=np.float64)
+        with np.errstate(over='ignore', invalid='ignore'):
+            as_float32 = values.astype(np.float32)
+        finite = values[np.isfinite(values)]
+        if np.array_equal(finite, np.round(finite)):
+            round_trip = as_float32.astype(np.float64)
+        else:
+            round_trip = as_float32.astype(str).astype(np.float64)
+        if np.array_equal(round_trip, values, equal_nan=True):
+            float32_columns.add(column)
+    return float32_columns
+
+
+# Writes a result table as Parquet, alongside the tabix-indexed TSV, for analyses that load results from many runs:
+#
+# 1. Each chromosome gets its own row group, so readers filtering on chromosome only read the groups they need
+# 2. ENST / MASK / MAF / chromosome columns are dictionary-encoded
+# 3. Floating point columns that do not need float64 are float32 (see get_float32_columns())
+# 4. Every column has min / max statistics, so filters on p-values (e.g. p < 1e-6) can skip whole row groups
+#
+# Tables can be written in pieces (e.g. one chromosome at a time), so long as every piece has the same columns and
+# dtypes. 'float32_columns' should then cover every piece (or else it is taken from the first).
+class ParquetTableWriter:
+
+    def __init__(self, path: Union[str, Path], chromosome_column: str, float32_columns: Optional[Set[str]] = None):
+
+        self._path = Path(path)
+        self._chromosome_column = chromosome_column
+        self._float32_columns = float32_columns
+        self._writer: Optional['pq.ParquetWriter'] = None
+
+    def _to_arrow(self, table: pd.DataFrame) -> 'pa.Table':
+
+        table = table.copy(deep=False)
+        for column in table.columns:
+            if table[column].dtype == object:
+                table[column] = table[column].astype('string')
+            elif column in self._float32_columns and table[column].dtype == np.float64:
+                table[column] = table[column].astype(np.float32)
+
+        arrow_table = pa.Table.from_pandas(table, preserve_index=False)
+        for column in CATEGORICAL_COLUMNS:
+            if column in arrow_table.column_names:
+                column_index = arrow_table.column_names.index(column)
+                arrow_table = arrow_table.set_column(column_index, column,
+                                                     pc.dictionary_encode(arrow_table.column(column_index)))
+        return arrow_table
+
+    # Rows of a table that are on the same chromosome (the table is expected to be sorted by chromosome)
+    def _get_chromosome_runs(self, table: pd.DataFrame) -> List[slice]:
+
+        chromosomes = table[self._chromosome_column].astype(str).to_numpy()
+        boundaries = [0] + list(np.flatnonzero(chromosomes[1:] != chromosomes[:-1]) + 1) + [len(table)]
+        return [slice(start, end) for start, end in zip(boundaries[:-1], boundaries[1:]) if end > start]
+
+    def write(self, table: pd.DataFrame) -> None:
+
+        if self._float32_columns is None:
+            self._float32_columns = get_float32_columns(table)
+        arrow_table = self._to_arrow(table)
+        if self._writer is None:
+            self._writer = pq.ParquetWriter(self._path, arrow_table.schema, compression='zstd',
+                                            write_statistics=True)
+        else:
+            arrow_table = arrow_table.cast(self._writer.schema)
+
+        for chromosome_run in self._get_chromosome_runs(table):
+            row_count = chromosome_run.stop - chromosome_run.start
+            self._writer.write_table(arrow_table.slice(chromosome_run.start, row_count), row_group_size=row_count)
+
+    def close(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+
+    def __enter__(self) -> 'ParquetTableWriter':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
@@ -0,0 +1,327 @@
+import cProfile
+import io
+import json
+import pstats
+import resource
+import threading
+import time
+from contextlib import contextmanager
+from functools import partial, wraps
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+from general_utilities import association_resources
+from general_utilities.thread_utility import thread_utility
+
+# Instance-wide CPU / memory / disk use is sampled this often (in seconds) for the timeline
+SAMPLE_SECONDS = 5
+
+# Spans shorter than this (e.g. single-gene GLM jobs) are only counted in the per-stage summary, not listed
+# individually, so that the profile stays a manageable size
+MIN_LISTED_SPAN_SECONDS = 0.05
+
+# How much of each command line to keep
+COMMAND_CHARS = 500
+
+# Spans that never overlap one another (the run as a whole, and each stage of it). Only these record process-wide
+# counters – CPU time of child processes and bytes read / written by this process – as concurrent tasks, jobs and
+# commands share the same counters, so that a difference over one of their spans also includes all the others.
+PROCESS_WIDE_CATEGORIES = ('tool', 'stage')
+PROCESS_WIDE_FIELDS = ['process_child_cpu', 'process_bytes_read', 'process_bytes_written']
+
+
+def _read_process_io() -> Dict[str, int]:
+    try:
+        with open('/proc/self/io', 'r') as io_file:
+            fields = dict(line.split(':') for line in io_file)
+        return {'read': int(fields['rchar']), 'write': int(fields['wchar'])}
+    except (OSError, KeyError, ValueError):
+        return {'read': 0, 'write': 0}
+
+
+# Everything we measure at the start and end of a span. CPU time is split into the current thread's own CPU time and
+# that of child processes, which only includes children that have exited (i.e. finished commands) and not processes
+# run inside docker containers – the instance-wide samples cover those.
+def _snapshot() -> dict:
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    process_io = _read_process_io()
+    return {'time': time.perf_counter(),
+            'thread_cpu': time.thread_time(),
+            'child_cpu': children.ru_utime + children.ru_stime,
+            'read': process_io['read'],
+            'write': process_io['write']}
+
+
+# A name for a function run as a job, for the profile
+def _callable_name(function: Callable) -> str:
+    if isinstance(function, partial):
+        return _callable_name(function.func)
+    return getattr(function, '__qualname__', repr(function))
+
+
+# Records where a run spends its time: ingestion and each stage of the ToolRunner, every task / job run on a thread,
+# and every external command run through run_cmd(). For each we record wall time, CPU time of the calling thread, and
+# for tasks and jobs the time spent queued waiting for a free thread. The run and its stages also record CPU time of
+# child processes and bytes read and written by this process (see PROCESS_WIDE_CATEGORIES). Nothing is measured per
+# command: most run in docker containers, outside this process's accounting. Instance-wide CPU, memory and disk use
+# are sampled in the background instead, which covers work done inside containers.
+#
+# write() saves this as '<output_prefix>.profile.json' (the raw spans, samples, and a per-stage summary) and as
+# '<output_prefix>.trace.json', a Chrome trace that can be opened in chrome://tracing or https://ui.perfetto.dev. When
+# Python profiling is on, the Python side is also run under cProfile and written to
+# '<output_prefix>.python_profile.txt'.
+#
+# Use the PROFILER instance below; run_cmd() and ThreadUtility from this module are drop-in replacements for those in
+# general_utilities that record to it.
+class Profiler:
+
+    def __init__(self):
+
+        self._origin = time.perf_counter()
+        self._origin_epoch = time.time()
+        self._lock = threading.Lock()
+        self._spans: List[dict] = []
+        self._summary: Dict[tuple, dict] = {}
+        self._samples: List[dict] = []
+        self._thread_ids: Dict[int, str] = {}
+
+        self._sampler: Optional[threading.Thread] = None
+        self._stop_sampling = threading.Event()
+
+        self._python_profiles: Optional[List[cProfile.Profile]] = None
+
+    # Start background sampling, and Python profiling if requested
+    def start(self, profile_python: bool = False) -> None:
+
+        if self._sampler is None and Path('/proc/stat').exists():
+            self._sampler = threading.Thread(target=self._sample_instance, daemon=True)
+            self._sampler.start()
+
+        if profile_python and self._python_profiles is None:
+            self._python_profiles = []
+            self._enable_python_profile()
+
+    # Profile the current thread, if Python profiling is on. Returns None if it is not, or if another profile is
+    # already running – from Python 3.12 one profile sees every thread, so only the first can be enabled.
+    def _enable_python_profile(self) -> Optional[cProfile.Profile]:
+
+        if self._python_profiles is None:
+            return None
+        python_profile = cProfile.Profile()
+        try:
+            python_profile.enable()
+        except ValueError:
+            return None
+        with self._lock:
+            self._python_profiles.append(python_profile)
+        return python_profile
+
+    @staticmethod
+    def _read_cpu_ticks() -> List[int]:
+        with open('/proc/stat', 'r') as stat_file:
+            return [int(ticks) for ticks in stat_file.readline().split()[1:]]
+
+    @staticmethod
+    def _read_memory_used() -> int:
+        memory = {}
+        with open('/proc/meminfo', 'r') as meminfo_file:
+            for line in meminfo_file:
+                name, value = line.split(':')
+                memory[name] = int(value.split()[0]) * 1024
+        return memory['MemTotal'] - memory.get('MemAvailable', memory['MemFree'])
+
+    # Sectors read / written by whole disks (not partitions, which would double count)
+    @staticmethod
+    def _read_disk_bytes() -> Dict[str, int]:
+        disk_bytes = {'read': 0, 'write': 0}
+        with open('/proc/diskstats', 'r') as diskstats_file:
+            for line in diskstats_file:
+                fields = line.split()
+                if Path(f'/sys/block/{fields[2]}').exists():
+                    disk_bytes['read'] += int(fields[5]) * 512
+                    disk_bytes['write'] += int(fields[9]) * 512
+        return disk_bytes
+
+    def _sample_instance(self) -> None:
+
+        try:
+            last_ticks = self._read_cpu_ticks()
+            last_disk = self._read_disk_bytes()
+            while not self._stop_sampling.wait(SAMPLE_SECONDS):
+                ticks = self._read_cpu_ticks()
+                disk = self._read_disk_bytes()
+                total = sum(ticks) - sum(last_ticks)
+                # idle + iowait are the 4th and 5th fields
+                idle = (ticks[3] + ticks[4]) - (last_ticks[3] + last_ticks[4])
+                sample = {'time': round(time.perf_counter() - self._origin, 3),
+                          'cpu_percent': round(100 * (total - idle) / total, 1) if total > 0 else 0,
+                          'memory_used': self._read_memory_used(),
+                          'disk_read_per_second': (disk['read'] - last_disk['read']) // SAMPLE_SECONDS,
+                          'disk_write_per_second': (disk['write'] - last_disk['write']) // SAMPLE_SECONDS}
+                with self._lock:
+                    self._samples.append(sample)
+                last_ticks = ticks
+                last_disk = disk
+        except (OSError, ValueError, IndexError, KeyError) as sample_error:
+            print(f'Stopped sampling instance resource use: {sample_error}')
+
+    # Start / end a span that does not fit in a single block of code (see span())
+    def begin(self, name: str, category: str, **details) -> dict:
+        return {'name': name, 'category': category, 'start': _snapshot(), 'details': details}
+
+    def end(self, open_span: dict) -> None:
+        self._record(open_span['name'], open_span['category'], open_span['start'], _snapshot(), None,
+                     open_span['details'])
+
+    # Time a block of code. 'category' groups spans in the summary (e.g. 'stage', 'task', 'job', 'command'). 'queued_at'
+    # is when a task / job was ready to run, if it had to wait for a thread. Any other keyword arguments are saved with
+    # the span.
+    @contextmanager
+    def span(self, name: str, category: str, queued_at: Optional[float] = None, **details):
+
+        start = _snapshot()
+        try:
+            yield
+        finally:
+            end = _snapshot()
+            self._record(name, category, start, end, queued_at, details)
+
+    def _record(self, name: str, category: str, start: dict, end: dict, queued_at: Optional[float],
+                details: dict) -> None:
+
+        thread = threading.current_thread()
+        span = {'name': name,
+                'category': category,
+                'thread': thread.name,
+                'start': round(start['time'] - self._origin, 6),
+                'wall': round(end['time'] - start['time'], 6),
+                'queue_wait': round(start['time'] - queued_at, 6) if queued_at is not None else 0,
+                'thread_cpu': round(end['thread_cpu'] - start['thread_cpu'], 6)}
+        if category in PROCESS_WIDE_CATEGORIES:
+            span.update({'process_child_cpu': round(end['child_cpu'] - start['child_cpu'], 6),
+                         'process_bytes_read': end['read'] - start['read'],
+                         'process_bytes_written': end['write'] - start['write']})
+        if len(details) > 0:
+            span['details'] = details
+
+        with self._lock:
+            if thread.ident not in self._thread_ids:
+                self._thread_ids[thread.ident] = thread.name
+            span['thread_id'] = list(self._thread_ids).index(thread.ident)
+
+            summed_fields = ['wall', 'queue_wait', 'thread_cpu']
+            if category in PROCESS_WIDE_CATEGORIES:
+                summed_fields += PROCESS_WIDE_FIELDS
+            summary = self._summary.setdefault((category, name), dict({'category': category, 'name': name, 'count': 0},
+                                                                      **{field: 0 for field in summed_fields}))
+            summary['count'] += 1
+            for field in summed_fields:
+                summary[field] += span[field]
+
+            if span['wall'] >= MIN_LISTED_SPAN_SECONDS or category in ('stage', 'tool'):
+                self._spans.append(span)
+
+    # Wrap a function that will be run on another thread so that it is timed (including how long it waited to be
+    # started since 'queued_at', by default now) and, if Python profiling is on, profiled.
+    def wrap(self, function: Callable, category: str, name: Optional[str] = None, queued_at: Optional[float] = None,
+             **details) -> Callable:
+
+        span_name = _callable_name(function) if name is None else name
+        queued_at = time.perf_counter() if queued_at is None else queued_at
+
+        @wraps(function)
+        def profiled_function(*args, **kwargs):
+            python_profile = self._enable_python_profile()
+            try:
+                with self.span(span_name, category, queued_at=queued_at, **details):
+                    return function(*args, **kwargs)
+            finally:
+                if python_profile is not None:
+                    python_profile.disable()
+
+        return profiled_function
+
+    def _chrome_trace(self, spans: List[dict], samples: List[dict]) -> dict:
+
+        events = [{'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': thread_id, 'args': {'name': thread_name}}
+                  for thread_id, thread_name in enumerate(self._thread_ids.values())]
+        for span in spans:
+            events.append({'name': span['name'], 'cat': span['category'], 'ph': 'X', 'pid': 1,
+                           'tid': span['thread_id'], 'ts': int(span['start'] * 1e6), 'dur': int(span['wall'] * 1e6),
+                           'args': {field: value for field, value in span.items()
+                                    if field not in ('name', 'category', 'thread', 'thread_id', 'start', 'wall')}})
+        for sample in samples:
+            timestamp = int(sample['time'] * 1e6)
+            events.append({'name': 'CPU %', 'ph': 'C', 'pid': 1, 'ts': timestamp,
+                           'args': {'cpu': sample['cpu_percent']}})
+            events.append({'name': 'Memory used (GB)', 'ph': 'C', 'pid': 1, 'ts': timestamp,
+                           'args': {'memory': round(sample['memory_used'] / 1024 ** 3, 2)}})
+            events.append({'name': 'Disk (MB/s)', 'ph': 'C', 'pid': 1, 'ts': timestamp,
+                           'args': {'read': round(sample['disk_read_per_second'] / 1024 ** 2, 1),
+                                    'write': round(sample['disk_write_per_second'] / 1024 ** 2, 1)}})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    # Stop profiling and write the profile, trace and (if on) Python profile. Returns the files written.
+    def write(self, output_prefix: str) -> List[str]:
+
+        self._stop_sampling.set()
+        if self._sampler is not None:
+            self._sampler.join()
+
+        with self._lock:
+            spans = sorted(self._spans, key=lambda listed_span: listed_span['start'])
+            summary = sorted(self._summary.values(), key=lambda stage_summary: -stage_summary['wall'])
+            samples = list(self._samples)
+
+        profile_path = f'{output_prefix}.profile.json'
+        with open(profile_path, 'w') as profile_file:
+            # ru_maxrss of children is the largest RSS of any single (finished) child over the whole run – for docker
+            # commands, that of the docker client rather than the container – so it is only reported once, here
+            children = resource.getrusage(resource.RUSAGE_CHILDREN)
+            json.dump({'start_time': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self._origin_epoch)),
+                       'wall': round(time.perf_counter() - self._origin, 3),
+                       'process_lifetime_child_max_rss': children.ru_maxrss * 1024,
+                       'summary': summary,
+                       'spans': spans,
+                       'samples': samples}, profile_file, indent=1)
+
+        trace_path = f'{output_prefix}.trace.json'
+        with open(trace_path, 'w') as trace_file:
+            json.dump(self._chrome_trace(spans, samples), trace_file)
+
+        written = [profile_path, trace_path]
+        if self._python_profiles is not None:
+            for python_profile in self._python_profiles:
+                python_profile.disable()
+            profiles = [python_profile for python_profile in self._python_profiles
+                        if python_profile.getstats()]
+            if len(profiles) > 0:
+                stats_text = io.StringIO()
+                stats = pstats.Stats(profiles[0], stream=stats_text)
+                for python_profile in profiles[1:]:
+                    stats.add(python_profile)
+                stats.sort_stats('cumulative').print_stats(100)
+                python_profile_path = f'{output_prefix}.python_profile.txt'
+                Path(python_profile_path).write_text(stats_text.getvalue())
+                written.append(python_profile_path)
+
+        return written
+
+
+PROFILER = Profiler()
+
+
+# run_cmd from general_utilities, recorded in the profile. Takes the same arguments.
+def run_cmd(cmd: str, *args, **kwargs):
+
+    command_words = cmd.split()
+    command_name = command_words[0].split('/')[-1] if len(command_words) > 0 else 'command'
+    with PROFILER.span(command_name, 'command', command=cmd[:COMMAND_CHARS]):
+        return association_resources.run_cmd(cmd, *args, **kwargs)
+
+
+# ThreadUtility from general_utilities that records each job (and how long it waited for a thread) in the profile
+class ThreadUtility(thread_utility.ThreadUtility):
+
+    def launch_job(self, class_type: Callable, **kwargs) -> None:
+        super().launch_job(class_type=PROFILER.wrap(class_type, 'job'), **kwargs)
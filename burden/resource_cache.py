@@ -0,0 +1,174 @@
+import fcntl
+import os
+import shutil
+import socket
+import stat
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Optional, Union, List
+
+
+# A persistent, size-capped cache of files that lives outside the job's working directory (e.g. on a volume shared by
+# successive jobs on the same worker). Each entry is a directory named by a string key containing one or more named
+# files. Entries are only ever created by renaming a fully-written staging directory into place, so a reader can never
+# see a partial entry. Concurrent access across threads and processes is serialised with flock() on a lock file –
+# shared for reads, exclusive for writes and eviction.
+#
+# A cache hit is satisfied by hardlinking the cached file to the requested destination, or copying it if the destination
+# is on a different filesystem, so eviction can never leave a job with a dangling link. Cached files are made read-only,
+# so that a tool writing to a hardlinked input in place fails rather than corrupting the cache entry. Eviction also
+# skips entries used in the last 'min_age' seconds, which the running job is likely to need again.
+#
+# Staging directories are named '<host>.<pid>.<random>'. Those left behind by a process that died mid-fetch are
+# removed when a cache is opened.
+class ResourceCache:
+
+    def __init__(self, cache_dir: Union[str, Path], max_bytes: int, min_age: float = 3600):
+
+        self._cache_dir = Path(cache_dir)
+        self._entries_dir = self._cache_dir / 'entries'
+        self._staging_dir = self._cache_dir / 'staging'
+        self._lock_file = self._cache_dir / '.lock'
+        self._max_bytes = max_bytes
+        self._min_age = min_age
+
+        self._entries_dir.mkdir(parents=True, exist_ok=True)
+        self._staging_dir.mkdir(parents=True, exist_ok=True)
+        self._lock_file.touch(exist_ok=True)
+        self._remove_stale_staging()
+
+    @contextmanager
+    def _locked(self, exclusive: bool):
+        with self._lock_file.open('r') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _entry(self, key: str) -> Path:
+        return self._entries_dir / key
+
+    # Link every file named in 'destinations' out of the cache entry for 'key'. Returns False on a cache miss.
+    def fetch(self, key: str, destinations: Dict[str, Union[str, Path]]) -> bool:
+
+        entry = self._entry(key)
+        with self._locked(exclusive=False):
+            if not entry.exists() or not all((entry / name).exists() for name in destinations):
+                return False
+            for name, destination in destinations.items():
+                self._link(entry / name, Path(destination))
+            # Entry mtime is our LRU clock
+            os.utime(entry)
+        return True
+
+    # Return the path of a single cached file (e.g. for streaming from it) or None on a miss
+    def get_path(self, key: str, name: str) -> Optional[Path]:
+        entry = self._entry(key)
+        with self._locked(exclusive=False):
+            if not (entry / name).exists():
+                return None
+            os.utime(entry)
+        return entry / name
+
+    # Create an empty staging directory that the caller can write files into before calling commit()
+    def stage(self) -> Path:
+        staging = self._staging_dir / f'{socket.gethostname()}.{os.getpid()}.{uuid.uuid4().hex}'
+        staging.mkdir()
+        return staging
+
+    @staticmethod
+    def _is_running(pid: int) -> bool:
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    # Remove staging directories left by processes on this host that are no longer running (e.g. a job that was killed
+    # mid-download). Directories from other hosts sharing the cache are left alone.
+    def _remove_stale_staging(self) -> None:
+
+        with self._locked(exclusive=True):
+            for staging in self._staging_dir.iterdir():
+                name_parts = staging.name.rsplit('.', 2)
+                if len(name_parts) == 3 and name_parts[0] != socket.gethostname():
+                    continue
+                if len(name_parts) != 3 or not name_parts[1].isdigit() or not self._is_running(int(name_parts[1])):
+                    shutil.rmtree(staging, ignore_errors=True)
+
+    # Make every file of a staged entry read-only (which also applies to any hardlinks to it)
+    @staticmethod
+    def _make_read_only(staging: Path) -> None:
+        for file in staging.rglob('*'):
+            if file.is_file():
+                file.chmod(stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+
+    def commit(self, key: str, staging: Path) -> None:
+
+        entry = self._entry(key)
+        self._make_read_only(staging)
+        with self._locked(exclusive=True):
+            if entry.exists():
+                # Someone else got there first – the content is identical by construction, so just drop ours
+                shutil.rmtree(staging, ignore_errors=True)
+            else:
+                staging.rename(entry)
+            self._evict(protect=key)
+
+    def discard(self, staging: Path) -> None:
+        shutil.rmtree(staging, ignore_errors=True)
+
+    # Add existing files (keyed by name) to the cache. Files are hardlinked in where possible, so this is cheap.
+    def store(self, key: str, sources: Dict[str, Union[str, Path]]) -> None:
+
+        if self._entry(key).exists():
+            return
+        staging = self.stage()
+        try:
+            for name, source in sources.items():
+                target = staging / name
+                target.parent.mkdir(parents=True, exist_ok=True)
+                try:
+                    os.link(source, target)
+                except OSError:
+                    shutil.copyfile(source, target)
+        except Exception:
+            self.discard(staging)
+            raise
+        self.commit(key, staging)
+
+    @staticmethod
+    def _link(source: Path, destination: Path) -> None:
+        destination.parent.mkdir(parents=True, exist_ok=True)
+        if destination.exists() or destination.is_symlink():
+            destination.unlink()
+        try:
+            os.link(source, destination)
+        except OSError:
+            shutil.copyfile(source, destination)
+
+    @staticmethod
+    def _entry_size(entry: Path) -> int:
+        return sum(file.stat().st_size for file in entry.rglob('*') if file.is_file())
+
+    # Must be called while holding the exclusive lock. Removes least-recently-used entries until we are under
+    # max_bytes.
+    def _evict(self, protect: str) -> None:
+
+        entries: List[Path] = sorted(self._entries_dir.iterdir(), key=lambda entry: entry.stat().st_mtime)
+        sizes = {entry: self._entry_size(entry) for entry in entries}
+        total_size = sum(sizes.values())
+        now = time.time()
+
+        for entry in entries:
+            if total_size <= self._max_bytes:
+                break
+            if entry.name == protect or now - entry.stat().st_mtime < self._min_age:
+                continue
+            shutil.rmtree(entry, ignore_errors=True)
+            total_size -= sizes[entry]
@@ -0,0 +1,185 @@
+import queue
+import select
+import shutil
+import subprocess
+from pathlib import Path
+from typing import List, Optional
+
+import dxpy
+
+# The worker script, shipped as package data (see setup.py). It is copied to the working directory, which docker mounts
+# as /test/.
+STAAR_WORKER_SCRIPT = Path(__file__).parent / 'resources' / 'staar_worker.R'
+# Workers run in the same image, with the same mounts, as run_cmd(..., is_docker=True)
+STAAR_DOCKER_COMMAND = ['docker', 'run', '-i', '--rm', '-v', '/home/dnanexus:/test', '-v', '/usr/bin/:/prog',
+                        'egardner413/mrcepid-burdentesting']
+# Seconds a worker has to answer a health check (PING) before it is restarted
+STAAR_HEALTH_TIMEOUT = 60
+# Times a job is tried when the worker running it crashes, or hangs (runs past --staar_job_timeout_hours). Errors
+# raised by STAAR itself are not retried.
+STAAR_JOB_ATTEMPTS = 2
+
+
+class STAARWorkerCrashed(Exception):
+    pass
+
+
+# One long-lived Rscript running staar_worker.R in its own container, started on first use. Jobs that take longer than
+# 'job_timeout' seconds are treated as hung; jobs are never timed out if it is None.
+class STAARWorker:
+
+    def __init__(self, worker_number: int, job_timeout: Optional[float] = None):
+
+        self._worker_number = worker_number
+        self._job_timeout = job_timeout
+        self._starts = 0
+        self._name: Optional[str] = None
+        self._process: Optional[subprocess.Popen] = None
+        self._log_path = Path(f'staar_worker.{worker_number}.log')
+
+    def _start(self) -> None:
+
+        self._starts += 1
+        self._name = f'staar_worker_{self._worker_number}_{self._starts}'
+        with self._log_path.open('a') as stderr_log:
+            self._process = subprocess.Popen(STAAR_DOCKER_COMMAND[:3] + ['--name', self._name] +
+                                             STAAR_DOCKER_COMMAND[3:] +
+                                             ['Rscript', f'/test/{STAAR_WORKER_SCRIPT.name}',
+                                              f'/test/{self._log_path.name}'],
+                                             stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=stderr_log,
+                                             text=True, bufsize=1)
+
+    # Send one command and wait up to 'timeout' seconds (or indefinitely if None) for its reply. A worker that does not
+    # answer in time is killed.
+    def _send(self, line: str, timeout: Optional[float]) -> str:
+
+        try:
+            self._process.stdin.write(line + '\n')
+            self._process.stdin.flush()
+        except (BrokenPipeError, OSError) as pipe_error:
+            raise STAARWorkerCrashed(f'{self._name} exited') from pipe_error
+
+        answered, _, _ = select.select([self._process.stdout], [], [], timeout)
+        if len(answered) == 0:
+            name = self._name
+            self._kill()
+            raise STAARWorkerCrashed(f'{name} did not finish within {timeout}s and was killed')
+        response = self._process.stdout.readline()
+        if response == '':
+            raise STAARWorkerCrashed(f'{self._name} exited with code {self._process.wait()}')
+        return response.rstrip('\n')
+
+    # Whether the worker is running and answers a PING within STAAR_HEALTH_TIMEOUT
+    def _is_healthy(self) -> bool:
+
+        if self._process is None or self._process.poll() is not None:
+            return False
+        try:
+            self._process.stdin.write('PING\n')
+            self._process.stdin.flush()
+        except (BrokenPipeError, OSError):
+            return False
+        answered, _, _ = select.select([self._process.stdout], [], [], STAAR_HEALTH_TIMEOUT)
+        return len(answered) > 0 and self._process.stdout.readline().rstrip('\n') == 'PONG'
+
+    # Make sure the worker is healthy, restarting it if not. Workers are checked before every job, as the previous job
+    # may have left R out of memory or hung.
+    def ensure_running(self) -> None:
+
+        if self._is_healthy():
+            return
+        if self._process is not None:
+            print(f'STAAR worker {self._name} is not responding, restarting it')
+            self.stop()
+        self._start()
+
+    # Run runSTAAR_Genes.R with 'args'. Raises STAARWorkerCrashed if the worker died or hung, or dxpy.AppError if the
+    # script itself failed.
+    def run_job(self, args: List[str]) -> None:
+
+        response = self._send('\t'.join(['JOB'] + args), self._job_timeout)
+        if response.startswith('ERROR'):
+            raise dxpy.AppError(f'runSTAAR_Genes.R failed ({" ".join(args)}): {response[len("ERROR"):].strip()}. '
+                                f'See {self._log_path}')
+        elif response != 'DONE':
+            raise STAARWorkerCrashed(f'{self._name} sent an unexpected response: {response}')
+
+    def stop(self) -> None:
+
+        if self._process is None:
+            return
+        if self._process.poll() is None:
+            try:
+                self._process.stdin.write('QUIT\n')
+                self._process.stdin.close()
+                self._process.wait(timeout=STAAR_HEALTH_TIMEOUT)
+            except (BrokenPipeError, OSError, subprocess.TimeoutExpired):
+                pass
+        self._kill()
+
+    def _kill(self) -> None:
+
+        if self._process.poll() is None:
+            self._process.kill()
+            self._process.wait()
+        # Killing the docker client does not stop the container, so make sure it is gone
+        subprocess.run(['docker', 'rm', '-f', self._name], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self._process = None
+
+
+# A fixed pool of long-lived R workers for STAAR gene tests (--staar_worker_pool). Running staar_genes() starts a new
+# Rscript for each tarball x chromosome, which reloads the STAAR library and the null model before testing anything –
+# for short chromosomes, longer than the tests themselves. Workers instead load both once and then take one job at a
+# time from run_genes(), which the TaskGraph calls from its threads in place of staar_genes().
+#
+# Each worker is health-checked before every job and restarted if it has died or hung. A job whose worker crashes
+# while running it, or does not finish within 'job_timeout' seconds (if set), is retried on the restarted worker, up
+# to STAAR_JOB_ATTEMPTS times.
+class STAARWorkerPool:
+
+    def __init__(self, workers: int, job_timeout: Optional[float] = None):
+
+        shutil.copy(STAAR_WORKER_SCRIPT, STAAR_WORKER_SCRIPT.name)
+        self._workers = [STAARWorker(worker_number, job_timeout) for worker_number in range(max(1, workers))]
+        self._idle: queue.Queue = queue.Queue()
+        for worker in self._workers:
+            self._idle.put(worker)
+
+    # Run runSTAAR_Genes.R for one tarball x chromosome on the next free worker. Takes the same inputs, and returns the
+    # same result, as staar_genes(..., has_gene_info=False). The arguments are those documented for runSTAAR_Genes.R.
+    def run_genes(self, tarball_prefix: str, chromosome: str, phenoname: str) -> tuple:
+
+        args = [f'/test/{tarball_prefix}.{chromosome}.STAAR.matrix.rds',
+                f'/test/{tarball_prefix}.{chromosome}.variants_table.STAAR.tsv',
+                f'/test/{phenoname}.STAAR_null.rds',
+                phenoname,
+                tarball_prefix,
+                chromosome]
+
+        worker = self._idle.get()
+        try:
+            for attempt in range(1, STAAR_JOB_ATTEMPTS + 1):
+                worker.ensure_running()
+                try:
+                    worker.run_job(args)
+                    break
+                except STAARWorkerCrashed as crash:
+                    if attempt == STAAR_JOB_ATTEMPTS:
+                        raise dxpy.AppError(f'STAAR worker crashed running {tarball_prefix} chr{chromosome} for '
+                                            f'{phenoname}: {crash}') from crash
+                    print(f'{crash}, retrying {tarball_prefix} chr{chromosome} for {phenoname}')
+        finally:
+            self._idle.put(worker)
+
+        return tarball_prefix, chromosome, phenoname
+
+    def close(self) -> None:
+        for worker in self._workers:
+            worker.stop()
+        Path(STAAR_WORKER_SCRIPT.name).unlink(missing_ok=True)
+
+    def __enter__(self) -> 'STAARWorkerPool':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
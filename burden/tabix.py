@@ -0,0 +1,373 @@
+import re
+import struct
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import dxpy
+
+# These mirror htslib's hts.c / tbx.c for the .tbi format (min_shift 14, 5 levels) so that an index built here is the
+# same as one written by 'tabix' for the same BGZF file.
+TBI_MIN_SHIFT = 14
+TBI_N_LEVELS = 5
+TBI_N_BINS = ((1 << (3 * TBI_N_LEVELS + 3)) - 1) // 7
+TBI_META_BIN = TBI_N_BINS + 1
+HTS_MIN_MARKER_DIST = 0x10000
+UNSET_OFFSET = 0xffffffffffffffff
+
+_LEADING_INTEGER = re.compile(r'\s*([+-]?\d+)')
+
+
+def _reg2bin(beg: int, end: int) -> int:
+    end -= 1
+    shift = TBI_MIN_SHIFT
+    first = ((1 << (3 * TBI_N_LEVELS + 3)) - 1) // 7
+    for level in range(TBI_N_LEVELS, 0, -1):
+        first -= 1 << (3 * level)
+        if beg >> shift == end >> shift:
+            return first + (beg >> shift)
+        shift += 3
+    return 0
+
+
+def _bin_first(level: int) -> int:
+    return ((1 << (3 * level)) - 1) // 7
+
+
+def _bin_parent(bin_number: int) -> int:
+    return (bin_number - 1) >> 3
+
+
+def _bin_bot(bin_number: int) -> int:
+    level = 0
+    current = bin_number
+    while current:
+        level += 1
+        current = _bin_parent(current)
+    return (bin_number - _bin_first(level)) << (TBI_N_LEVELS - level) * 3
+
+
+# htslib stores bins in a klib khash (int32 keys, identity hash, quadratic probing) and writes them out in hash-bucket
+# order. The .tbi is only byte-identical if we iterate bins in the same order, so this reproduces khash's insertion,
+# deletion and resizing behaviour exactly.
+class _KHashInt:
+
+    _EMPTY = 2
+    _DELETED = 1
+    _USED = 0
+    _HASH_UPPER = 0.77
+
+    def __init__(self):
+        self.n_buckets = 0
+        self.size = 0
+        self.n_occupied = 0
+        self.upper_bound = 0
+        self.keys: List[int] = []
+        self.values: List[Optional[list]] = []
+        self.flags: List[int] = []
+
+    def _resize(self, new_n_buckets: int) -> None:
+
+        new_n_buckets = 1 << (new_n_buckets - 1).bit_length() if new_n_buckets > 1 else new_n_buckets
+        new_n_buckets = max(new_n_buckets, 4)
+        if self.size >= int(new_n_buckets * self._HASH_UPPER + 0.5):
+            return
+
+        new_flags = [self._EMPTY] * new_n_buckets
+        if self.n_buckets < new_n_buckets:
+            self.keys.extend([0] * (new_n_buckets - self.n_buckets))
+            self.values.extend([None] * (new_n_buckets - self.n_buckets))
+        new_mask = new_n_buckets - 1
+
+        for j in range(self.n_buckets):
+            if self.flags[j] != self._USED:
+                continue
+            key = self.keys[j]
+            value = self.values[j]
+            self.flags[j] = self._DELETED
+            while True:
+                step = 0
+                i = key & new_mask
+                while new_flags[i] != self._EMPTY:
+                    step += 1
+                    i = (i + step) & new_mask
+                new_flags[i] = self._USED
+                if i < self.n_buckets and self.flags[i] == self._USED:
+                    # Kick out the existing element and carry on re-inserting it
+                    key, self.keys[i] = self.keys[i], key
+                    value, self.values[i] = self.values[i], value
+                    self.flags[i] = self._DELETED
+                else:
+                    self.keys[i] = key
+                    self.values[i] = value
+                    break
+
+        if self.n_buckets > new_n_buckets:
+            del self.keys[new_n_buckets:]
+            del self.values[new_n_buckets:]
+        self.flags = new_flags
+        self.n_buckets = new_n_buckets
+        self.n_occupied = self.size
+        self.upper_bound = int(self.n_buckets * self._HASH_UPPER + 0.5)
+
+    # Returns the bucket holding 'key', adding it (with an empty list as its value) if absent
+    def put(self, key: int) -> int:
+
+        if self.n_occupied >= self.upper_bound:
+            if self.n_buckets > (self.size << 1):
+                self._resize(self.n_buckets - 1)
+            else:
+                self._resize(self.n_buckets + 1)
+
+        mask = self.n_buckets - 1
+        x = site = self.n_buckets
+        i = key & mask
+        if self.flags[i] == self._EMPTY:
+            x = i
+        else:
+            last = i
+            step = 0
+            while self.flags[i] != self._EMPTY and (self.flags[i] == self._DELETED or self.keys[i] != key):
+                if self.flags[i] == self._DELETED:
+                    site = i
+                step += 1
+                i = (i + step) & mask
+                if i == last:
+                    x = site
+                    break
+            if x == self.n_buckets:
+                x = site if self.flags[i] == self._EMPTY and site != self.n_buckets else i
+
+        if self.flags[x] == self._EMPTY:
+            self.keys[x] = key
+            self.values[x] = []
+            self.flags[x] = self._USED
+            self.size += 1
+            self.n_occupied += 1
+        elif self.flags[x] == self._DELETED:
+            self.keys[x] = key
+            self.values[x] = []
+            self.flags[x] = self._USED
+            self.size += 1
+        return x
+
+    def get(self, key: int) -> Optional[int]:
+
+        if self.n_buckets == 0:
+            return None
+        mask = self.n_buckets - 1
+        i = key & mask
+        last = i
+        step = 0
+        while self.flags[i] != self._EMPTY and (self.flags[i] == self._DELETED or self.keys[i] != key):
+            step += 1
+            i = (i + step) & mask
+            if i == last:
+                return None
+        return None if self.flags[i] != self._USED else i
+
+    def delete(self, bucket: int) -> None:
+        if self.flags[bucket] == self._USED:
+            self.flags[bucket] = self._DELETED
+            self.values[bucket] = None
+            self.size -= 1
+
+    def buckets(self) -> List[int]:
+        return [bucket for bucket in range(self.n_buckets) if self.flags[bucket] == self._USED]
+
+
+# Builds a tabix (.tbi) index line by line, the same way 'tabix -s <seq> -b <begin> -e <end> -S <skip>' does
+# for a generic, 1-based, tab-delimited file. Lines must be passed in file order with the BGZF virtual offset of the
+# END of each line (see BGZFWriter).
+class TabixIndex:
+
+    def __init__(self, seq_col: int, begin_col: int, end_col: int, skip_lines: int = 0, meta_char: str = '#'):
+
+        self._seq_col = seq_col
+        self._begin_col = begin_col
+        self._end_col = end_col
+        self._skip_lines = skip_lines
+        self._meta_char = meta_char
+
+        self._names: Dict[str, int] = {}
+        self._bins: List[Optional[_KHashInt]] = []
+        self._linear: List[List[int]] = []
+
+        self._line_number = 0
+        self._started = False
+        self._last_off = 0
+        self._n_no_coor = 0
+        self._finished = False
+
+        # htslib's 'z' state for hts_idx_push()
+        self._save_bin = self._save_tid = self._last_tid = self._last_bin = 0xffffffff
+        self._save_off = self._off_beg = self._off_end = 0
+        self._last_coor = 0xffffffff
+        self._n_mapped = self._n_unmapped = 0
+
+    # tbx.c get_intv(): columns are 1-based; begin is converted to 0-based. If begin and end are the same column a
+    # record covers a single base.
+    def _parse_line(self, line: str) -> Tuple[int, int, int]:
+
+        fields = line.split('\t')
+        try:
+            name = fields[self._seq_col - 1]
+            begin = int(_LEADING_INTEGER.match(fields[self._begin_col - 1]).group(1))
+            end = begin
+            if self._end_col != self._begin_col:
+                end = int(_LEADING_INTEGER.match(fields[self._end_col - 1]).group(1))
+        except (IndexError, AttributeError):
+            raise dxpy.AppError(f'Could not parse tabix interval from line {self._line_number}: {line[:100]}')
+        begin = max(begin - 1, 0)
+        end = max(end, begin + 1)
+
+        if name not in self._names:
+            self._names[name] = len(self._names)
+            self._bins.append(None)
+            self._linear.append([])
+        return self._names[name], begin, end
+
+    def add_line(self, line: str, end_offset: int) -> None:
+
+        self._line_number += 1
+        if self._line_number <= self._skip_lines or line.startswith(self._meta_char):
+            self._last_off = end_offset
+            return
+        if not self._started:
+            self._save_off = self._off_beg = self._off_end = self._last_off
+            self._started = True
+
+        tid, begin, end = self._parse_line(line)
+        self._push(tid, begin, end, end_offset)
+
+    @staticmethod
+    def _insert_to_b(bins: _KHashInt, bin_number: int, beg: int, end: int) -> None:
+        bins.values[bins.put(bin_number)].append((beg, end))
+
+    def _insert_to_l(self, tid: int, beg: int, end: int, offset: int) -> None:
+        linear = self._linear[tid]
+        beg >>= TBI_MIN_SHIFT
+        end = (end - 1) >> TBI_MIN_SHIFT
+        if len(linear) < end + 1:
+            linear.extend([UNSET_OFFSET] * (end + 1 - len(linear)))
+        for i in range(beg, end + 1):
+            if linear[i] == UNSET_OFFSET:
+                linear[i] = offset
+
+    # hts.c hts_idx_push()
+    def _push(self, tid: int, beg: int, end: int, offset: int) -> None:
+
+        if self._last_tid != tid:
+            if self._bins[tid] is not None:
+                raise dxpy.AppError(f'Cannot build tabix index: chromosome blocks are not contiguous at line '
+                                    f'{self._line_number}')
+            self._last_tid = tid
+            self._last_bin = 0xffffffff
+        elif self._last_coor > beg:
+            raise dxpy.AppError(f'Cannot build tabix index: unsorted positions at line {self._line_number}')
+
+        if self._bins[tid] is None:
+            self._bins[tid] = _KHashInt()
+        self._insert_to_l(tid, beg, end, self._last_off)
+
+        bin_number = _reg2bin(beg, end)
+        if self._last_bin != bin_number:
+            if self._save_bin != 0xffffffff:
+                self._insert_to_b(self._bins[self._save_tid], self._save_bin, self._save_off, self._last_off)
+            if self._last_bin == 0xffffffff and self._save_bin != 0xffffffff:
+                # Change of chromosome – keep meta information
+                self._off_end = self._last_off
+                self._insert_to_b(self._bins[self._save_tid], TBI_META_BIN, self._off_beg, self._off_end)
+                self._insert_to_b(self._bins[self._save_tid], TBI_META_BIN, self._n_mapped, self._n_unmapped)
+                self._n_mapped = self._n_unmapped = 0
+                self._off_beg = self._off_end
+            self._save_off = self._last_off
+            self._save_bin = self._last_bin = bin_number
+            self._save_tid = tid
+
+        self._n_mapped += 1
+        self._last_off = offset
+        self._last_coor = beg
+
+    # hts.c hts_idx_finish(), update_loff() and compress_binning()
+    def finish(self, final_offset: int) -> None:
+
+        if self._finished:
+            return
+        if self._started and self._save_tid != 0xffffffff:
+            self._insert_to_b(self._bins[self._save_tid], self._save_bin, self._save_off, final_offset)
+            self._insert_to_b(self._bins[self._save_tid], TBI_META_BIN, self._off_beg, final_offset)
+            self._insert_to_b(self._bins[self._save_tid], TBI_META_BIN, self._n_mapped, self._n_unmapped)
+
+        for tid in range(len(self._bins)):
+            self._update_loff(tid)
+            self._compress_binning(tid)
+        self._finished = True
+
+    # Windows no record starts in take the offset of the next window that has one (the last window always does), as
+    # htslib has done since 1.10 – earlier versions filled them forwards, from the previous window
+    def _update_loff(self, tid: int) -> None:
+
+        linear = self._linear[tid]
+        for position in range(len(linear) - 2, -1, -1):
+            if linear[position] == UNSET_OFFSET:
+                linear[position] = linear[position + 1]
+
+    def _compress_binning(self, tid: int) -> None:
+
+        bins = self._bins[tid]
+        # Merge a bin into its parent if the bin is too small
+        for level in range(TBI_N_LEVELS, 0, -1):
+            start = _bin_first(level)
+            for bucket in range(bins.n_buckets):
+                if bins.flags[bucket] != _KHashInt._USED or bins.keys[bucket] >= TBI_N_BINS or \
+                        bins.keys[bucket] < start:
+                    continue
+                chunks = bins.values[bucket]
+                if level < TBI_N_LEVELS and len(chunks) > 1:
+                    chunks.sort(key=lambda chunk: chunk[0])
+                if (chunks[-1][1] >> 16) - (chunks[0][0] >> 16) < HTS_MIN_MARKER_DIST:
+                    parent_bucket = bins.get(_bin_parent(bins.keys[bucket]))
+                    if parent_bucket is None:
+                        continue
+                    bins.values[parent_bucket].extend(chunks)
+                    bins.delete(bucket)
+
+        root_bucket = bins.get(0)
+        if root_bucket is not None:
+            bins.values[root_bucket].sort(key=lambda chunk: chunk[0])
+
+        # Merge adjacent chunks that start from the same BGZF block
+        for bucket in bins.buckets():
+            if bins.keys[bucket] >= TBI_N_BINS:
+                continue
+            chunks = bins.values[bucket]
+            merged = [list(chunks[0])]
+            for chunk_beg, chunk_end in chunks[1:]:
+                if merged[-1][1] >> 16 >= chunk_beg >> 16:
+                    merged[-1][1] = max(merged[-1][1], chunk_end)
+                else:
+                    merged.append([chunk_beg, chunk_end])
+            bins.values[bucket] = [tuple(chunk) for chunk in merged]
+
+    # hts.c hts_idx_save_as() for HTS_FMT_TBI, including tbx.c's meta block of column settings and sequence names
+    def save(self, path: Path) -> None:
+
+        from burden.bgzf import BGZFWriter
+
+        names = b''.join(name.encode() + b'\x00' for name in self._names)
+        meta = struct.pack('<7i', 0, self._seq_col, self._begin_col, self._end_col, ord(self._meta_char),
+                           self._skip_lines, len(names)) + names
+
+        with BGZFWriter(path) as index_file:
+            index_file.write(b'TBI\x01' + struct.pack('<i', len(self._bins)) + meta)
+            for tid in range(len(self._bins)):
+                bins = self._bins[tid]
+                index_file.write(struct.pack('<i', bins.size))
+                for bucket in bins.buckets():
+                    chunks = bins.values[bucket]
+                    index_file.write(struct.pack('<Ii', bins.keys[bucket], len(chunks)) +
+                                     b''.join(struct.pack('<QQ', chunk_beg, chunk_end)
+                                              for chunk_beg, chunk_end in chunks))
+                linear = self._linear[tid]
+                index_file.write(struct.pack('<i', len(linear)) + struct.pack(f'<{len(linear)}Q', *linear))
+            index_file.write(struct.pack('<Q', self._n_no_coor))
@@ -0,0 +1,161 @@
+import shutil
+import subprocess
+import tarfile
+import threading
+from pathlib import Path
+from typing import BinaryIO, List, Optional, Tuple
+
+import dxpy
+
+
+# Members of a collapsevariants tarball that each tool actually reads. Everything else in the tarball is skipped
+# without ever being written to disk when extracting in streaming mode.
+TOOL_MEMBER_SUFFIXES = {'bolt': ('.BOLT.bgen', '.BOLT.sample'),
+                        'saige': ('.SAIGE.bcf', '.SAIGE.bcf.csi', '.SAIGE.groupFile.txt'),
+                        'staar': ('.STAAR.matrix.rds', '.variants_table.STAAR.tsv'),
+                        'regenie': ('.variants_table.STAAR.tsv',),
+                        'glm': ('.STAAR.matrix.rds', '.variants_table.STAAR.tsv')}
+
+# Tarballs can be gzip (the collapsevariants default), zstd, or uncompressed
+TARBALL_SUFFIXES = ('.tar.gz', '.tar.zst', '.tar')
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+
+# A file-like object that puts back the bytes we read to sniff the compression type. The download stream cannot seek,
+# so this is the only way to 'peek' at it.
+class _PrefixedStream:
+
+    def __init__(self, prefix: bytes, stream: BinaryIO):
+        self._prefix = prefix
+        self._stream = stream
+
+    def read(self, size: int = -1) -> bytes:
+        if len(self._prefix) == 0:
+            return self._stream.read(size)
+        if size < 0:
+            data = self._prefix + self._stream.read()
+            self._prefix = b''
+            return data
+        data = self._prefix[:size]
+        self._prefix = self._prefix[size:]
+        if len(data) < size:
+            data += self._stream.read(size - len(data))
+        return data
+
+
+# Copies the download stream into an external decompressor on a separate thread so that downloading, decompressing,
+# and tar extraction all happen concurrently. An error reading the download (e.g. a checksum mismatch) is kept in
+# 'error' for the extracting thread to raise once the feeder has been joined. The decompressor exiting early just stops
+# the copy – its exit status says why.
+class _ProcessFeeder:
+
+    def __init__(self, stream: BinaryIO, process: subprocess.Popen):
+
+        self.process = process
+        self.error: Optional[Exception] = None
+        self._stream = stream
+        self._thread = threading.Thread(target=self._feed, daemon=True)
+        self._thread.start()
+
+    def _feed(self) -> None:
+        try:
+            while True:
+                chunk = self._stream.read(1024 * 1024)
+                if len(chunk) == 0:
+                    break
+                try:
+                    self.process.stdin.write(chunk)
+                except (BrokenPipeError, OSError):
+                    break
+        except Exception as read_error:
+            self.error = read_error
+        finally:
+            try:
+                self.process.stdin.close()
+            except (BrokenPipeError, OSError):
+                pass
+
+    # Wait for the copy to finish and the decompressor to exit. Returns the decompressor's exit status.
+    def join(self) -> int:
+        self._thread.join()
+        return self.process.wait()
+
+
+def _open_decompressed(stream: BinaryIO, threads: int) -> Tuple[BinaryIO, Optional[_ProcessFeeder]]:
+
+    magic = stream.read(4)
+    stream = _PrefixedStream(magic, stream)
+
+    if magic.startswith(GZIP_MAGIC):
+        # pigz decompresses on its own threads (reading, writing and check calculation), otherwise fall back to
+        # tarfile's built-in gzip handling
+        decompress_cmd = ['pigz', '-dc', '-p', f'{threads}'] if shutil.which('pigz') else None
+    elif magic.startswith(ZSTD_MAGIC):
+        if shutil.which('zstd'):
+            decompress_cmd = ['zstd', '-dcq', f'-T{threads}']
+        else:
+            try:
+                import zstandard
+            except ImportError:
+                raise dxpy.AppError('Tarball is zstd compressed but neither the zstd binary or python zstandard '
+                                    'module are available!')
+            return zstandard.ZstdDecompressor().stream_reader(stream), None
+    else:
+        # Assume an uncompressed tar – tarfile will complain if it isn't
+        return stream, None
+
+    if decompress_cmd is None:
+        return stream, None
+
+    process = subprocess.Popen(decompress_cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    return process.stdout, _ProcessFeeder(stream, process)
+
+
+def _extract_members(decompressed: BinaryIO, wanted_suffixes: Optional[Tuple[str, ...]],
+                     output_dir: Path) -> List[str]:
+
+    # 'r|*' lets tarfile handle gzip itself when we couldn't find pigz; otherwise the stream is already plain tar
+    member_names = []
+    with tarfile.open(fileobj=decompressed, mode='r|*') as tar:
+        for member in tar:
+            member_names.append(member.name)
+            if wanted_suffixes is None or (member.isfile() and member.name.endswith(wanted_suffixes)):
+                tar.extract(member, path=output_dir)
+    return member_names
+
+
+# Extract a (possibly compressed) tar straight from 'stream' without writing the archive to disk. Only members ending
+# in one of the suffixes required by 'tool' are written (or everything if tool is None). Returns the names of ALL
+# members in the archive so callers can still check for things like SNP / GENE tarballs.
+#
+# A tarball that is not a (compressed) tar raises tarfile.ReadError, whether tarfile or the external decompressor found
+# the problem. An error reading 'stream' itself is raised as is, ahead of any error it caused further down.
+def stream_extract_tarball(stream: BinaryIO, tool: Optional[str], threads: int = 1,
+                           output_dir: Path = Path('.')) -> List[str]:
+
+    wanted_suffixes = None if tool is None else TOOL_MEMBER_SUFFIXES[tool]
+    decompressed, feeder = _open_decompressed(stream, threads)
+    if feeder is None:
+        return _extract_members(decompressed, wanted_suffixes, output_dir)
+
+    try:
+        member_names = _extract_members(decompressed, wanted_suffixes, output_dir)
+        # tarfile stops reading at the end-of-archive marker, so drain anything left before waiting on the process
+        decompressed.read()
+    except Exception as extract_error:
+        feeder.process.kill()
+        feeder.join()
+        if feeder.error is not None:
+            raise feeder.error from extract_error
+        raise
+    finally:
+        decompressed.close()
+
+    return_code = feeder.join()
+    if feeder.error is not None:
+        raise feeder.error
+    if return_code != 0:
+        raise tarfile.ReadError(f'Decompression of tarball stream failed with exit code {return_code}')
+    return member_names
@@ -0,0 +1,286 @@
+import heapq
+import os
+import time
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Hashable, Iterable, List, Optional, Set, Tuple
+
+import dxpy
+
+from burden.checkpoint import Checkpoint, CheckpointStore
+from burden.job_history import JobHistory
+from burden.profiler import PROFILER
+
+
+@dataclass
+class Task:
+    name: Hashable
+    function: Callable
+    kwargs: Dict[str, Any]
+    dependencies: Set[Hashable]
+    threads: int
+    memory: int
+    order: int
+    job: Optional[dict] = None
+    cost: float = 0
+    rank: float = 0
+    ready_at: float = 0
+    checkpoint: Optional[Checkpoint] = None
+    checkpoint_key: Optional[str] = None
+    dependents: List[Hashable] = field(default_factory=list)
+
+
+# Total physical memory of this instance in bytes, used as the default memory budget
+def get_total_memory() -> int:
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+# Runs a set of tasks with dependencies between them. Unlike a series of ThreadUtility stages separated by
+# collect_futures() barriers, a task starts as soon as everything it depends on has finished – e.g. step 2 for
+# chromosome 1 can run while chromosome 22's bgen is still downloading.
+#
+# Each task declares how many threads and how much memory (in bytes) it needs. Ready tasks are started whenever enough
+# of both is free; a ready task that does not fit is skipped for now, so smaller tasks behind it can use the spare
+# capacity. Requests larger than the whole budget are capped to it, so every task can eventually run.
+#
+# Tasks can also describe the job they do (see JobHistory). Their run time is then estimated from previous runs, and
+# ready tasks are started longest-path-first: by the estimated time from the start of the task to the end of the
+# longest chain of tasks that depend on it, so large chromosomes are started early rather than becoming stragglers.
+# Tasks with equal estimates (e.g. when nothing is known) start in the order they were added. Actual run times are
+# recorded back to the history, and the expected and actual makespan of the graph reported.
+#
+# With a CheckpointStore, tasks given a Checkpoint are saved as they finish and restored (rather than run) if they were
+# finished by an earlier run with the same inputs. Tasks without a Checkpoint (e.g. input preparation) are skipped when
+# every task that depends on them was restored, so a task must depend on every task whose files it reads.
+class TaskGraph:
+
+    def __init__(self, threads: int, memory: Optional[int] = None, error_message: str = 'A task failed',
+                 history: Optional[JobHistory] = None, checkpoints: Optional[CheckpointStore] = None):
+
+        self._threads = max(1, threads)
+        self._memory = get_total_memory() if memory is None else memory
+        self._error_message = error_message
+        self._history = history
+        self._checkpoints = checkpoints if checkpoints is not None and checkpoints.enabled else None
+        self._tasks: Dict[Hashable, Task] = {}
+
+    # Add a task that runs function(**kwargs) once every task in 'dependencies' has finished. 'job' optionally
+    # describes the task for the JobHistory cost model, and 'checkpoint' the files and inputs needed to checkpoint it.
+    # Returns 'name' so it can be used directly as a dependency of later tasks.
+    def add_task(self, name: Hashable, function: Callable, dependencies: Iterable[Hashable] = (), threads: int = 1,
+                 memory: int = 0, job: Optional[dict] = None, checkpoint: Optional[Checkpoint] = None,
+                 **kwargs) -> Hashable:
+
+        if name in self._tasks:
+            raise dxpy.AppError(f'Task {name} was added to the task graph twice')
+        self._tasks[name] = Task(name=name, function=function, kwargs=kwargs, dependencies=set(dependencies),
+                                 threads=min(max(1, threads), self._threads), memory=min(memory, self._memory),
+                                 order=len(self._tasks), job=job, checkpoint=checkpoint)
+        return name
+
+    def __contains__(self, name: Hashable) -> bool:
+        return name in self._tasks
+
+    def _check_dependencies(self) -> None:
+        for task in self._tasks.values():
+            for dependency in task.dependencies:
+                if dependency not in self._tasks:
+                    raise dxpy.AppError(f'Task {task.name} depends on unknown task {dependency}')
+                self._tasks[dependency].dependents.append(task.name)
+
+    # Tasks in dependency order (every task after the tasks it depends on)
+    def _order_tasks(self) -> List[Task]:
+
+        waiting_on = {name: len(task.dependencies) for name, task in self._tasks.items()}
+        ordered = [task for task in self._tasks.values() if len(task.dependencies) == 0]
+        for task in ordered:
+            for dependent in task.dependents:
+                waiting_on[dependent] -= 1
+                if waiting_on[dependent] == 0:
+                    ordered.append(self._tasks[dependent])
+        if len(ordered) != len(self._tasks):
+            unfinished = [name for name, waiting in waiting_on.items() if waiting > 0]
+            raise dxpy.AppError(f'Task graph has a dependency cycle involving: {unfinished[:5]}')
+        return ordered
+
+    # Restore every checkpointed task finished by an earlier run, and then skip tasks that only fed restored tasks.
+    # Returns a result for every task that does not need to run: the saved result if restored, or None if skipped.
+    def _restore_checkpoints(self, ordered: List[Task]) -> Dict[Hashable, Any]:
+
+        results = {}
+        if self._checkpoints is None:
+            return results
+
+        for task in ordered:
+            task.checkpoint_key = self._checkpoints.get_key(
+                task.name,
+                task.checkpoint.inputs if task.checkpoint is not None else [],
+                [self._tasks[dependency].checkpoint_key for dependency in task.dependencies])
+            if task.checkpoint is not None:
+                restored, result = self._checkpoints.restore(task.checkpoint_key, task.checkpoint)
+                if restored:
+                    results[task.name] = result
+        restored_count = len(results)
+
+        for task in reversed(ordered):
+            if task.checkpoint is None and len(task.dependents) > 0 and \
+                    all(dependent in results for dependent in task.dependents):
+                results[task.name] = None
+
+        if len(results) > 0:
+            print(f'Restored {restored_count} tasks from checkpoints, skipping {len(results) - restored_count} more')
+        return results
+
+    # Run a task's function and save it as a checkpoint (on the same thread, as hashing large outputs takes a while)
+    def _run_and_checkpoint(self, task: Task, **kwargs) -> Any:
+
+        result = task.function(**kwargs)
+        self._checkpoints.save(task.checkpoint_key, task.name, task.checkpoint, result)
+        return result
+
+    # Estimate every task's run time and rank it by the estimated length of the longest chain it starts. Tasks that do
+    # not need to run ('done') cost nothing.
+    def _rank_tasks(self, ordered: List[Task], done: Set[Hashable]) -> None:
+
+        for task in reversed(ordered):
+            if task.name in done:
+                task.cost = 0
+            elif task.job is not None and self._history is not None:
+                estimate = self._history.estimate(task.job)
+                task.cost = 0 if estimate is None else estimate
+            task.rank = task.cost + max((self._tasks[dependent].rank for dependent in task.dependents), default=0)
+
+    # Start every ready task that fits in the free threads / memory, highest rank first. Returns the tasks started and
+    # those still waiting.
+    @staticmethod
+    def _start_ready(ready: List[Task], free_threads: int, free_memory: int) -> Tuple[List[Task], List[Task]]:
+
+        started = []
+        not_started = []
+        for task in sorted(ready, key=lambda ready_task: (-ready_task.rank, ready_task.order)):
+            if task.threads <= free_threads and task.memory <= free_memory:
+                free_threads -= task.threads
+                free_memory -= task.memory
+                started.append(task)
+            else:
+                not_started.append(task)
+        return started, not_started
+
+    # Tasks that need to run and have nothing left to wait for, given the tasks that are 'done'
+    def _get_ready(self, done: Set[Hashable]) -> Tuple[Dict[Hashable, Set[Hashable]], List[Task]]:
+
+        waiting_on = {name: task.dependencies - done for name, task in self._tasks.items() if name not in done}
+        ready = [self._tasks[name] for name, waiting in waiting_on.items() if len(waiting) == 0]
+        return waiting_on, ready
+
+    # Play the schedule through using estimated run times to get the expected makespan
+    def _expected_makespan(self, done: Set[Hashable]) -> float:
+
+        waiting_on, ready = self._get_ready(done)
+        running: List[Tuple[float, int, Task]] = []
+        free_threads = self._threads
+        free_memory = self._memory
+        now = 0.0
+        while len(ready) > 0 or len(running) > 0:
+            started, ready = self._start_ready(ready, free_threads, free_memory)
+            for task in started:
+                free_threads -= task.threads
+                free_memory -= task.memory
+                heapq.heappush(running, (now + task.cost, task.order, task))
+            if len(running) == 0:
+                break
+            now, _, task = heapq.heappop(running)
+            free_threads += task.threads
+            free_memory += task.memory
+            for dependent in task.dependents:
+                if dependent not in waiting_on:
+                    continue
+                waiting_on[dependent].discard(task.name)
+                if len(waiting_on[dependent]) == 0:
+                    ready.append(self._tasks[dependent])
+        return now
+
+    # Tasks are grouped in the profile by their step, or otherwise the first part of their name
+    @staticmethod
+    def _get_profile_name(task: Task) -> str:
+        if task.job is not None:
+            return task.job['step']
+        elif isinstance(task.name, tuple):
+            return str(task.name[0])
+        else:
+            return str(task.name)
+
+    # Run every task and return their results keyed by task name. The first task to fail stops the graph: nothing new
+    # is started, queued work is cancelled, and the error is raised.
+    #
+    # 'on_finish(name, result)' is called on this thread for every task as soon as it finishes (restored and skipped
+    # tasks first), so results can be written out while other tasks are still running rather than all at the end. It is
+    # only called once the tasks that became ready have been started, so the workers are never kept waiting on it.
+    def run(self, on_finish: Optional[Callable[[Hashable, Any], None]] = None) -> Dict[Hashable, Any]:
+
+        self._check_dependencies()
+        ordered = self._order_tasks()
+        results = self._restore_checkpoints(ordered)
+        done = set(results)
+        self._rank_tasks(ordered, done)
+        expected_makespan = self._expected_makespan(done)
+
+        waiting_on, ready = self._get_ready(done)
+        running: Dict[Future, Tuple[Task, float]] = {}
+        free_threads = self._threads
+        free_memory = self._memory
+        graph_start = time.perf_counter()
+        for task in ready:
+            task.ready_at = graph_start
+
+        finished_names = list(results)
+        with ThreadPoolExecutor(max_workers=self._threads) as executor:
+            while True:
+
+                started, ready = self._start_ready(ready, free_threads, free_memory)
+                for task in started:
+                    free_threads -= task.threads
+                    free_memory -= task.memory
+                    task_function = partial(self._run_and_checkpoint, task) \
+                        if self._checkpoints is not None and task.checkpoint is not None else task.function
+                    task_function = PROFILER.wrap(task_function, 'task', name=self._get_profile_name(task),
+                                                  queued_at=task.ready_at, task=str(task.name), threads=task.threads)
+                    running[executor.submit(task_function, **task.kwargs)] = (task, time.perf_counter())
+
+                if on_finish is not None:
+                    for name in finished_names:
+                        on_finish(name, results[name])
+                finished_names = []
+
+                if len(running) == 0:
+                    break
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    task, task_start = running.pop(future)
+                    free_threads += task.threads
+                    free_memory += task.memory
+                    try:
+                        results[task.name] = future.result()
+                    except Exception as task_error:
+                        for pending in running:
+                            pending.cancel()
+                        raise dxpy.AppError(f'{self._error_message} (task {task.name}): {task_error}') from task_error
+                    finished_names.append(task.name)
+
+                    if task.job is not None and self._history is not None:
+                        self._history.record(task.job, time.perf_counter() - task_start)
+                    for dependent in task.dependents:
+                        if dependent not in waiting_on:
+                            continue
+                        waiting_on[dependent].discard(task.name)
+                        if len(waiting_on[dependent]) == 0:
+                            self._tasks[dependent].ready_at = time.perf_counter()
+                            ready.append(self._tasks[dependent])
+
+        print(f'{len(results)} tasks finished')
+        if self._history is not None:
+            self._history.save()
+            print(f'Makespan: expected {expected_makespan:.0f}s, actual {time.perf_counter() - graph_start:.0f}s')
+        return results
@@ -1,8 +1,23 @@
+from functools import partial
+from operator import itemgetter
 from pathlib import Path
+from typing import Set
 
+import numpy as np
+
+from burden.bgen import BGENWriter, rewrite_bgens, write_sample_file
+from burden.bgzf import BGZFWriter
+from burden.output_parser import read_bolt_stats
 from burden.tool_runners.tool_runner import ToolRunner
 from general_utilities.association_resources import *
 from general_utilities.thread_utility.thread_utility import *
+from burden.profiler import run_cmd
+
+# Dosage files are filtered this many bytes of lines at a time
+DOSAGE_CHUNK_BYTES = 16 * 1024 * 1024
+# Values pandas would have read as NA in the original dosage file, and what BOLT expects for a missing dosage instead
+DOSAGE_MISSING_VALUES = frozenset(['', 'NA', 'N/A', 'NaN', 'nan', '-nan', 'NULL', 'null', '#N/A', '<NA>'])
+BOLT_MISSING_DOSAGE = '-9'
 
 
 class BOLTRunner(ToolRunner):
@@ -14,10 +29,15 @@ class BOLTRunner(ToolRunner):
 
         # 1. First we need to download / prep the BGEN files we want to run through BOLT
         print("Processing BGEN files for BOLT run...")
-        thread_utility = ThreadUtility(self._association_pack.threads,
-                                       error_message='A BOLT thread failed',
-                                       incrementor=10,
-                                       thread_factor=4)
+        self._start_stage('bolt.prepare')
+        task_graph = self._new_task_graph('A BOLT task failed')
+
+        # Samples to keep when rewriting mask bgens (equivalent to plink's --keep-fam)
+        keep_samples = set()
+        if not self._association_pack.is_dosage:
+            with Path('SAMPLES_Include.txt').open('r') as include_file:
+                for line in include_file:
+                    keep_samples.add(line.rstrip())
 
         # The 'poss_chromosomes.txt' has a slightly different format depending on the data-type being used, but
         # generally has a format of <genetics file>\t<fam file>
@@ -25,43 +45,79 @@ class BOLTRunner(ToolRunner):
             for chromosome in get_chromosomes():
                 if self._association_pack.is_dosage:
                     if chromosome in self._association_pack.dosage_dict:
-                        thread_utility.launch_job(class_type=self._process_bolt_dosage_file,
-                                                  chromosome=chromosome)
-                        poss_chromosomes.write(f'/test/{chromosome}.INCLUDE.dosage '
-                                               f'/test/{chromosome}.INCLUDE.fam\n')
+                        task_graph.add_task(('dosage', chromosome),
+                                            self._process_bolt_dosage_file,
+                                            threads=4,
+                                            memory=self._estimate_memory('bolt.dosage'),
+                                            job=dict(self._describe_job('bolt.dosage', chromosome),
+                                                     input_bytes=self._association_pack.dosage_dict[chromosome][
+                                                         'dosage'].stat().st_size),
+                                            chromosome=chromosome)
+                        if self._association_pack.is_dosage_bgen:
+                            poss_chromosomes.write(f'/test/{chromosome}.INCLUDE.bgen '
+                                                   f'/test/{chromosome}.INCLUDE.sample\n')
+                        else:
+                            poss_chromosomes.write(f'/test/{chromosome}.INCLUDE.dosage.gz '
+                                                   f'/test/{chromosome}.INCLUDE.fam\n')
 
                 else:
-                    for tarball_prefix in self._association_pack.tarball_prefixes:
-                        if Path(f'{tarball_prefix}.{chromosome}.BOLT.bgen').exists():
-                            poss_chromosomes.write(f'/test/{tarball_prefix}.{chromosome}.bgen '
-                                                   f'/test/{tarball_prefix}.{chromosome}.sample\n')
-                            thread_utility.launch_job(class_type=self._process_bolt_bgen_file,
-                                                      tarball_prefix=tarball_prefix,
-                                                      chromosome=chromosome)
+                    # All masks for a chromosome are merged into one bgen so BOLT only has to read one file per
+                    # chromosome
+                    chromosome_prefixes = [tarball_prefix for tarball_prefix in self._association_pack.tarball_prefixes
+                                           if Path(f'{tarball_prefix}.{chromosome}.BOLT.bgen').exists()]
+                    if len(chromosome_prefixes) > 0:
+                        poss_chromosomes.write(f'/test/{chromosome}.masks.bgen '
+                                               f'/test/{chromosome}.masks.sample\n')
+                        task_graph.add_task(('masks', chromosome),
+                                            self._association_pack.derived_cache.load_or_build,
+                                            threads=4,
+                                            memory=self._estimate_memory('bolt.masks'),
+                                            job=self._describe_job('bolt.masks', chromosome, chromosome_prefixes),
+                                            artifact='bolt_masks',
+                                            tarball_prefixes=chromosome_prefixes,
+                                            chromosome=chromosome,
+                                            files={'masks.bgen': f'{chromosome}.masks.bgen',
+                                                   'masks.sample': f'{chromosome}.masks.sample'},
+                                            build=partial(self._process_bolt_bgen_file,
+                                                          tarball_prefixes=chromosome_prefixes,
+                                                          chromosome=chromosome,
+                                                          keep_samples=keep_samples))
 
                     if self._association_pack.run_marker_tests:
                         poss_chromosomes.write(f'/test/{chromosome}.markers.bgen '
                                                f'/test/{chromosome}.markers.bolt.sample\n')
                         # This makes use of a utility class from AssociationResources since bgen filtering/processing is
                         # IDENTICAL to that done for SAIGE. Do not want to duplicate code!
-                        thread_utility.launch_job(class_type=process_bgen_file,
-                                                  chrom_bgen_index=self._association_pack.bgen_dict[chromosome],
-                                                  chromosome=chromosome)
+                        task_graph.add_task(('bgen', chromosome),
+                                            process_bgen_file,
+                                            threads=4,
+                                            memory=self._estimate_memory('bolt.bgen'),
+                                            job=self._describe_job('bolt.bgen', chromosome),
+                                            chrom_bgen_index=self._association_pack.bgen_dict[chromosome],
+                                            chromosome=chromosome)
 
             poss_chromosomes.close()
-            thread_utility.collect_futures()
-
-        # 2. Actually run BOLT
-        print("Running BOLT...")
-        self._run_bolt()
-
-        # 3. Process the outputs
-        print("Processing BOLT outputs...")
-        if self._association_pack.is_dosage:
-            self._outputs.append(f'{self._output_prefix}.dosage.stats.gz')
-        else:
-            self._outputs.extend(self._process_bolt_outputs())
-
+            task_graph.run()
+
+        # 2. Actually run BOLT. BOLT can only take one phenotype at a time, so in batch mode we re-use the genetic data
+        # prepared above and run once per phenotype
+        for phenoname in self._association_pack.pheno_names:
+            print(f"Running BOLT for {phenoname}...")
+            self._start_stage('bolt.run')
+            self._run_bolt(phenoname)
+
+            # 3. Process the outputs
+            print(f"Processing BOLT outputs for {phenoname}...")
+            self._start_stage('bolt.process_outputs')
+            if self._association_pack.is_dosage:
+                self._outputs.append(f'{self._get_output_prefix(phenoname)}.dosage.stats.gz')
+            else:
+                self._outputs.extend(self._process_bolt_outputs(phenoname))
+
+    # Filter a chromosome's text dosage file down to the samples in SAMPLES_Include.txt. The file is streamed a chunk of
+    # lines at a time and the columns to keep are worked out once from the .sample file, so memory use does not depend
+    # on the size of the file. Dosage values are passed through as-is (missing values are written as BOLT's '-9') into
+    # a bgzip-compressed file, or converted to an 8-bit BGEN if requested.
     def _process_bolt_dosage_file(self, chromosome: str) -> None:
 
         current_file_pack = self._association_pack.dosage_dict[chromosome]
@@ -73,11 +129,6 @@ class BOLTRunner(ToolRunner):
                 sample = line.rstrip().split('\t')
                 dosage_sample_list.append(sample[1])
 
-        # Read genotypes as a pandas DF, so we can easily drop columns
-        current_genotypes = pd.read_csv(current_file_pack['dosage'], sep="\t",
-                                        names=['rsID', 'chrom', 'pos', 'REF', 'ALT'] + dosage_sample_list,
-                                        dtype={'chrom': str})
-
         # Then use the SAMPLES_Include.txt file to get the samples we want to keep:
         valid_sample_list = set()
         with Path('SAMPLES_Include.txt').open('r') as sample_file:
@@ -85,60 +136,69 @@ class BOLTRunner(ToolRunner):
                 sample = line.rstrip()
                 valid_sample_list.add(sample)
 
-        # ... and exclude all samples (drop_samples) that we DON'T find in the include file
-        drop_samples = []
-        for sample in dosage_sample_list:
-            if sample not in valid_sample_list:
-                drop_samples.append(sample)
-
-        # And finally write the new genotype and sample files:
-        with Path(f'{chromosome}.INCLUDE.dosage').open('w') as new_dosage,\
-                Path(f'{chromosome}.INCLUDE.fam').open('w') as new_fam:
-
-            current_genotypes = current_genotypes.drop(columns=drop_samples)
-            current_genotypes.to_csv(new_dosage, sep="\t", float_format='%0.4f', na_rep='-9', index=False, header=False)
-
-            sample_names = list(current_genotypes.columns)[5:]
-            for i in range(0, len(sample_names)):
-                new_fam.write(f'{sample_names[i]}\t{sample_names[i]}\n')
-
-            new_dosage.close()
-            new_fam.close()
-
-    # This handles processing of mask and whole-exome bgen files for input into BOLT
+        # ... and get the column positions of the samples we DO find in the include file (after the 5 variant columns)
+        keep_columns = [column for column, sample in enumerate(dosage_sample_list) if sample in valid_sample_list]
+        keep_samples = [dosage_sample_list[column] for column in keep_columns]
+        column_getter = itemgetter(*(list(range(5)) + [column + 5 for column in keep_columns]))
+
+        with current_file_pack['dosage'].open('r') as dosage_file:
+            if self._association_pack.is_dosage_bgen:
+                write_sample_file(f'{chromosome}.INCLUDE.sample', keep_samples)
+                with BGENWriter(f'{chromosome}.INCLUDE.bgen', keep_samples) as bgen_writer:
+                    for lines in iter(lambda: dosage_file.readlines(DOSAGE_CHUNK_BYTES), []):
+                        for line in lines:
+                            fields = column_getter(line.rstrip('\n').split('\t'))
+                            bgen_writer.write_variant(fields[0], fields[0], fields[1], int(fields[2]),
+                                                      fields[3], fields[4], self._parse_dosages(fields[5:]))
+            else:
+                with Path(f'{chromosome}.INCLUDE.fam').open('w') as new_fam:
+                    for sample in keep_samples:
+                        new_fam.write(f'{sample}\t{sample}\n')
+                with BGZFWriter(f'{chromosome}.INCLUDE.dosage.gz') as new_dosage:
+                    for lines in iter(lambda: dosage_file.readlines(DOSAGE_CHUNK_BYTES), []):
+                        filtered_lines = []
+                        for line in lines:
+                            fields = column_getter(line.rstrip('\n').split('\t'))
+                            if not DOSAGE_MISSING_VALUES.isdisjoint(fields[5:]):
+                                fields = [BOLT_MISSING_DOSAGE if value in DOSAGE_MISSING_VALUES else value
+                                          for value in fields]
+                            filtered_lines.append('\t'.join(fields))
+                        filtered_lines.append('')
+                        new_dosage.write('\n'.join(filtered_lines))
+
+    # Convert dosage strings to floats, with anything BOLT would treat as missing becoming NaN
+    @staticmethod
+    def _parse_dosages(values: Tuple[str, ...]) -> np.ndarray:
+        try:
+            dosages = np.array(values, dtype=np.float64)
+        except ValueError:
+            dosages = np.array(['nan' if value in DOSAGE_MISSING_VALUES else value for value in values],
+                               dtype=np.float64)
+        dosages[dosages == float(BOLT_MISSING_DOSAGE)] = np.nan
+        return dosages
+
+    # This handles processing of mask bgen files for input into BOLT. Each mask's variants are renamed to
+    # '<ID>-<tarball_prefix>' so masks can be told apart, restricted to the samples we are testing, and merged into a
+    # single 8-bit bgen for the chromosome. This is a single streaming pass over each mask bgen.
     @staticmethod
-    def _process_bolt_bgen_file(tarball_prefix: str, chromosome: str) -> None:
-
-        # Do the mask first...
-        # We need to modify the bgen file to have an alternate name for IDing masks
-        cmd = f'plink2 --threads 4 --bgen /test/{tarball_prefix}.{chromosome}.BOLT.bgen \'ref-last\' ' \
-                    f'--out /test/{tarball_prefix}.{chromosome} ' \
-                    f'--make-just-pvar'
-        run_cmd(cmd, True)
-
-        with open(f'{tarball_prefix}.{chromosome}.fixer', 'w') as fix_writer:
-            pvar_reader = csv.DictReader(open(f'{tarball_prefix}.{chromosome}.pvar', 'r'), delimiter='\t')
-            for variant_id in pvar_reader:
-                fix_writer.write(f'{variant_id["ID"]} {variant_id["ID"]}-{tarball_prefix}\n')
-            fix_writer.close()
-
-        cmd = f'plink2 --threads 4 --bgen /test/{tarball_prefix}.{chromosome}.BOLT.bgen \'ref-last\' ' \
-              f'--sample /test/{tarball_prefix}.{chromosome}.BOLT.sample ' \
-              f'--update-name /test/{tarball_prefix}.{chromosome}.fixer ' \
-              f'--export bgen-1.2 \'bits=\'8 ' \
-              f'--out /test/{tarball_prefix}.{chromosome} ' \
-              f'--keep-fam /test/SAMPLES_Include.txt'
-        run_cmd(cmd, True)
+    def _process_bolt_bgen_file(tarball_prefixes: List[str], chromosome: str, keep_samples: Set[str]) -> None:
+
+        inputs = [(Path(f'{tarball_prefix}.{chromosome}.BOLT.bgen'),
+                   Path(f'{tarball_prefix}.{chromosome}.BOLT.sample'),
+                   tarball_prefix) for tarball_prefix in tarball_prefixes]
+        rewrite_bgens(inputs, keep_samples, Path(f'{chromosome}.masks.bgen'), Path(f'{chromosome}.masks.sample'))
 
     # Run rare variant association testing using BOLT
-    def _run_bolt(self) -> None:
+    def _run_bolt(self, phenoname: str) -> None:
+
+        output_prefix = self._get_output_prefix(phenoname)
 
         # See the README.md for more information on these parameters
         cmd = f'bolt ' + \
                 f'--bfile=/test/genetics/UKBB_470K_Autosomes_QCd_WBA ' \
                 f'--exclude=/test/genetics/UKBB_470K_Autosomes_QCd.low_MAC.snplist ' \
                 f'--phenoFile=/test/phenotypes_covariates.formatted.txt ' \
-                f'--phenoCol={self._association_pack.pheno_names[0]} ' \
+                f'--phenoCol={phenoname} ' \
                 f'--covarFile=/test/phenotypes_covariates.formatted.txt ' \
                 f'--covarCol=sex ' \
                 f'--covarCol=wes_batch ' \
@@ -149,11 +209,11 @@ class BOLTRunner(ToolRunner):
                 f'--LDscoresFile=BOLT-LMM_v2.4/tables/LDSCORE.1000G_EUR.tab.gz ' \
                 f'--geneticMapFile=BOLT-LMM_v2.4/tables/genetic_map_hg19_withX.txt.gz ' \
                 f'--numThreads={self._association_pack.threads} ' \
-                f'--statsFile=/test/{self._output_prefix}.stats.gz ' \
+                f'--statsFile=/test/{output_prefix}.stats.gz ' \
                 f'--verboseStats '
 
         # I/O for 'imputed' data depends on input format (dosage/bgen), decide that here
-        if self._association_pack.is_dosage:
+        if self._association_pack.is_dosage and not self._association_pack.is_dosage_bgen:
             # Dosage format takes everything on the command-line, cannot supply a file-list like bgen, but can take
             # multiple files as multiple inputs of the same option (--dosageFile). Only needs one Fid/Iid File (so
             # capture the first one we see regardless of which chromosome)
@@ -169,11 +229,16 @@ class BOLTRunner(ToolRunner):
             dosage_files = [f'--dosageFile={file}' for file in dosage_files]
             cmd += f'{" ".join(dosage_files)} ' \
                    f'--dosageFidIidFile={fam_file} ' \
-                   f'--statsFileDosageSnps=/test/{self._output_prefix}.dosage.stats.gz'
+                   f'--statsFileDosageSnps=/test/{output_prefix}.dosage.stats.gz'
+
+        elif self._association_pack.is_dosage:
+            # Dosage converted to BGEN – same output name as a text dosage run
+            cmd += f'--bgenSampleFileList=/test/poss_chromosomes.txt ' \
+                   f'--statsFileBgenSnps=/test/{output_prefix}.dosage.stats.gz'
 
         else:
             cmd += f'--bgenSampleFileList=/test/poss_chromosomes.txt ' \
-                   f'--statsFileBgenSnps=/test/{self._output_prefix}.bgen.stats.gz'
+                   f'--statsFileBgenSnps=/test/{output_prefix}.bgen.stats.gz'
 
         if self._association_pack.is_bolt_non_infinite:
             cmd += ' --lmmForceNonInf'
@@ -186,31 +251,31 @@ class BOLTRunner(ToolRunner):
         if len(self._association_pack.found_categorical_covariates) > 0:
             for covar in self._association_pack.found_categorical_covariates:
                 cmd += f' --covarCol={covar} '
-        run_cmd(cmd, True, self._output_prefix + '.BOLT.log')
+        run_cmd(cmd, True, output_prefix + '.BOLT.log')
 
     # This parses the BOLT output file into a useable format for plotting/R
-    def _process_bolt_outputs(self) -> List[str]:
+    def _process_bolt_outputs(self, phenoname: str) -> List[str]:
 
-        # First read in the BOLT stats file:
-        bolt_table = pd.read_csv(f'{self._output_prefix}.bgen.stats.gz', sep="\t")
+        output_prefix = self._get_output_prefix(phenoname)
 
-        # Split the main table into marker and gene tables and remove the larger table
-        bolt_table_gene = bolt_table[bolt_table['SNP'].str.contains('ENST')]
-        bolt_table_marker = bolt_table[bolt_table['SNP'].str.contains(':')]
-        del bolt_table
+        # First read in the BOLT stats file (without the position columns we don't report) and split it into marker
+        # and gene tables:
+        bolt_table_gene, bolt_table_marker = read_bolt_stats(f'{output_prefix}.bgen.stats.gz',
+                                                             drop=['CHR', 'BP', 'ALLELE1', 'ALLELE0', 'GENPOS'],
+                                                             split_markers=self._association_pack.run_marker_tests)
 
         # Now process the gene table into a useable format:
         # First read in the transcripts file
-        transcripts_table = build_transcript_table()
+        transcripts_table = self._annotation_engine.get_transcripts()
 
         # Test what columns we have in the 'SNP' field so we can name them...
         field_names = define_field_names_from_pandas(bolt_table_gene.iloc[0])
         bolt_table_gene[field_names] = bolt_table_gene['SNP'].str.split("-", expand=True)
-        bolt_table_gene = bolt_table_gene.drop(columns=['SNP', 'CHR', 'BP', 'ALLELE1', 'ALLELE0', 'GENPOS'])
+        bolt_table_gene = bolt_table_gene.drop(columns=['SNP'])
 
         # We need to add in an 'AC' column. Pull samples total from the BOLT log file:
         n_bolt = 0
-        with open(self._output_prefix + '.BOLT.log', 'r') as bolt_log_file:
+        with open(output_prefix + '.BOLT.log', 'r') as bolt_log_file:
             for line in bolt_log_file:
                 if 'samples (Nbgen):' in line:
                     n_bolt = int(line.strip('samples (Nbgen): '))
@@ -222,57 +287,38 @@ class BOLTRunner(ToolRunner):
 
         # Now merge the transcripts table into the gene table to add annotation and the write
         bolt_table_gene = pd.merge(transcripts_table, bolt_table_gene, on='ENST', how="left")
-        with open(self._output_prefix + '.genes.BOLT.stats.tsv', 'w') as gene_out:
+        with self._open_indexed_output(output_prefix + '.genes.BOLT.stats.tsv.gz', end_col=4) as gene_out:
             # Sort by chrom/pos just to be sure...
             bolt_table_gene = bolt_table_gene.sort_values(by=['chrom', 'start', 'end'])
 
             bolt_table_gene.to_csv(path_or_buf=gene_out, index=False, sep="\t", na_rep='NA')
-            gene_out.close()
-
-            # And bgzip and tabix...
-            cmd = "bgzip /test/" + self._output_prefix + '.genes.BOLT.stats.tsv'
-            run_cmd(cmd, True)
-            cmd = "tabix -S 1 -s 2 -b 3 -e 4 /test/" + self._output_prefix + '.genes.BOLT.stats.tsv.gz'
-            run_cmd(cmd, True)
 
-        outputs = [self._output_prefix + '.stats.gz',
-                   self._output_prefix + '.genes.BOLT.stats.tsv.gz',
-                   self._output_prefix + '.genes.BOLT.stats.tsv.gz.tbi',
-                   self._output_prefix + '.BOLT.log']
+        outputs = [output_prefix + '.stats.gz',
+                   output_prefix + '.genes.BOLT.stats.tsv.gz',
+                   output_prefix + '.genes.BOLT.stats.tsv.gz.tbi',
+                   output_prefix + '.BOLT.log']
+        outputs.extend(self._write_parquet_output(output_prefix + '.genes.BOLT.stats.tsv.gz', bolt_table_gene))
 
         # And now process the SNP file (if necessary):
-        # Read in the variant index (per-chromosome and mash together)
         if self._association_pack.run_marker_tests:
-            variant_index = []
-            # Open all chromosome indicies and load them into a list and append them together
-            for chromosome in get_chromosomes():
-                variant_index.append(pd.read_csv(f'filtered_bgen/{chromosome}.filtered.vep.tsv.gz',
-                                                 sep="\t",
-                                                 dtype={'SIFT': str, 'POLYPHEN': str}))
-
-            variant_index = pd.concat(variant_index)
-            variant_index = variant_index.set_index('varID')
 
             # For markers, we can use the SNP ID column to get what we need
             bolt_table_marker = bolt_table_marker.rename(columns={'SNP': 'varID', 'A1FREQ': 'BOLT_MAF'})
-            bolt_table_marker = bolt_table_marker.drop(columns=['CHR', 'BP', 'ALLELE1', 'ALLELE0', 'GENPOS'])
             bolt_table_marker['BOLT_AC'] = bolt_table_marker['BOLT_MAF'] * (n_bolt*2)
             bolt_table_marker['BOLT_AC'] = bolt_table_marker['BOLT_AC'].round()
-            bolt_table_marker = pd.merge(variant_index, bolt_table_marker, on='varID', how="left")
-            with open(self._output_prefix + '.markers.BOLT.stats.tsv', 'w') as marker_out:
-                # Sort by chrom/pos just to be sure...
-                bolt_table_marker = bolt_table_marker.sort_values(by=['CHROM', 'POS'])
-
-                bolt_table_marker.to_csv(path_or_buf=marker_out, index=False, sep="\t", na_rep='NA')
-                marker_out.close()
-
-                # And bgzip and tabix...
-                cmd = "bgzip /test/" + self._output_prefix + '.markers.BOLT.stats.tsv'
-                run_cmd(cmd, True)
-                cmd = "tabix -S 1 -s 2 -b 3 -e 3 /test/" + self._output_prefix + '.markers.BOLT.stats.tsv.gz'
-                run_cmd(cmd, True)
-
-            outputs.extend([self._output_prefix + '.markers.BOLT.stats.tsv.gz',
-                            self._output_prefix + '.markers.BOLT.stats.tsv.gz.tbi'])
+            # Annotate one chromosome at a time, passing each only its own markers (varIDs are CHROM:POS:REF:ALT)
+            marker_rows = bolt_table_marker.groupby(bolt_table_marker['varID'].str.split(':', n=1).str[0]).indices
+            marker_parquet_path = self._get_parquet_path(output_prefix + '.markers.BOLT.stats.tsv.gz')
+            with self._open_indexed_output(output_prefix + '.markers.BOLT.stats.tsv.gz', end_col=3) as marker_out:
+                self._annotation_engine.write_annotated_markers(
+                    get_chromosomes(),
+                    lambda chromosome: bolt_table_marker.iloc[marker_rows.get(chromosome, [])],
+                    marker_out,
+                    marker_parquet_path)
+
+            outputs.extend([output_prefix + '.markers.BOLT.stats.tsv.gz',
+                            output_prefix + '.markers.BOLT.stats.tsv.gz.tbi'])
+            if marker_parquet_path is not None:
+                outputs.append(marker_parquet_path)
 
         return outputs
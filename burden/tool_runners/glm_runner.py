@@ -1,9 +1,16 @@
+import pickle
+
+from burden.glm_batch import ResidualMatrix, score_all_genes
+from burden.glm_logistic import BatchedLogisticRegression
+from burden.genotype_pack import GenotypePack
+from burden.glm_pool import GLMProcessPool
 from burden.tool_runners.tool_runner import ToolRunner
 from general_utilities.association_resources import *
 from general_utilities.linear_model import linear_model
 from general_utilities.linear_model.linear_model import LinearModelResult
 from general_utilities.linear_model.proccess_model_output import process_linear_model_outputs
 from general_utilities.thread_utility.thread_utility import *
+from burden.profiler import ThreadUtility
 
 
 class GLMRunner(ToolRunner):
@@ -12,68 +19,157 @@ class GLMRunner(ToolRunner):
 
         # 1. Do setup for the linear models.
         # This will load all variants, genes, and phenotypes into memory to allow for parallelization
-        # This function returns a class of type LinearModelPack containing info for running GLMs
+        # This function returns a class of type LinearModelPack containing info for running GLMs. In batch mode we build
+        # one null model per phenotype.
         print("Loading data and running null Linear Model")
-        null_model = linear_model.linear_model_null(self._association_pack.pheno_names[0],
-                                                    self._association_pack.is_binary,
-                                                    self._association_pack.found_quantitative_covariates,
-                                                    self._association_pack.found_categorical_covariates)
+        self._start_stage('glm.null_models')
+        null_models = {}
+        for phenoname in self._association_pack.pheno_names:
+            null_model_file = f'{phenoname}.GLM_null.pkl'
+            self._association_pack.null_model_store.load_or_fit('glm', [phenoname],
+                                                                self._association_pack.pheno_names,
+                                                                {'GLM_null.pkl': null_model_file},
+                                                                lambda: self._glm_null(phenoname, null_model_file))
+            with open(null_model_file, 'rb') as null_model_reader:
+                null_models[phenoname] = pickle.load(null_model_reader)
 
-        # 2. Load the tarballs INTO separate genotypes dictionaries
+        # 2. Load the tarballs INTO separate genotype packs (shared by all phenotypes)
         print("Loading Linear Model genotypes")
+        self._start_stage('glm.load_genotypes')
         thread_utility = ThreadUtility(self._association_pack.threads,
                                        error_message='A GLM thread failed',
                                        incrementor=10,
                                        thread_factor=2)
 
         for tarball_prefix in self._association_pack.tarball_prefixes:
-            thread_utility.launch_job(linear_model.load_tarball_linear_model,
-                                      tarball_prefix=tarball_prefix,
-                                      is_snp_tar=False,
-                                      is_gene_tar=False)
+            thread_utility.launch_job(self._load_genotypes,
+                                      tarball_prefix=tarball_prefix)
 
         future_results = thread_utility.collect_futures()
         genotype_packs = {}
         for result in future_results:
-            tarball_prefix, genotype_dict = result
-            genotype_packs[tarball_prefix] = genotype_dict
+            tarball_prefix, genotype_pack = result
+            genotype_packs[tarball_prefix] = genotype_pack
 
-        # 3. Iterate through every model / gene (in linear_model_pack['genes']) pair and run a GLM
-        print("Submitting Linear Models to threads")
-        thread_utility = ThreadUtility(self._association_pack.threads,
-                                       error_message='A GLM thread failed',
-                                       incrementor=500,
-                                       thread_factor=1)
-
-        for model in genotype_packs:
-            for gene in genotype_packs[model].index.levels[0]:  # level[0] in this DataFrame is ENST
-                thread_utility.launch_job(linear_model.run_linear_model,
-                                          linear_model_pack=null_model,
-                                          genotype_table=genotype_packs[model],
-                                          gene=gene,
-                                          mask_name=model,
-                                          is_binary=self._association_pack.is_binary)
+        # 3. Screen every model / gene pair against every phenotype at once: the phenotypes are residualised against the
+        # covariates once, and the residual model is then run for all genes in a mask as sparse matrix products (see
+        # glm_batch). Only genes with a p. value below --glm_screen_threshold are refit with the full model.
+        print("Screening all genes with the residual model")
+        self._start_stage('glm.genes')
+        residual_matrix = ResidualMatrix(null_models)
 
-        # As futures finish, write unformatted results:
+        # Write unformatted results as they are made:
         fieldnames = ['ENST', 'maskname', 'pheno_name', 'p_val_init', 'n_car', 'cMAC', 'n_model',
                       'p_val_full', 'effect', 'std_err']
         # Binary traits get an additional set of fields to describe the confusion matrix.
         if self._association_pack.is_binary:
             fieldnames.extend(['n_noncar_affected', 'n_noncar_unaffected', 'n_car_affected', 'n_car_unaffected'])
 
-        lm_stats_file = open(self._output_prefix + '.lm_stats.tmp', 'w')
-        lm_stats_writer = csv.DictWriter(lm_stats_file,
-                                         delimiter="\t",
-                                         fieldnames=fieldnames,
-                                         extrasaction='ignore')
+        lm_stats_files = {}
+        lm_stats_writers = {}
+        for phenoname in self._association_pack.pheno_names:
+            lm_stats_files[phenoname] = open(self._get_output_prefix(phenoname) + '.lm_stats.tmp', 'w')
+            lm_stats_writers[phenoname] = csv.DictWriter(lm_stats_files[phenoname],
+                                                         delimiter="\t",
+                                                         fieldnames=fieldnames,
+                                                         extrasaction='ignore')
+            lm_stats_writers[phenoname].writeheader()
 
-        lm_stats_writer.writeheader()
-        future_results = thread_utility.collect_futures()
-        for result in future_results:
-            finished_gene: LinearModelResult = result
-            lm_stats_writer.writerow(finished_gene.todict())
-        lm_stats_file.close()
+        # Binary traits are refit with batched logistic regression (falling back to Firth for genes that separate – see
+        # BatchedLogisticRegression), a batch of genes per thread. Otherwise, full model fits run on threads with
+        # run_linear_model(), or with --glm_process_pool, on a pool of processes sharing memory-mapped design and
+        # genotype matrices (see GLMProcessPool).
+        logistic_regression = None
+        if self._association_pack.is_binary:
+            logistic_regression = BatchedLogisticRegression(residual_matrix, null_models)
+            refit_pool = ThreadUtility(self._association_pack.threads,
+                                       error_message='A GLM thread failed',
+                                       incrementor=50,
+                                       thread_factor=1)
+        elif self._association_pack.glm_process_pool:
+            refit_pool = GLMProcessPool(residual_matrix, null_models, self._association_pack.threads)
+        else:
+            refit_pool = ThreadUtility(self._association_pack.threads,
+                                       error_message='A GLM thread failed',
+                                       incrementor=500,
+                                       thread_factor=1)
+        # The process pool's workers and shared arrays are cleaned up even if screening or a fit fails
+        try:
+            refit_count = 0
+            for model in genotype_packs:
+                genotype_pack = genotype_packs[model]
+                genotype_matrix = genotype_pack.get_matrix(residual_matrix.samples)
+                screened_rows, refits = score_all_genes(residual_matrix, genotype_pack.genes, genotype_matrix, model,
+                                                        self._association_pack.is_binary,
+                                                        self._association_pack.glm_screen_threshold)
+                for row in screened_rows:
+                    lm_stats_writers[row['pheno_name']].writerow(row)
+                if logistic_regression is not None:
+                    for batch in logistic_regression.get_batches(refits):
+                        refit_pool.launch_job(logistic_regression.fit_batch,
+                                              genotype_matrix=genotype_matrix,
+                                              batch=batch)
+                elif self._association_pack.glm_process_pool:
+                    refit_pool.submit(model, genotype_matrix, refits)
+                else:
+                    for _, _, row in refits:
+                        refit_pool.launch_job(linear_model.run_linear_model,
+                                              linear_model_pack=null_models[row['pheno_name']],
+                                              genotype_table=genotype_pack.get_gene_table(row['ENST']),
+                                              gene=row['ENST'],
+                                              mask_name=model,
+                                              is_binary=self._association_pack.is_binary,
+                                              always_run_corrected=True)
+                refit_count += len(refits)
+
+            print(f'Refitting {refit_count} gene / phenotype pairs with the full model')
+            if logistic_regression is not None:
+                for result in refit_pool.collect_futures():
+                    for finished_row in result:
+                        lm_stats_writers[finished_row['pheno_name']].writerow(finished_row)
+            elif self._association_pack.glm_process_pool:
+                for finished_row in refit_pool.collect():
+                    lm_stats_writers[finished_row['pheno_name']].writerow(finished_row)
+            else:
+                for result in refit_pool.collect_futures():
+                    finished_gene: LinearModelResult = result
+                    finished_row = finished_gene.todict()
+                    lm_stats_writers[finished_row['pheno_name']].writerow(finished_row)
+        finally:
+            if isinstance(refit_pool, GLMProcessPool):
+                refit_pool.close()
+        for lm_stats_file in lm_stats_files.values():
+            lm_stats_file.close()
 
         # 5. Annotate unformatted results and print final outputs
         print("Annotating Linear Model results")
-        self._outputs.extend(process_linear_model_outputs(self._output_prefix))
+        self._start_stage('glm.annotate')
+        for phenoname in self._association_pack.pheno_names:
+            self._outputs.extend(self._add_parquet_outputs(
+                process_linear_model_outputs(self._get_output_prefix(phenoname))))
+
+    # Fit the GLM null model for one phenotype and save it so it can be stored by the null model store
+    def _glm_null(self, phenoname: str, null_model_file: str) -> None:
+        null_model = linear_model.linear_model_null(phenoname,
+                                                    self._association_pack.is_binary,
+                                                    self._association_pack.found_quantitative_covariates,
+                                                    self._association_pack.found_categorical_covariates)
+        with open(null_model_file, 'wb') as null_model_writer:
+            pickle.dump(null_model, null_model_writer)
+
+    # Genotypes are converted to a GenotypePack, saved as <tarball_prefix>.GLM_genotypes.*.npy, and loaded
+    # memory-mapped so that only one mask's table is ever in memory at a time. Packs only depend on the tarball and
+    # samples, so are kept in the derived cache if there is one.
+    def _load_genotypes(self, tarball_prefix: str) -> tuple:
+
+        pack_prefix = f'{tarball_prefix}.GLM_genotypes'
+        self._association_pack.derived_cache.load_or_build('glm_genotypes', [tarball_prefix], None,
+                                                           {f'genotypes.{name}.npy': path for name, path
+                                                            in GenotypePack.get_paths(pack_prefix).items()},
+                                                           lambda: self._build_genotypes(tarball_prefix, pack_prefix))
+        return tarball_prefix, GenotypePack.load(pack_prefix)
+
+    @staticmethod
+    def _build_genotypes(tarball_prefix: str, pack_prefix: str) -> None:
+        _, genotype_table = linear_model.load_tarball_linear_model(tarball_prefix, is_snp_tar=False, is_gene_tar=False)
+        GenotypePack.from_table(genotype_table).save(pack_prefix)
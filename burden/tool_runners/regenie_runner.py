@@ -1,147 +1,251 @@
 import re
+from functools import partial
 from os.path import exists
+from typing import Any, Dict, Hashable, IO, List, Optional
 
-from burden.tool_runners.tool_runner import ToolRunner
+from burden.annotation import MarkerSpill
+from burden.output_parser import read_table
+from burden.tool_runners.tool_runner import ToolRunner, COMBINED_MASK_PREFIX
 from general_utilities.association_resources import *
 from general_utilities.thread_utility.thread_utility import *
+from burden.profiler import run_cmd
+
+# Per-chromosome mask definition files made by _make_regenie_files(), named <file_prefix>.<chromosome>.REGENIE.<file>
+REGENIE_MASK_FILES = ['annotationFile.tsv', 'setListFile.tsv', 'maskfile.tsv']
+
+# Threads reserved for each chromosome's bgen download / filtering
+BGEN_PREP_THREADS = 4
+
+# Threads given to each REGENIE step 2 run when all masks on a chromosome are tested at once (--combine_masks)
+COMBINED_STEP_TWO_THREADS = 4
 
 
 class REGENIERunner(ToolRunner):
 
     def run_tool(self) -> None:
 
-        # 1. Run step 1 of regenie
-        print("Running REGENIE step 1")
-        self._run_regenie_step_one()
+        # Every step is a task in a single graph, so each chromosome / mask moves on as soon as its own inputs are ready
+        # rather than waiting for every other chromosome to finish the same step:
+        #   step 1 ------------------------------------+--> step 2 (mask, chrom) --> parse (mask, chrom)
+        #   bgen (chrom) ------------------------------+
+        #   mask files (mask, chrom) ------------------+
+        #   step 1 + bgen (chrom) --> per-marker tests (chrom) [if requested]
+        task_graph = self._new_task_graph('A REGENIE task failed')
+
+        # 1. Run step 1 of regenie. In batch mode all phenotypes are fit in a single multi-column run, which produces
+        # one .loco file per phenotype (in the same order as --phenoColList). Step 1 uses every thread, but is scheduled
+        # as if it leaves a few free, so that (mostly I/O-bound) bgen downloads and mask preparation overlap with it.
+        loco_files = [f'fit_out_{pheno_num}.loco'
+                      for pheno_num in range(1, len(self._association_pack.pheno_names) + 1)]
+        step_one_files = {'fit_out_pred.list': 'fit_out_pred.list',
+                          'REGENIE_step1.log': self._output_prefix + '.REGENIE_step1.log'}
+        step_one_files.update({loco_file: loco_file for loco_file in loco_files})
+        step_one = task_graph.add_task('step_one',
+                                       self._association_pack.null_model_store.load_or_fit,
+                                       threads=self._association_pack.threads - BGEN_PREP_THREADS,
+                                       memory=self._estimate_memory('regenie.step_one'),
+                                       job=self._describe_job('regenie.step_one'),
+                                       checkpoint=self._null_model_checkpoint('regenie',
+                                                                              self._association_pack.pheno_names,
+                                                                              step_one_files),
+                                       tool='regenie',
+                                       phenonames=self._association_pack.pheno_names,
+                                       all_phenonames=self._association_pack.pheno_names,
+                                       files=step_one_files,
+                                       fit=self._run_regenie_step_one)
         # Add the step1 files to output so we can use later if need-be:
-        self._outputs.extend(['fit_out_pred.list',
-                              'fit_out_1.loco'])
+        self._outputs.append('fit_out_pred.list')
+        self._outputs.extend(loco_files)
 
-        # 2. Prep bgen files for a run:
-        print("Downloading and filtering raw bgen files")
-        thread_utility = ThreadUtility(self._association_pack.threads,
-                                       error_message='A REGENIE bgen thread failed',
-                                       incrementor=10,
-                                       thread_factor=4)
-
-        for chromosome in get_chromosomes():
-            # This makes use of a utility class from AssociationResources since bgen filtering/processing is
-            # IDENTICAL to that done for BOLT. Do not want to duplicate code!
-            thread_utility.launch_job(class_type=process_bgen_file,
-                                      chrom_bgen_index=self._association_pack.bgen_dict[chromosome],
-                                      chromosome=chromosome)
-        thread_utility.collect_futures()
-
-        # 3. Prep mask files
-        print("Prepping mask files")
-        thread_utility = ThreadUtility(self._association_pack.threads,
-                                       error_message='A REGENIE mask thread failed',
-                                       incrementor=10,
-                                       thread_factor=1)
-        for chromosome in get_chromosomes():
-            for tarball_prefix in self._association_pack.tarball_prefixes:
-                if exists(tarball_prefix + "." + chromosome + ".variants_table.STAAR.tsv"):
-                    thread_utility.launch_job(class_type=self._make_regenie_files,
-                                              tarball_prefix=tarball_prefix,
-                                              chromosome=chromosome)
-        thread_utility.collect_futures()
-
-        # 4. Run step 2 of regenie
-        print("Running REGENIE step 2")
-        thread_utility = ThreadUtility(self._association_pack.threads,
-                                       error_message='A REGENIE step 2 thread failed',
-                                       incrementor=10,
-                                       thread_factor=1)
+        step_two_runs = []
+        marker_spills = {}
+        if self._association_pack.run_marker_tests:
+            marker_spills = {phenoname: MarkerSpill(self._annotation_engine,
+                                                    self._get_parquet_path(self._get_output_prefix(phenoname) +
+                                                                           '.markers.REGENIE.stats.tsv.gz'))
+                             for phenoname in self._association_pack.pheno_names}
+        step_two_threads = COMBINED_STEP_TWO_THREADS if self._association_pack.combine_masks else 1
         for chromosome in get_chromosomes():
-            for tarball_prefix in self._association_pack.tarball_prefixes:
-                if exists(tarball_prefix + "." + chromosome + ".REGENIE.annotationFile.tsv"):
-                    thread_utility.launch_job(self._run_regenie_step_two,
-                                              tarball_prefix=tarball_prefix,
-                                              chromosome=chromosome)
-        future_results = thread_utility.collect_futures()
 
-        # Gather preliminary results from step 2:
-        print("Gathering REGENIE mask-based results...")
-        completed_gene_tables = []
+            # 2. Prep bgen files for a run. This makes use of a utility class from AssociationResources since bgen
+            # filtering/processing is IDENTICAL to that done for BOLT. Do not want to duplicate code!
+            bgen_ready = task_graph.add_task(('bgen', chromosome),
+                                             process_bgen_file,
+                                             threads=BGEN_PREP_THREADS,
+                                             memory=self._estimate_memory('regenie.bgen'),
+                                             job=self._describe_job('regenie.bgen', chromosome),
+                                             chrom_bgen_index=self._association_pack.bgen_dict[chromosome],
+                                             chromosome=chromosome)
+
+            # 3. Prep mask files. With --combine_masks every mask on a chromosome goes into one set of files, so step 2
+            # only needs a single (multi-threaded) pass over each chromosome's bgen
+            chromosome_prefixes = [tarball_prefix for tarball_prefix in self._association_pack.tarball_prefixes
+                                   if exists(tarball_prefix + "." + chromosome + ".variants_table.STAAR.tsv")]
+            if len(chromosome_prefixes) == 0:
+                mask_inputs = []
+            elif self._association_pack.combine_masks:
+                mask_inputs = [(COMBINED_MASK_PREFIX, chromosome_prefixes)]
+            else:
+                mask_inputs = [(tarball_prefix, [tarball_prefix]) for tarball_prefix in chromosome_prefixes]
+
+            for file_prefix, tarball_prefixes in mask_inputs:
+                masks_ready = task_graph.add_task(
+                    ('mask_files', file_prefix, chromosome),
+                    self._association_pack.derived_cache.load_or_build,
+                    job=self._describe_job('regenie.mask_files', chromosome, tarball_prefixes),
+                    artifact='regenie_masks',
+                    tarball_prefixes=tarball_prefixes,
+                    chromosome=chromosome,
+                    files={f'REGENIE.{regenie_file}': f'{file_prefix}.{chromosome}.REGENIE.{regenie_file}'
+                           for regenie_file in REGENIE_MASK_FILES},
+                    build=partial(self._make_regenie_files,
+                                  tarball_prefixes=tarball_prefixes,
+                                  chromosome=chromosome,
+                                  file_prefix=file_prefix),
+                    options={'combine_masks': file_prefix == COMBINED_MASK_PREFIX})
+
+                # 4. Run step 2 of regenie and read its output
+                step_two = task_graph.add_task(('step_two', file_prefix, chromosome),
+                                               self._run_regenie_step_two,
+                                               dependencies=[step_one, bgen_ready, masks_ready],
+                                               threads=step_two_threads,
+                                               memory=self._estimate_memory('regenie.step_two'),
+                                               job=self._describe_job('regenie.step_two', chromosome,
+                                                                      tarball_prefixes),
+                                               checkpoint=self._checkpoint(
+                                                   self._get_step_two_files(file_prefix, chromosome),
+                                                   tarball_prefixes),
+                                               tarball_prefix=file_prefix,
+                                               chromosome=chromosome,
+                                               regenie_threads=step_two_threads)
+                task_graph.add_task(('parse', file_prefix, chromosome),
+                                    self._read_regenie_output,
+                                    dependencies=[step_two],
+                                    checkpoint=self._checkpoint(tarball_prefixes=tarball_prefixes, save_result=True),
+                                    tarball_prefix=file_prefix,
+                                    chromosome=chromosome)
+                step_two_runs.append((file_prefix, chromosome))
+
+            # 5. Run per-marker tests, if requested, and annotate each phenotype's results as soon as they are ready
+            if self._association_pack.run_marker_tests:
+                markers = task_graph.add_task(('markers', chromosome),
+                                              self._regenie_marker_run,
+                                              dependencies=[step_one, bgen_ready],
+                                              threads=4,
+                                              memory=self._estimate_memory('regenie.markers'),
+                                              job=self._describe_job('regenie.markers', chromosome),
+                                              checkpoint=self._checkpoint(self._get_marker_files(chromosome)),
+                                              chromosome=chromosome)
+                for phenoname in self._association_pack.pheno_names:
+                    # Annotation reads the VEP table downloaded with the bgen, so depends on it too (and so a resumed
+                    # run does not skip the bgen when the marker tests were restored from checkpoints)
+                    task_graph.add_task(('annotate_markers', chromosome, phenoname),
+                                        self._spill_regenie_markers,
+                                        dependencies=[markers, bgen_ready],
+                                        marker_spill=marker_spills[phenoname],
+                                        chromosome=chromosome,
+                                        phenoname=phenoname)
+
+        # Logs cover all phenotypes in batch mode, and are streamed in as the runs finish (see _append_regenie_log())
         log_file = open(self._output_prefix + '.REGENIE_step2.log', 'w')
-        for result in future_results:
-            tarball_prefix, finished_chromosome = result
-            completed_gene_tables.append(self._process_regenie_output(tarball_prefix,
-                                                                      finished_chromosome))
-            log_file.write("{s:{c}^{n}}\n".format(s=tarball_prefix + '-' + finished_chromosome + '.log', n=50, c='-'))
-            with open(tarball_prefix + "." + finished_chromosome + ".log", 'r') as current_log:
-                for line in current_log:
-                    log_file.write(line)
-                current_log.close()
-        log_file.close()
+        markers_log_file = open(self._output_prefix + '.REGENIE_markers.log', 'w') \
+            if self._association_pack.run_marker_tests else None
 
-        # 5. Run per-marker tests, if requested
-        completed_marker_chromosomes = []
-        if self._association_pack.run_marker_tests:
-            print("Running per-marker tests...")
-            thread_utility = ThreadUtility(self._association_pack.threads,
-                                           error_message='A SAIGE marker thread failed',
-                                           incrementor=1,
-                                           thread_factor=4)
-            for chromosome in get_chromosomes():
-                thread_utility.launch_job(class_type=self._regenie_marker_run,
-                                          chromosome=chromosome)
-                completed_marker_chromosomes.append(chromosome)
-            future_results = thread_utility.collect_futures()
-
-            markers_log_file = open(self._output_prefix + '.REGENIE_markers.log', 'w')
-            for result in future_results:
-                finished_chromosome = result
-                markers_log_file.write(
-                    "{s:{c}^{n}}\n".format(s=finished_chromosome + '.log', n=50, c='-'))
-                with open(finished_chromosome + ".REGENIE_markers.log", 'r') as current_log:
-                    for line in current_log:
-                        markers_log_file.write(line)
-                    current_log.close()
+        print("Running REGENIE tasks...")
+        self._start_stage('regenie.tasks')
+        task_results = task_graph.run(on_finish=partial(self._append_regenie_log, log_file, markers_log_file))
+        log_file.close()
+        if markers_log_file is not None:
             markers_log_file.close()
+        # A null model restored from a checkpoint did not go through the null model store, so add it to the bundle here
+        self._association_pack.null_model_store.mark_used('regenie', self._association_pack.pheno_names,
+                                                          self._association_pack.pheno_names, step_one_files)
+
+        # Gather preliminary results from step 2 (already parsed as each run finished):
+        print("Gathering REGENIE mask-based results...")
+        self._start_stage('regenie.gather')
+        completed_gene_tables = {phenoname: [] for phenoname in self._association_pack.pheno_names}
+        for file_prefix, chromosome in step_two_runs:
+            for phenoname, processed_tables in task_results[('parse', file_prefix, chromosome)].items():
+                completed_gene_tables[phenoname].extend(processed_tables)
 
         # 6. Process outputs
         print("Processing REGENIE outputs...")
-        self._outputs.extend(self._annotate_regenie_output(completed_gene_tables, completed_marker_chromosomes))
+        self._start_stage('regenie.annotate')
+        # Logs cover all phenotypes in batch mode, so only need to be added once
+        self._outputs.extend([self._output_prefix + '.REGENIE_step1.log',
+                              self._output_prefix + '.REGENIE_step2.log'])
+        if self._association_pack.run_marker_tests:
+            self._outputs.append(self._output_prefix + '.REGENIE_markers.log')
+        for phenoname in self._association_pack.pheno_names:
+            self._outputs.extend(self._annotate_regenie_output(completed_gene_tables[phenoname],
+                                                               marker_spills.get(phenoname),
+                                                               phenoname))
+
+    # Called by the task graph as each task finishes: append step 2 and per-marker logs to the combined logs
+    def _append_regenie_log(self, log_file: IO, markers_log_file: Optional[IO], task_name: Hashable,
+                            result: Any) -> None:
+
+        if not isinstance(task_name, tuple):
+            return
+        elif task_name[0] == 'step_two':
+            _, tarball_prefix, chromosome = task_name
+            self._append_log(log_file,
+                             "{s:{c}^{n}}\n".format(s=tarball_prefix + '-' + chromosome + '.log', n=50, c='-'),
+                             f'{tarball_prefix}.{chromosome}.log')
+        elif task_name[0] == 'markers':
+            _, chromosome = task_name
+            self._append_log(markers_log_file, "{s:{c}^{n}}\n".format(s=chromosome + '.log', n=50, c='-'),
+                             f'{chromosome}.REGENIE_markers.log')
 
     # We need three files per chromosome-mask combination:
     # 1. Annotation file, which lists variants with gene and mask name
     # 2. Set list file, which lists all variants per-gene
     # 3. A mask name file, which lists all masks to run
-    # This function handles creation of those files
+    # This function handles creation of those files, named like <file_prefix>.<chromosome>.REGENIE.*
+    #
+    # With --combine_masks (file_prefix is COMBINED_MASK_PREFIX) the files cover every mask in 'tarball_prefixes'. A
+    # variant can be in more than one mask for the same gene, so each gene x mask pair gets its own set named
+    # '<ENST>_<mask number>' holding only that mask's variants. REGENIE then tests each pair exactly as it would in a
+    # run of that mask alone, and results are split back out by the mask name in their ID.
     @staticmethod
-    def _make_regenie_files(tarball_prefix: str, chromosome: str) -> None:
+    def _make_regenie_files(tarball_prefixes: List[str], chromosome: str, file_prefix: str) -> None:
 
         # This is used to print the set list file (2) below
         gene_dict = {}
+        is_combined = file_prefix == COMBINED_MASK_PREFIX
 
         # 1. Annotation File
-        with open(f'{tarball_prefix}.{chromosome}.REGENIE.annotationFile.tsv', 'w', newline='\n') as annotation_file:
-            table_reader = csv.DictReader(open(tarball_prefix + "." + chromosome + ".variants_table.STAAR.tsv", 'r'),
-                                          delimiter='\t')
+        with open(f'{file_prefix}.{chromosome}.REGENIE.annotationFile.tsv', 'w', newline='\n') as annotation_file:
             annotation_writer = csv.DictWriter(annotation_file,
                                                delimiter='\t',
                                                fieldnames=['varID', 'ENST', 'annotation'],
                                                extrasaction='ignore',
                                                lineterminator='\n')  # REGENIE is very fussy about line terminators.
-            last_var = None  # Need to check for small number of duplicate variants...
-            for variant in table_reader:
-                if last_var != variant['varID']:
-                    variant['annotation'] = tarball_prefix
-                    annotation_writer.writerow(variant)
-                    last_var = variant['varID']
-                    # And build gene_dict while we iterate...
-                    if variant['ENST'] in gene_dict:
-                        gene_dict[variant['ENST']]['varIDs'].append(variant['varID'])
-                    else:
-                        gene_dict[variant['ENST']] = {'chrom': variant['chrom'],
-                                                      'pos': variant['pos'],
-                                                      'varIDs': [variant['varID']],
-                                                      'ENST': variant['ENST']}
+            for mask_number, tarball_prefix in enumerate(tarball_prefixes):
+                table_reader = csv.DictReader(open(tarball_prefix + "." + chromosome + ".variants_table.STAAR.tsv",
+                                                   'r'),
+                                              delimiter='\t')
+                last_var = None  # Need to check for small number of duplicate variants...
+                for variant in table_reader:
+                    if last_var != variant['varID']:
+                        variant['annotation'] = tarball_prefix
+                        if is_combined:
+                            variant['ENST'] = f'{variant["ENST"]}_{mask_number}'
+                        annotation_writer.writerow(variant)
+                        last_var = variant['varID']
+                        # And build gene_dict while we iterate...
+                        if variant['ENST'] in gene_dict:
+                            gene_dict[variant['ENST']]['varIDs'].append(variant['varID'])
+                        else:
+                            gene_dict[variant['ENST']] = {'chrom': variant['chrom'],
+                                                          'pos': variant['pos'],
+                                                          'varIDs': [variant['varID']],
+                                                          'ENST': variant['ENST']}
             annotation_file.close()
 
         # 2. Set list file
-        with open(tarball_prefix + "." + chromosome + ".REGENIE.setListFile.tsv", 'w', newline='\n') as set_list_file:
+        with open(f'{file_prefix}.{chromosome}.REGENIE.setListFile.tsv', 'w', newline='\n') as set_list_file:
             set_list_writer = csv.DictWriter(set_list_file,
                                              delimiter="\t",
                                              fieldnames=['ENST', 'chrom', 'pos', 'varIDs'],
@@ -152,8 +256,9 @@ class REGENIERunner(ToolRunner):
             set_list_file.close()
 
         # 3. This makes the mask name file. Just needs to be the name of the mask (tarball prefix) used in file #1
-        with open(tarball_prefix + "." + chromosome + ".REGENIE.maskfile.tsv", 'w') as mask_file:
-            mask_file.write(tarball_prefix + '\t' + tarball_prefix + '\n')
+        with open(f'{file_prefix}.{chromosome}.REGENIE.maskfile.tsv', 'w') as mask_file:
+            for tarball_prefix in tarball_prefixes:
+                mask_file.write(tarball_prefix + '\t' + tarball_prefix + '\n')
             mask_file.close()
 
     def _run_regenie_step_one(self) -> None:
@@ -198,14 +303,14 @@ class REGENIERunner(ToolRunner):
               '--bsize 1000 ' \
               '--out /test/fit_out ' \
               f'--threads {str(self._association_pack.threads)} ' \
-              f'--phenoCol {self._association_pack.pheno_names[0]} '
+              f'--phenoColList {",".join(self._association_pack.pheno_names)} '
 
         cmd += define_covariate_string(self._association_pack.found_quantitative_covariates,
                                        self._association_pack.found_categorical_covariates,
                                        self._association_pack.is_binary)
         run_cmd(cmd, True, stdout_file=self._output_prefix + ".REGENIE_step1.log")
 
-    def _run_regenie_step_two(self, tarball_prefix: str, chromosome: str) -> tuple:
+    def _run_regenie_step_two(self, tarball_prefix: str, chromosome: str, regenie_threads: int) -> tuple:
 
         # Note – there is some issue with skato (in --vc-tests flag), so I have changed to skato-acat which works...?
         cmd = f'regenie ' \
@@ -214,7 +319,7 @@ class REGENIERunner(ToolRunner):
               f'--sample /test/{chromosome}.markers.bolt.sample ' \
               f'--covarFile /test/phenotypes_covariates.formatted.txt ' \
               f'--phenoFile /test/phenotypes_covariates.formatted.txt ' \
-              f'--phenoCol {self._association_pack.pheno_names[0]} ' \
+              f'--phenoColList {",".join(self._association_pack.pheno_names)} ' \
               f'--pred /test/fit_out_pred.list ' \
               f'--anno-file /test/{tarball_prefix}.{chromosome}.REGENIE.annotationFile.tsv ' \
               f'--mask-def /test/{tarball_prefix}.{chromosome}.REGENIE.maskfile.tsv ' \
@@ -222,7 +327,7 @@ class REGENIERunner(ToolRunner):
               f'--aaf-bins 1 ' \
               f'--vc-tests skato-acat,acato-full ' \
               f'--bsize 400 ' \
-              f'--threads 1 ' \
+              f'--threads {regenie_threads} ' \
               f'--minMAC 1 ' \
               f'--maxCatLevels 100 ' \
               f'--out /test/{tarball_prefix}.{chromosome} '
@@ -231,10 +336,27 @@ class REGENIERunner(ToolRunner):
                                        self._association_pack.found_categorical_covariates,
                                        self._association_pack.is_binary)
 
-        run_cmd(cmd, True, chromosome + ".REGENIE_markers.log")
+        run_cmd(cmd, True, f'{tarball_prefix}.{chromosome}.REGENIE_step2.stdout')
 
         return tarball_prefix, chromosome
 
+    # Files written by one step 2 run (for checkpointing): one table per phenotype, REGENIE's log, and its stdout
+    def _get_step_two_files(self, tarball_prefix: str, chromosome: str) -> Dict[str, str]:
+
+        step_two_files = {'log': f'{tarball_prefix}.{chromosome}.log',
+                          'REGENIE_step2.stdout': f'{tarball_prefix}.{chromosome}.REGENIE_step2.stdout'}
+        step_two_files.update({f'{phenoname}.regenie': f'{tarball_prefix}.{chromosome}_{phenoname}.regenie'
+                               for phenoname in self._association_pack.pheno_names})
+        return step_two_files
+
+    # ... and by one per-marker run
+    def _get_marker_files(self, chromosome: str) -> Dict[str, str]:
+
+        marker_files = {'REGENIE_markers.log': f'{chromosome}.REGENIE_markers.log'}
+        marker_files.update({f'{phenoname}.regenie': f'{chromosome}.markers.REGENIE_{phenoname}.regenie'
+                             for phenoname in self._association_pack.pheno_names})
+        return marker_files
+
     def _regenie_marker_run(self, chromosome: str) -> str:
 
         cmd = f'regenie ' \
@@ -243,7 +365,7 @@ class REGENIERunner(ToolRunner):
               f'--sample /test/{chromosome}.markers.bolt.sample ' \
               f'--covarFile /test/phenotypes_covariates.formatted.txt ' \
               f'--phenoFile /test/phenotypes_covariates.formatted.txt ' \
-              f'--phenoCol {self._association_pack.pheno_names[0]} ' \
+              f'--phenoColList {",".join(self._association_pack.pheno_names)} ' \
               f'--pred /test/fit_out_pred.list ' \
               f'--maxCatLevels 100 ' \
               f'--bsize 200 ' \
@@ -257,12 +379,10 @@ class REGENIERunner(ToolRunner):
 
         return chromosome
 
-    def _process_regenie_output(self, tarball_prefix: str, chromosome: str) -> pd.DataFrame:
-
-        # Load the raw table
-        regenie_table = pd.read_csv(f'{tarball_prefix}.{chromosome}_{self._association_pack.pheno_names[0]}.regenie',
-                                    sep=' ',
-                                    comment='#')
+    # REGENIE writes one output file per phenotype for each run (named <out>_<phenoname>.regenie). These are read (in
+    # parallel, without the position / allele columns) in run_tool() and passed in here as 'regenie_table'
+    @staticmethod
+    def _process_regenie_output(tarball_prefix: str, regenie_table: pd.DataFrame) -> pd.DataFrame:
 
         # And then should be able to split into 3 columns:
         regenie_table[['ENST', 'MASK', 'SUBSET']] = regenie_table['ID'].str.split('.', expand=True)
@@ -274,8 +394,7 @@ class REGENIERunner(ToolRunner):
         regenie_table['PVALUE'] = 10 ** (-1 * regenie_table['LOG10P'])
 
         # And finally drop columns we won't care about:
-        regenie_table = regenie_table.drop(columns=['ID', 'CHROM', 'GENPOS', 'ALLELE0', 'ALLELE1', 'EXTRA',
-                                                    'MASK', 'SUBSET', 'LOG10P'])
+        regenie_table = regenie_table.drop(columns=['ID', 'MASK', 'SUBSET', 'LOG10P'])
 
         # Get column names for Mask/MAF information if possible from the tarball name
         regenie_table = define_field_names_from_tarball_prefix(tarball_prefix, regenie_table)
@@ -295,17 +414,48 @@ class REGENIERunner(ToolRunner):
 
         return regenie_table
 
-    def _annotate_regenie_output(self, completed_gene_tables: list, completed_marker_chromosomes: list) -> list:
+    # Read and process the step 2 output for every phenotype from one run. Returns processed tables keyed by phenotype.
+    def _read_regenie_output(self, tarball_prefix: str, chromosome: str) -> Dict[str, List[pd.DataFrame]]:
+
+        processed_tables = {}
+        for phenoname in self._association_pack.pheno_names:
+            regenie_table = read_table(f'{tarball_prefix}.{chromosome}_{phenoname}.regenie',
+                                       sep=' ',
+                                       drop=['CHROM', 'GENPOS', 'ALLELE0', 'ALLELE1', 'EXTRA'])
+            if tarball_prefix == COMBINED_MASK_PREFIX:
+                processed_tables[phenoname] = self._split_combined_regenie_output(regenie_table)
+            else:
+                processed_tables[phenoname] = [self._process_regenie_output(tarball_prefix, regenie_table)]
+        return processed_tables
+
+    # Split a combined (--combine_masks) result table back into one table per mask. IDs look like
+    # '<ENST>_<mask number>.<mask name>.<subset>', so restore the plain ENST and process each mask on its own.
+    @staticmethod
+    def _split_combined_regenie_output(regenie_table: pd.DataFrame) -> List[pd.DataFrame]:
+
+        id_parts = regenie_table['ID'].str.split('.', n=1, expand=True)
+        regenie_table = regenie_table.assign(ID=id_parts[0].str.rsplit('_', n=1).str[0] + '.' + id_parts[1])
+        mask_names = id_parts[1].str.rsplit('.', n=1).str[0]
+
+        mask_tables = []
+        for tarball_prefix, mask_table in regenie_table.groupby(mask_names, sort=False):
+            mask_tables.append(REGENIERunner._process_regenie_output(tarball_prefix,
+                                                                     mask_table.reset_index(drop=True)))
+        return mask_tables
 
+    def _annotate_regenie_output(self, completed_gene_tables: list, marker_spill: Optional[MarkerSpill],
+                                 phenoname: str) -> list:
+
+        output_prefix = self._get_output_prefix(phenoname)
         regenie_table = pd.concat(completed_gene_tables)
 
         # Now process the gene table into a useable format:
         # First read in the transcripts file
-        transcripts_table = build_transcript_table()
+        transcripts_table = self._annotation_engine.get_transcripts()
 
         # Now merge the transcripts table into the gene table to add annotation and the write
         regenie_table = pd.merge(transcripts_table, regenie_table, left_index=True, right_index=True, how="left")
-        with open(self._output_prefix + '.genes.REGENIE.stats.tsv', 'w') as gene_out:
+        with self._open_indexed_output(output_prefix + '.genes.REGENIE.stats.tsv.gz', end_col=4) as gene_out:
 
             # Reset the index and make sure chrom/start/end are first (for indexing)
             regenie_table.reset_index(inplace=True)
@@ -314,60 +464,39 @@ class REGENIERunner(ToolRunner):
             regenie_table = regenie_table.sort_values(by=['chrom', 'start', 'end'])
 
             regenie_table.to_csv(path_or_buf=gene_out, index=False, sep="\t", na_rep='NA')
-            gene_out.close()
-
-            # And bgzip and tabix...
-            cmd = f'bgzip /test/{self._output_prefix}.genes.REGENIE.stats.tsv'
-            run_cmd(cmd, True)
-            cmd = f'tabix -S 1 -s 2 -b 3 -e 4 /test/{self._output_prefix}.genes.REGENIE.stats.tsv.gz'
-            run_cmd(cmd, True)
 
-        outputs = [self._output_prefix + '.REGENIE_step1.log',
-                   self._output_prefix + '.REGENIE_step2.log',
-                   self._output_prefix + '.genes.REGENIE.stats.tsv.gz',
-                   self._output_prefix + '.genes.REGENIE.stats.tsv.gz.tbi']
+        outputs = [output_prefix + '.genes.REGENIE.stats.tsv.gz',
+                   output_prefix + '.genes.REGENIE.stats.tsv.gz.tbi']
+        outputs.extend(self._write_parquet_output(output_prefix + '.genes.REGENIE.stats.tsv.gz', regenie_table))
 
         if self._association_pack.run_marker_tests:
 
-            variant_index = []
-            regenie_table_marker = []
-            # Open all chromosome indicies and load them into a list and append them together
-            for chromosome in completed_marker_chromosomes:
-                variant_index.append(
-                    pd.read_csv(f'filtered_bgen/{chromosome}.filtered.vep.tsv.gz',
-                                sep="\t",
-                                dtype={'SIFT': str, 'POLYPHEN': str}))
-                regenie_table_marker.append(
-                    pd.read_csv(f'{chromosome}.markers.REGENIE_{self._association_pack.pheno_names[0]}.regenie',
-                                sep=' '))
-
-            variant_index = pd.concat(variant_index)
-            variant_index = variant_index.set_index('varID')
-
-            regenie_table_marker = pd.concat(regenie_table_marker)
-
-            # For markers, we can use the SNP ID column to get what we need
-            regenie_table_marker = regenie_table_marker.rename(
-                columns={'ID': 'varID', 'A1FREQ': 'REGENIE_MAF'})
-            regenie_table_marker['PVALUE'] = 10 ** (-1 * regenie_table_marker['LOG10P'])
-            regenie_table_marker = regenie_table_marker.drop(columns=['CHROM', 'GENPOS', 'ALLELE0', 'ALLELE1', 'INFO',
-                                                                      'EXTRA', 'TEST', 'LOG10P'])
-            regenie_table_marker = pd.merge(variant_index, regenie_table_marker, on='varID', how="left")
-            with open(self._output_prefix + '.markers.REGENIE.stats.tsv', 'w') as marker_out:
-                # Sort by chrom/pos just to be sure...
-                regenie_table_marker = regenie_table_marker.sort_values(by=['CHROM', 'POS'])
-
-                regenie_table_marker.to_csv(path_or_buf=marker_out, index=False, sep="\t", na_rep='NA')
-                marker_out.close()
-
-                # And bgzip and tabix...
-                cmd = "bgzip /test/" + self._output_prefix + '.markers.REGENIE.stats.tsv'
-                run_cmd(cmd, True)
-                cmd = "tabix -S 1 -s 2 -b 3 -e 3 /test/" + self._output_prefix + '.markers.REGENIE.stats.tsv.gz'
-                run_cmd(cmd, True)
-
-            outputs.extend([self._output_prefix + '.markers.REGENIE.stats.tsv.gz',
-                            self._output_prefix + '.markers.REGENIE.stats.tsv.gz.tbi',
-                            self._output_prefix + '.REGENIE_markers.log'])
+            # Markers were annotated one chromosome at a time as their tests finished, so just need writing out
+            with self._open_indexed_output(output_prefix + '.markers.REGENIE.stats.tsv.gz', end_col=3) as marker_out:
+                marker_spill.write(marker_out)
+
+            outputs.extend([output_prefix + '.markers.REGENIE.stats.tsv.gz',
+                            output_prefix + '.markers.REGENIE.stats.tsv.gz.tbi'])
+            if self._association_pack.parquet_outputs:
+                outputs.append(self._get_parquet_path(output_prefix + '.markers.REGENIE.stats.tsv.gz'))
 
         return outputs
+
+    # Annotate one phenotype's per-marker results for a chromosome as soon as its tests finish
+    def _spill_regenie_markers(self, marker_spill: MarkerSpill, chromosome: str, phenoname: str) -> None:
+        marker_spill.add(chromosome, self._load_regenie_markers(chromosome, phenoname))
+
+    # Load per-marker results for one chromosome, ready to be joined to the VEP annotation
+    @staticmethod
+    def _load_regenie_markers(chromosome: str, phenoname: str) -> pd.DataFrame:
+
+        regenie_table_marker = read_table(f'{chromosome}.markers.REGENIE_{phenoname}.regenie',
+                                          sep=' ',
+                                          drop=['CHROM', 'GENPOS', 'ALLELE0', 'ALLELE1', 'INFO', 'EXTRA', 'TEST'])
+
+        # For markers, we can use the SNP ID column to get what we need
+        regenie_table_marker = regenie_table_marker.rename(columns={'ID': 'varID', 'A1FREQ': 'REGENIE_MAF'})
+        regenie_table_marker['PVALUE'] = 10 ** (-1 * regenie_table_marker['LOG10P'])
+        regenie_table_marker = regenie_table_marker.drop(columns=['LOG10P'])
+
+        return regenie_table_marker
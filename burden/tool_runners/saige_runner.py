@@ -1,78 +1,194 @@
+from functools import partial
 from os.path import exists
-from burden.tool_runners.tool_runner import ToolRunner
+from typing import Any, Dict, IO, List, Optional
+
+from burden.annotation import MarkerSpill
+from burden.output_parser import read_table
+from burden.tool_runners.tool_runner import ToolRunner, COMBINED_MASK_PREFIX
 from general_utilities.association_resources import *
 from general_utilities.thread_utility.thread_utility import *
+from burden.profiler import run_cmd
+
+# Per-chromosome step 2 inputs made for each mask (or for all masks with --combine_masks), named
+# <file_prefix>.<chromosome>.<file>
+SAIGE_STEP_TWO_FILES = ['SAIGE_v1.0.groupFile.txt', 'saige_input.bcf', 'saige_input.bcf.csi']
 
 
 class SAIGERunner(ToolRunner):
 
     def run_tool(self) -> None:
 
-        # 1. Run SAIGE step one without parallelisation
-        print("Running SAIGE step 1...")
-        self._saige_step_one()
-
-        # 2. Run SAIGE step two WITH parallelisation by chromosome
-        print("Running SAIGE step 2...")
-        thread_utility = ThreadUtility(self._association_pack.threads,
-                                       error_message='A SAIGE thread failed', 
-                                       incrementor=10, 
-                                       thread_factor=1)
-        
+        # Every step is a task in a single graph, so each chromosome / mask / phenotype moves on as soon as its own
+        # inputs are ready rather than waiting for every other run to finish the same step:
+        #   step 1 (pheno) -----------+--> step 2 (mask, chrom, pheno) --> parse (mask, chrom, pheno)
+        #   step 2 inputs (mask, chrom) +
+        #   step 1 (pheno) + bgen (chrom) --> per-marker tests (chrom, pheno) [if requested]
+        task_graph = self._new_task_graph('A SAIGE task failed')
+
+        # 1. Run SAIGE step one. Each fit uses every thread, so fits for different phenotypes never overlap.
+        step_one = {}
+        step_one_files = {}
+        for phenoname in self._association_pack.pheno_names:
+            step_one_files[phenoname] = {'SAIGE_OUT.rda': f'{phenoname}.SAIGE_OUT.rda',
+                                         'SAIGE_step1.log': self._get_output_prefix(phenoname) + '.SAIGE_step1.log'}
+            step_one[phenoname] = task_graph.add_task(
+                ('step_one', phenoname),
+                self._association_pack.null_model_store.load_or_fit,
+                threads=self._association_pack.threads,
+                memory=self._estimate_memory('saige.step_one'),
+                job=self._describe_job('saige.step_one'),
+                checkpoint=self._null_model_checkpoint('saige', [phenoname], step_one_files[phenoname]),
+                tool='saige',
+                phenonames=[phenoname],
+                all_phenonames=self._association_pack.pheno_names,
+                files=step_one_files[phenoname],
+                fit=partial(self._saige_step_one, phenoname))
+
+        # 2. Prepare phenotype-independent inputs for step 2 (group files and sample-subset bcfs). In batch mode these
+        # are shared by every phenotype. With --combine_masks, all masks on a chromosome are merged into a single bcf
+        # and group file so that step 2 is only run once per chromosome.
+        step_two_runs = []
         for chromosome in get_chromosomes():
-            for tarball_prefix in self._association_pack.tarball_prefixes:
-                if exists(tarball_prefix + "." + chromosome + ".SAIGE.bcf"):
-                    self._prep_group_file(tarball_prefix, chromosome)
-                    thread_utility.launch_job(class_type=self._saige_step_two,
-                                              tarball_prefix=tarball_prefix,
-                                              chromosome=chromosome)
-        future_results = thread_utility.collect_futures()
-
-        # 3. Gather preliminary results
-        print("Gathering SAIGE mask-based results...")
-        completed_gene_tables = []
-        log_file = open(self._output_prefix + '.SAIGE_step2.log', 'w')
-        for result in future_results:
-            tarball_prefix, finished_chromosome = result
-            completed_gene_tables.append(self._process_saige_output(tarball_prefix, finished_chromosome))
-            log_file.write(f'{tarball_prefix + "-" + finished_chromosome:{"-"}^{50}}')
-            with open(tarball_prefix + "." + finished_chromosome + ".SAIGE_step2.log", 'r') as current_log:
-                for line in current_log:
-                    log_file.write(line)
-                current_log.close()
-        log_file.close()
-
-        # 4. Run per-marker tests, if requested
-        completed_marker_chromosomes = []
+            chromosome_prefixes = [tarball_prefix for tarball_prefix in self._association_pack.tarball_prefixes
+                                   if exists(tarball_prefix + "." + chromosome + ".SAIGE.bcf")]
+            if len(chromosome_prefixes) == 0:
+                continue
+            if self._association_pack.combine_masks:
+                build = partial(self._prep_combined_saige_inputs, chromosome_prefixes, chromosome)
+                mask_inputs = [(COMBINED_MASK_PREFIX, chromosome_prefixes, build)]
+            else:
+                mask_inputs = [(tarball_prefix, [tarball_prefix],
+                                partial(self._prep_saige_inputs, tarball_prefix, chromosome))
+                               for tarball_prefix in chromosome_prefixes]
+            for file_prefix, tarball_prefixes, build in mask_inputs:
+                inputs_ready = task_graph.add_task(('step_two_inputs', file_prefix, chromosome),
+                                                   self._association_pack.derived_cache.load_or_build,
+                                                   memory=self._estimate_memory('saige.step_two_inputs'),
+                                                   job=self._describe_job('saige.step_two_inputs', chromosome,
+                                                                          tarball_prefixes),
+                                                   artifact='saige_inputs',
+                                                   tarball_prefixes=tarball_prefixes,
+                                                   chromosome=chromosome,
+                                                   files={saige_file: f'{file_prefix}.{chromosome}.{saige_file}'
+                                                          for saige_file in SAIGE_STEP_TWO_FILES},
+                                                   build=build,
+                                                   options={'combine_masks': file_prefix == COMBINED_MASK_PREFIX})
+
+                # 3. Run SAIGE step two (single-threaded) for every phenotype and read its output
+                for phenoname in self._association_pack.pheno_names:
+                    step_two = task_graph.add_task(('step_two', file_prefix, chromosome, phenoname),
+                                                   self._saige_step_two,
+                                                   dependencies=[step_one[phenoname], inputs_ready],
+                                                   memory=self._estimate_memory('saige.step_two'),
+                                                   job=self._describe_job('saige.step_two', chromosome,
+                                                                          tarball_prefixes),
+                                                   checkpoint=self._checkpoint(
+                                                       {'SAIGE.gene.txt': f'{file_prefix}.{chromosome}.{phenoname}.'
+                                                                          f'SAIGE_OUT.SAIGE.gene.txt',
+                                                        'SAIGE_step2.log': f'{file_prefix}.{chromosome}.{phenoname}.'
+                                                                           f'SAIGE_step2.log'},
+                                                       tarball_prefixes),
+                                                   tarball_prefix=file_prefix,
+                                                   chromosome=chromosome,
+                                                   phenoname=phenoname)
+                    task_graph.add_task(('parse', file_prefix, chromosome, phenoname),
+                                        self._read_saige_output,
+                                        dependencies=[step_two],
+                                        checkpoint=self._checkpoint(tarball_prefixes=tarball_prefixes,
+                                                                    save_result=True),
+                                        tarball_prefix=file_prefix,
+                                        chromosome=chromosome,
+                                        phenoname=phenoname,
+                                        mask_prefixes=tarball_prefixes)
+                    step_two_runs.append((file_prefix, chromosome, phenoname))
+
+        # 4. Run per-marker tests, if requested. bgen filtering is phenotype-independent, so do it once per chromosome
+        # and then test every phenotype against it. Each chromosome's results are annotated as soon as they are ready.
+        marker_spills = {}
         if self._association_pack.run_marker_tests:
-            print("Running per-marker tests...")
-            thread_utility = ThreadUtility(self._association_pack.threads,
-                                           error_message='A SAIGE marker thread failed',
-                                           incrementor=1,
-                                           thread_factor=4)
-
+            marker_spills = {phenoname: MarkerSpill(self._annotation_engine,
+                                                    self._get_parquet_path(self._get_output_prefix(phenoname) +
+                                                                           '.markers.SAIGE.stats.tsv.gz'))
+                             for phenoname in self._association_pack.pheno_names}
             for chromosome in get_chromosomes():
-                thread_utility.launch_job(class_type=self._saige_marker_run,
-                                          chromosome=chromosome)
-                completed_marker_chromosomes.append(chromosome)
-
-            future_results = thread_utility.collect_futures()
-            markers_log_file = open(self._output_prefix + '.SAIGE_markers.log', 'w')
-            for result in future_results:
-                finished_chromosome = result
-                markers_log_file.write(f'{finished_chromosome + ".log":{"-"}^{50}}')
-                with open(finished_chromosome + ".SAIGE_markers.log", 'r') as current_log:
-                    for line in current_log:
-                        markers_log_file.write(line)
-                    current_log.close()
-            markers_log_file.close()
-
-        # 5. Process final results
+                bgen_ready = task_graph.add_task(('bgen', chromosome),
+                                                 process_bgen_file,
+                                                 threads=4,
+                                                 memory=self._estimate_memory('saige.bgen'),
+                                                 job=self._describe_job('saige.bgen', chromosome),
+                                                 chrom_bgen_index=self._association_pack.bgen_dict[chromosome],
+                                                 chromosome=chromosome)
+                for phenoname in self._association_pack.pheno_names:
+                    markers = task_graph.add_task(('markers', chromosome, phenoname),
+                                                  self._saige_marker_run,
+                                                  dependencies=[step_one[phenoname], bgen_ready],
+                                                  threads=4,
+                                                  memory=self._estimate_memory('saige.markers'),
+                                                  job=self._describe_job('saige.markers', chromosome),
+                                                  checkpoint=self._checkpoint(
+                                                      {'SAIGE.markers.txt': f'{chromosome}.{phenoname}.SAIGE_OUT.'
+                                                                            f'SAIGE.markers.txt',
+                                                       'SAIGE_markers.log': f'{chromosome}.{phenoname}.'
+                                                                            f'SAIGE_markers.log'}),
+                                                  chromosome=chromosome,
+                                                  phenoname=phenoname)
+                    # Annotation reads the VEP table downloaded with the bgen, so depends on it too (and so a resumed
+                    # run does not skip the bgen when the marker tests were restored from checkpoints)
+                    task_graph.add_task(('annotate_markers', chromosome, phenoname),
+                                        self._spill_saige_markers,
+                                        dependencies=[markers, bgen_ready],
+                                        marker_spill=marker_spills[phenoname],
+                                        chromosome=chromosome,
+                                        phenoname=phenoname)
+
+        # Logs are streamed into each phenotype's combined logs as the runs finish (see _append_saige_log())
+        log_files = {phenoname: open(self._get_output_prefix(phenoname) + '.SAIGE_step2.log', 'w')
+                     for phenoname in self._association_pack.pheno_names}
+        markers_log_files = {}
+        if self._association_pack.run_marker_tests:
+            markers_log_files = {phenoname: open(self._get_output_prefix(phenoname) + '.SAIGE_markers.log', 'w')
+                                 for phenoname in self._association_pack.pheno_names}
+
+        print("Running SAIGE tasks...")
+        self._start_stage('saige.tasks')
+        task_results = task_graph.run(on_finish=partial(self._append_saige_log, log_files, markers_log_files))
+        for log_file in list(log_files.values()) + list(markers_log_files.values()):
+            log_file.close()
+        # Null models restored from a checkpoint did not go through the null model store, so add them to the bundle here
+        for phenoname in self._association_pack.pheno_names:
+            self._association_pack.null_model_store.mark_used('saige', [phenoname], self._association_pack.pheno_names,
+                                                              step_one_files[phenoname])
+
+        # 5. Gather preliminary results (already parsed as each run finished)
+        print("Gathering SAIGE mask-based results...")
+        self._start_stage('saige.gather')
+        completed_gene_tables = {phenoname: [] for phenoname in self._association_pack.pheno_names}
+        for file_prefix, chromosome, phenoname in step_two_runs:
+            completed_gene_tables[phenoname].extend(task_results[('parse', file_prefix, chromosome, phenoname)])
+
+        # 6. Process final results
         print("Processing final SAIGE output...")
-        self._outputs.extend(self._annotate_saige_output(completed_gene_tables, completed_marker_chromosomes))
+        self._start_stage('saige.annotate')
+        for phenoname in self._association_pack.pheno_names:
+            self._outputs.extend(self._annotate_saige_output(completed_gene_tables[phenoname],
+                                                             marker_spills.get(phenoname),
+                                                             phenoname))
+
+    # Called by the task graph as each task finishes: append step 2 and per-marker logs to the phenotype's combined logs
+    def _append_saige_log(self, log_files: Dict[str, IO], markers_log_files: Dict[str, IO], task_name: tuple,
+                          result: Any) -> None:
+
+        if task_name[0] == 'step_two':
+            _, tarball_prefix, chromosome, phenoname = task_name
+            self._append_log(log_files[phenoname], f'{tarball_prefix + "-" + chromosome:{"-"}^{50}}',
+                             f'{tarball_prefix}.{chromosome}.{phenoname}.SAIGE_step2.log')
+        elif task_name[0] == 'markers':
+            _, chromosome, phenoname = task_name
+            self._append_log(markers_log_files[phenoname], f'{chromosome + ".log":{"-"}^{50}}',
+                             f'{chromosome}.{phenoname}.SAIGE_markers.log')
 
     # Run rare variant association testing using SAIGE-GENE
-    def _saige_step_one(self) -> None:
+    def _saige_step_one(self, phenoname: str) -> None:
 
         # See the README.md for more information on these parameters
         # Just to note – I previously tried to implement the method that includes variance ratio estimation. However,
@@ -80,10 +196,10 @@ class SAIGERunner(ToolRunner):
         # documentation includes this step, but I am very unsure how it works...
         cmd = 'step1_fitNULLGLMM.R ' \
                     '--phenoFile=/test/phenotypes_covariates.formatted.txt ' \
-                    f'--phenoCol={self._association_pack.pheno_names[0]} ' \
+                    f'--phenoCol={phenoname} ' \
                     '--isCovariateTransform=FALSE ' \
                     '--sampleIDColinphenoFile=IID ' \
-                    f'--outputPrefix=/test/{self._association_pack.pheno_names[0]}.SAIGE_OUT ' \
+                    f'--outputPrefix=/test/{phenoname}.SAIGE_OUT ' \
                     '--sparseGRMFile=/test/genetics/sparseGRM_470K_Autosomes_QCd.sparseGRM.mtx ' \
                     '--sparseGRMSampleIDFile=/test/genetics/sparseGRM_470K_Autosomes_QCd.sparseGRM.mtx.sampleIDs.txt ' \
                     f'--nThreads={str(self._association_pack.threads)} ' \
@@ -112,35 +228,61 @@ class SAIGERunner(ToolRunner):
             cmd = cmd + '--qCovarColList=wes_batch '
         cmd = cmd + '--covarColList=' + ','.join(all_covariates)
 
-        run_cmd(cmd, True, self._output_prefix + ".SAIGE_step1.log", print_cmd=True)
+        run_cmd(cmd, True, self._get_output_prefix(phenoname) + ".SAIGE_step1.log", print_cmd=True)
+
+    # Step 2 needs a v1.0 group file and a sample-subset (indexed) bcf for every mask / chromosome
+    def _prep_saige_inputs(self, tarball_prefix: str, chromosome: str) -> None:
+        self._prep_group_file(tarball_prefix, chromosome)
+        self._prep_saige_bcf(tarball_prefix, chromosome)
+
+    # ... or, with --combine_masks, a single group file and bcf covering every mask on the chromosome
+    def _prep_combined_saige_inputs(self, tarball_prefixes: List[str], chromosome: str) -> None:
+        self._prep_combined_group_file(tarball_prefixes, chromosome)
+        self._prep_combined_saige_bcf(tarball_prefixes, chromosome)
 
     # This exists for a very stupid reason – they _heavily_ modified the groupFile for v1.0 and I haven't gone back
     # to change how this file is made in 'collapse variants'
     @staticmethod
     def _prep_group_file(tarball_prefix: str, chromosome: str) -> None:
 
-        with open(tarball_prefix + '.' + chromosome + '.SAIGE.groupFile.txt', 'r') as group_file:
-            modified_group = open(tarball_prefix + '.' + chromosome + '.SAIGE_v1.0.groupFile.txt', 'w')
+        with open(tarball_prefix + '.' + chromosome + '.SAIGE.groupFile.txt', 'r') as group_file,\
+                open(tarball_prefix + '.' + chromosome + '.SAIGE_v1.0.groupFile.txt', 'w') as modified_group:
             for line in group_file:
                 data = line.rstrip().split('\t')
-                mod_data = [data[0], 'var']
-                found = set()
-                for var in data[1:]:
-                    var = var.translate(str.maketrans('_/', '::'))
-                    if var not in found:
-                        mod_data.append(var)
-                        found.add(var)
-                modified_group.writelines(' '.join(mod_data) + "\n")
-                mod_annote = [data[0], 'anno']
-                for i in range(2, len(mod_data)):
-                    mod_annote.append('foo')
-                modified_group.write(' '.join(mod_annote) + "\n")
-            group_file.close()
-            modified_group.close()
+                modified_group.write(SAIGERunner._format_group(data[0], data[1:]))
 
-    # This is a helper function to parallelise SAIGE step 2 by chromosome
-    # This returns the tarball_prefix and chromosome number to make it easier to generate output
-    def _saige_step_two(self, tarball_prefix: str, chromosome: str) -> tuple:
+    # Convert one gene from the old groupFile format into a v1.0 'var' / 'anno' line pair named 'region_name'
+    @staticmethod
+    def _format_group(region_name: str, variants: List[str]) -> str:
+
+        mod_data = [region_name, 'var']
+        found = set()
+        for var in variants:
+            var = var.translate(str.maketrans('_/', '::'))
+            if var not in found:
+                mod_data.append(var)
+                found.add(var)
+        mod_annote = [region_name, 'anno'] + ['foo'] * (len(mod_data) - 2)
+        return ' '.join(mod_data) + "\n" + ' '.join(mod_annote) + "\n"
+
+    # With --combine_masks every gene in every mask on this chromosome becomes its own region named
+    # '<ENST>.<mask number>' (the index of the mask in this chromosome's tarball_prefixes, which is what the derived
+    # cache and checkpoints are keyed on), so that one SAIGE run tests every gene x mask pair exactly as separate runs
+    # would, and the results can be split back out by mask afterwards.
+    @staticmethod
+    def _prep_combined_group_file(tarball_prefixes: List[str], chromosome: str) -> None:
+
+        with open(f'{COMBINED_MASK_PREFIX}.{chromosome}.SAIGE_v1.0.groupFile.txt', 'w') as combined_group:
+            for mask_number, tarball_prefix in enumerate(tarball_prefixes):
+                with open(tarball_prefix + '.' + chromosome + '.SAIGE.groupFile.txt', 'r') as group_file:
+                    for line in group_file:
+                        data = line.rstrip().split('\t')
+                        combined_group.write(SAIGERunner._format_group(f'{data[0]}.{mask_number}', data[1:]))
+
+    # Subset the mask bcf to only the samples we are testing. This does not depend on phenotype, so only do it once
+    # per tarball / chromosome
+    @staticmethod
+    def _prep_saige_bcf(tarball_prefix: str, chromosome: str) -> None:
 
         cmd = f'bcftools view --threads 1 -S /test/SAMPLES_Include.txt -Ob ' \
               f'-o /test/{tarball_prefix}.{chromosome}.saige_input.bcf ' \
@@ -148,16 +290,34 @@ class SAIGERunner(ToolRunner):
         run_cmd(cmd, True)
         cmd = f'bcftools index --threads 1 /test/{tarball_prefix}.{chromosome}.saige_input.bcf'
         run_cmd(cmd, True)
-        
+
+    # Merge every mask bcf on this chromosome (the same variant in two masks has the same genotypes, so duplicates
+    # are dropped) and then subset the merged bcf to only the samples we are testing
+    @staticmethod
+    def _prep_combined_saige_bcf(tarball_prefixes: List[str], chromosome: str) -> None:
+
+        for tarball_prefix in tarball_prefixes:
+            cmd = f'bcftools index --threads 1 -f /test/{tarball_prefix}.{chromosome}.SAIGE.bcf'
+            run_cmd(cmd, True)
+        cmd = f'bcftools concat --threads 1 --allow-overlaps --rm-dups exact -Ob ' \
+              f'-o /test/{COMBINED_MASK_PREFIX}.{chromosome}.SAIGE.bcf ' + \
+              ' '.join(f'/test/{tarball_prefix}.{chromosome}.SAIGE.bcf' for tarball_prefix in tarball_prefixes)
+        run_cmd(cmd, True)
+        SAIGERunner._prep_saige_bcf(COMBINED_MASK_PREFIX, chromosome)
+
+    # This is a helper function to parallelise SAIGE step 2 by chromosome
+    # This returns the tarball_prefix, chromosome number, and phenotype to make it easier to generate output
+    def _saige_step_two(self, tarball_prefix: str, chromosome: str, phenoname: str) -> tuple:
+
         # See the README.md for more information on these parameters
         cmd = 'step2_SPAtests.R ' \
               f'--vcfFile=/test/{tarball_prefix}.{chromosome}.saige_input.bcf ' \
               '--vcfField=GT ' \
-              f'--GMMATmodelFile=/test/{self._association_pack.pheno_names[0]}.SAIGE_OUT.rda ' \
+              f'--GMMATmodelFile=/test/{phenoname}.SAIGE_OUT.rda ' \
               '--sparseGRMFile=/test/genetics/sparseGRM_470K_Autosomes_QCd.sparseGRM.mtx ' \
               '--sparseGRMSampleIDFile=/test/genetics/sparseGRM_470K_Autosomes_QCd.sparseGRM.mtx.sampleIDs.txt ' \
               '--LOCO=FALSE ' \
-              f'--SAIGEOutputFile=/test/{tarball_prefix}.{chromosome}.SAIGE_OUT.SAIGE.gene.txt ' \
+              f'--SAIGEOutputFile=/test/{tarball_prefix}.{chromosome}.{phenoname}.SAIGE_OUT.SAIGE.gene.txt ' \
               f'--groupFile=/test/{tarball_prefix}.{chromosome}.SAIGE_v1.0.groupFile.txt ' \
               '--is_output_moreDetails=TRUE ' \
               '--maxMAF_in_groupTest=0.5 ' \
@@ -168,109 +328,122 @@ class SAIGERunner(ToolRunner):
         if self._association_pack.is_binary:
             cmd = cmd + '--is_Firth_beta=TRUE'
 
-        run_cmd(cmd, True, tarball_prefix + "." + chromosome + ".SAIGE_step2.log")
-
-        return tarball_prefix, chromosome
+        run_cmd(cmd, True, f'{tarball_prefix}.{chromosome}.{phenoname}.SAIGE_step2.log')
 
-    def _saige_marker_run(self, chromosome: str) -> str:
+        return tarball_prefix, chromosome, phenoname
 
-        process_bgen_file(self._association_pack.bgen_dict[chromosome], chromosome)
+    def _saige_marker_run(self, chromosome: str, phenoname: str) -> tuple:
 
         cmd = 'step2_SPAtests.R ' \
               f'--bgenFile=/test/{chromosome}.markers.bgen ' \
               f'--bgenFileIndex=/test/{chromosome}.markers.bgen.bgi ' \
               f'--sampleFile=/test/{chromosome}.markers.bolt.sample ' \
-              f'--GMMATmodelFile=/test/{self._association_pack.pheno_names[0]}.SAIGE_OUT.rda ' \
+              f'--GMMATmodelFile=/test/{phenoname}.SAIGE_OUT.rda ' \
               '--sparseGRMFile=/test/genetics/sparseGRM_470K_Autosomes_QCd.sparseGRM.mtx ' \
               '--sparseGRMSampleIDFile=/test/genetics/sparseGRM_470K_Autosomes_QCd.sparseGRM.mtx.sampleIDs.txt ' \
-              f'--SAIGEOutputFile=/test/{chromosome}.SAIGE_OUT.SAIGE.markers.txt ' \
+              f'--SAIGEOutputFile=/test/{chromosome}.{phenoname}.SAIGE_OUT.SAIGE.markers.txt ' \
               '--LOCO=FALSE ' \
               '--is_output_moreDetails=TRUE ' \
               '--maxMissing=1 '
         if self._association_pack.is_binary:
             cmd = cmd + '--is_Firth_beta=TRUE'
-        run_cmd(cmd, True, chromosome + ".SAIGE_markers.log")
+        run_cmd(cmd, True, f'{chromosome}.{phenoname}.SAIGE_markers.log')
 
-        return chromosome
+        return chromosome, phenoname
 
-    def _process_saige_output(self, tarball_prefix: str, chromosome: str) -> pandas.DataFrame:
+    # The raw table is read (without the 'Group' and 'max_MAF' columns) in _read_saige_output()
+    @staticmethod
+    def _process_saige_output(tarball_prefix: str, saige_table: pandas.DataFrame) -> pandas.DataFrame:
 
-        # Load the raw table
-        saige_table = pd.read_csv(tarball_prefix + "." + chromosome + ".SAIGE_OUT.SAIGE.gene.txt", sep='\t')
         saige_table = saige_table.rename(columns={'Region': 'ENST'})
-        saige_table = saige_table.drop(columns=['Group', 'max_MAF'])
 
         # Get column names for Mask/MAF information if possible
         saige_table = define_field_names_from_tarball_prefix(tarball_prefix, saige_table)
 
         return saige_table
 
-    def _annotate_saige_output(self, completed_gene_tables: list, completed_marker_chromosomes: list) -> list:
+    # Read and process the step 2 output of one run. The raw table is read without the 'Group' and 'max_MAF' columns.
+    # 'mask_prefixes' are the masks the run's inputs were built from, in the same order.
+    def _read_saige_output(self, tarball_prefix: str, chromosome: str, phenoname: str,
+                           mask_prefixes: List[str]) -> List[pandas.DataFrame]:
+
+        saige_table = read_table(f'{tarball_prefix}.{chromosome}.{phenoname}.SAIGE_OUT.SAIGE.gene.txt',
+                                 sep='\t',
+                                 drop=['Group', 'max_MAF'])
+        if tarball_prefix == COMBINED_MASK_PREFIX:
+            return self._split_combined_saige_output(saige_table, mask_prefixes)
+        else:
+            return [self._process_saige_output(tarball_prefix, saige_table)]
+
+    # Split a combined (--combine_masks) result table back into one table per mask using the '<ENST>.<mask number>'
+    # region names (mask numbers index 'mask_prefixes'), and process each as if it came from its own run
+    @staticmethod
+    def _split_combined_saige_output(saige_table: pandas.DataFrame,
+                                     mask_prefixes: List[str]) -> List[pandas.DataFrame]:
+
+        region_parts = saige_table['Region'].str.rsplit('.', n=1, expand=True)
+        saige_table = saige_table.assign(Region=region_parts[0])
+        mask_numbers = region_parts[1].astype(int)
+
+        mask_tables = []
+        for mask_number, mask_table in saige_table.groupby(mask_numbers, sort=True):
+            tarball_prefix = mask_prefixes[mask_number]
+            mask_tables.append(SAIGERunner._process_saige_output(tarball_prefix, mask_table.reset_index(drop=True)))
+        return mask_tables
 
+    def _annotate_saige_output(self, completed_gene_tables: list, marker_spill: Optional[MarkerSpill],
+                               phenoname: str) -> list:
+
+        output_prefix = self._get_output_prefix(phenoname)
         saige_table = pd.concat(completed_gene_tables)
 
         # Now process the gene table into a useable format:
         # First read in the transcripts file
-        transcripts_table = build_transcript_table()
+        transcripts_table = self._annotation_engine.get_transcripts()
 
         # Now merge the transcripts table into the gene table to add annotation and the write
         saige_table = pd.merge(transcripts_table, saige_table, on='ENST', how="left")
-        with open(self._output_prefix + '.genes.SAIGE.stats.tsv', 'w') as gene_out:
+        with self._open_indexed_output(output_prefix + '.genes.SAIGE.stats.tsv.gz', end_col=4) as gene_out:
 
             # Sort just in case
             saige_table = saige_table.sort_values(by=['chrom', 'start', 'end'])
 
             saige_table.to_csv(path_or_buf=gene_out, index=False, sep="\t", na_rep='NA')
-            gene_out.close()
 
-            # And bgzip and tabix...
-            cmd = "bgzip /test/" + self._output_prefix + '.genes.SAIGE.stats.tsv'
-            run_cmd(cmd, True)
-            cmd = "tabix -S 1 -s 2 -b 3 -e 4 /test/" + self._output_prefix + '.genes.SAIGE.stats.tsv.gz'
-            run_cmd(cmd, True)
-
-        outputs = [self._output_prefix + '.SAIGE_step1.log',
-                   self._output_prefix + '.SAIGE_step2.log',
-                   self._output_prefix + '.genes.SAIGE.stats.tsv.gz',
-                   self._output_prefix + '.genes.SAIGE.stats.tsv.gz.tbi']
+        outputs = [output_prefix + '.SAIGE_step1.log',
+                   output_prefix + '.SAIGE_step2.log',
+                   output_prefix + '.genes.SAIGE.stats.tsv.gz',
+                   output_prefix + '.genes.SAIGE.stats.tsv.gz.tbi']
+        outputs.extend(self._write_parquet_output(output_prefix + '.genes.SAIGE.stats.tsv.gz', saige_table))
 
         if self._association_pack.run_marker_tests:
 
-            variant_index = []
-            saige_table_marker = []
-            # Open all chromosome indicies and load them into a list and append them together
-            for chromosome in completed_marker_chromosomes:
-                variant_index.append(pd.read_csv(f'filtered_bgen/{chromosome}.filtered.vep.tsv.gz',
-                                                 sep="\t",
-                                                 dtype={'SIFT': str, 'POLYPHEN': str}))
-                saige_table_marker.append(pd.read_csv(chromosome + ".SAIGE_OUT.SAIGE.markers.txt", sep="\t"))
-
-            variant_index = pd.concat(variant_index)
-            variant_index = variant_index.set_index('varID')
-
-            saige_table_marker = pd.concat(saige_table_marker)
-
-            # For markers, we can use the SNP ID column to get what we need
-            saige_table_marker = saige_table_marker.rename(columns={'MarkerID': 'varID',
-                                                                    'AC_Allele2': 'SAIGE_AC',
-                                                                    'AF_Allele2': 'SAIGE_MAF'})
-            saige_table_marker = saige_table_marker.drop(columns=['CHR', 'POS', 'Allele1', 'Allele2', 'MissingRate'])
-            saige_table_marker = pd.merge(variant_index, saige_table_marker, on='varID', how="left")
-            with open(self._output_prefix + '.markers.SAIGE.stats.tsv', 'w') as marker_out:
-                # Sort by chrom/pos just to be sure...
-                saige_table_marker = saige_table_marker.sort_values(by=['CHROM', 'POS'])
-
-                saige_table_marker.to_csv(path_or_buf=marker_out, index=False, sep="\t", na_rep='NA')
-                marker_out.close()
-
-                # And bgzip and tabix...
-                cmd = "bgzip /test/" + self._output_prefix + '.markers.SAIGE.stats.tsv'
-                run_cmd(cmd, True)
-                cmd = "tabix -S 1 -s 2 -b 3 -e 3 /test/" + self._output_prefix + '.markers.SAIGE.stats.tsv.gz'
-                run_cmd(cmd, True)
-
-            outputs.append([self._output_prefix + '.markers.SAIGE.stats.tsv.gz',
-                            self._output_prefix + '.markers.SAIGE.stats.tsv.gz.tbi',
-                            self._output_prefix + '.SAIGE_markers.log'])
+            # Markers were annotated one chromosome at a time as their tests finished, so just need writing out
+            with self._open_indexed_output(output_prefix + '.markers.SAIGE.stats.tsv.gz', end_col=3) as marker_out:
+                marker_spill.write(marker_out)
+
+            outputs.extend([output_prefix + '.markers.SAIGE.stats.tsv.gz',
+                            output_prefix + '.markers.SAIGE.stats.tsv.gz.tbi',
+                            output_prefix + '.SAIGE_markers.log'])
+            if self._association_pack.parquet_outputs:
+                outputs.append(self._get_parquet_path(output_prefix + '.markers.SAIGE.stats.tsv.gz'))
 
         return outputs
+
+    # Annotate one chromosome's per-marker results as soon as its tests finish
+    def _spill_saige_markers(self, marker_spill: MarkerSpill, chromosome: str, phenoname: str) -> None:
+        marker_spill.add(chromosome, self._load_saige_markers(chromosome, phenoname))
+
+    # Load per-marker results for one chromosome, ready to be joined to the VEP annotation
+    @staticmethod
+    def _load_saige_markers(chromosome: str, phenoname: str) -> pd.DataFrame:
+
+        saige_table_marker = read_table(f'{chromosome}.{phenoname}.SAIGE_OUT.SAIGE.markers.txt',
+                                        sep='\t',
+                                        drop=['CHR', 'POS', 'Allele1', 'Allele2', 'MissingRate'])
+
+        # For markers, we can use the SNP ID column to get what we need
+        saige_table_marker = saige_table_marker.rename(columns={'MarkerID': 'varID',
+                                                                'AC_Allele2': 'SAIGE_AC',
+                                                                'AF_Allele2': 'SAIGE_MAF'})
+        return saige_table_marker
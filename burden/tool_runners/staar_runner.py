@@ -1,5 +1,7 @@
+from functools import partial
 from os.path import exists
 
+from burden.staar_pool import STAARWorkerPool
 from burden.tool_runners.tool_runner import ToolRunner
 from general_utilities.association_resources import *
 from general_utilities.linear_model.proccess_model_output import process_staar_outputs
@@ -11,39 +13,80 @@ class STAARRunner(ToolRunner):
 
     def run_tool(self) -> None:
 
-        # 1. Run the STAAR NULL model
-        print("Running STAAR Null Model...")
-        staar_null(phenoname=self._association_pack.pheno_names[0],
-                   is_binary=self._association_pack.is_binary,
-                   found_quantitative_covariates=self._association_pack.found_quantitative_covariates,
-                   found_categorical_covariates=self._association_pack.found_categorical_covariates)
+        task_graph = self._new_task_graph('A STAAR task failed')
+        gene_tasks = []
+        null_files = {}
 
-        # 2. Run the actual per-gene association tests
-        print("Running STAAR masks * chromosomes...")
-        thread_utility = ThreadUtility(self._association_pack.threads,
-                                       error_message='A STAAR thread failed',
-                                       incrementor=10,
-                                       thread_factor=1)
+        # With --staar_worker_pool, gene tests run on long-lived R workers (one per thread), not a new Rscript each
+        staar_pool = None
+        run_genes = partial(staar_genes, has_gene_info=False)
+        if self._association_pack.staar_worker_pool:
+            job_timeout = self._association_pack.staar_job_timeout_hours
+            staar_pool = STAARWorkerPool(self._association_pack.threads,
+                                         None if job_timeout is None else job_timeout * 60 * 60)
+            run_genes = staar_pool.run_genes
 
+        # 1. Run the STAAR NULL model (one per phenotype in batch mode)
         for phenoname in self._association_pack.pheno_names:
+            null_files[phenoname] = {'STAAR_null.rds': f'{phenoname}.STAAR_null.rds'}
+            null_ready = task_graph.add_task(
+                ('null', phenoname),
+                self._association_pack.null_model_store.load_or_fit,
+                memory=self._estimate_memory('staar.null'),
+                job=self._describe_job('staar.null'),
+                checkpoint=self._null_model_checkpoint('staar', [phenoname], null_files[phenoname]),
+                tool='staar',
+                phenonames=[phenoname],
+                all_phenonames=self._association_pack.pheno_names,
+                files=null_files[phenoname],
+                fit=partial(staar_null,
+                            phenoname=phenoname,
+                            is_binary=self._association_pack.is_binary,
+                            found_quantitative_covariates=self._association_pack.found_quantitative_covariates,
+                            found_categorical_covariates=self._association_pack.found_categorical_covariates))
+
+            # 2. Run the actual per-gene association tests once the phenotype's null model is ready
             for tarball_prefix in self._association_pack.tarball_prefixes:
                 for chromosome in get_chromosomes():
                     if exists(tarball_prefix + "." + chromosome + ".STAAR.matrix.rds"):
-                        thread_utility.launch_job(staar_genes,
-                                                  tarball_prefix=tarball_prefix,
-                                                  chromosome=chromosome,
-                                                  phenoname=phenoname,
-                                                  has_gene_info=False)
+                        gene_tasks.append(task_graph.add_task(
+                            ('genes', phenoname, tarball_prefix, chromosome),
+                            run_genes,
+                            dependencies=[null_ready],
+                            memory=self._estimate_memory('staar.genes'),
+                            job=self._describe_job('staar.genes', chromosome, [tarball_prefix]),
+                            checkpoint=self._checkpoint({'STAAR_results.tsv': f'{tarball_prefix}.{phenoname}.'
+                                                                              f'{chromosome}.STAAR_results.tsv'},
+                                                        [tarball_prefix],
+                                                        save_result=True),
+                            tarball_prefix=tarball_prefix,
+                            chromosome=chromosome,
+                            phenoname=phenoname))
 
-        future_results = thread_utility.collect_futures()
+        print("Running STAAR null models and masks * chromosomes...")
+        self._start_stage('staar.tasks')
+        try:
+            task_results = task_graph.run()
+        finally:
+            if staar_pool is not None:
+                staar_pool.close()
+        # Null models restored from a checkpoint did not go through the null model store, so add them to the bundle here
+        for phenoname in self._association_pack.pheno_names:
+            self._association_pack.null_model_store.mark_used('staar', [phenoname], self._association_pack.pheno_names,
+                                                              null_files[phenoname])
+        future_results = [task_results[gene_task] for gene_task in gene_tasks]
 
         # 3. Print a preliminary STAAR output
         print("Finalising STAAR outputs...")
-        completed_staar_files = []
+        self._start_stage('staar.finalise')
+        completed_staar_files = {phenoname: [] for phenoname in self._association_pack.pheno_names}
         # And gather the resulting futures
         for result in future_results:
             tarball_prefix, finished_chromosome, phenoname = result
-            completed_staar_files.append(f'{tarball_prefix}.{phenoname}.{finished_chromosome}.STAAR_results.tsv')
+            completed_staar_files[phenoname].append(f'{tarball_prefix}.{phenoname}.{finished_chromosome}.'
+                                                    f'STAAR_results.tsv')
 
         # 4. Annotate and print final STAAR output
-        self._outputs.extend(process_staar_outputs(completed_staar_files, self._output_prefix))
+        for phenoname in self._association_pack.pheno_names:
+            self._outputs.extend(self._add_parquet_outputs(process_staar_outputs(completed_staar_files[phenoname],
+                                                                                 self._get_output_prefix(phenoname))))
@@ -1,7 +1,43 @@
+import shutil
 from abc import ABC, abstractmethod
-from typing import List
+from pathlib import Path
+from typing import Dict, IO, Iterable, List, Optional, Tuple
 
+import pandas as pd
+
+from burden.annotation import AnnotationEngine
+from burden.bgzf import BGZFWriter
 from burden.burden_ingester import BurdenAssociationPack
+from burden.checkpoint import Checkpoint
+from burden.output_parser import read_table
+from burden.parquet_writer import ParquetTableWriter
+from burden.profiler import PROFILER
+from burden.tabix import TabixIndex
+from burden.task_graph import TaskGraph
+
+# Stands in for a tarball prefix in the names of per-chromosome files that cover every mask (--combine_masks)
+COMBINED_MASK_PREFIX = 'combined_masks'
+
+# Estimated peak memory (in GiB) of the memory-heavy steps when testing the full UK Biobank WES cohort
+# (FULL_COHORT_SAMPLES), used as each task's memory request to the TaskGraph. Requests scale linearly with the number
+# of samples tested, down to a floor of MIN_MEMORY_FRACTION of the estimate for fixed costs (loading the tool, sparse
+# GRM headers, etc.). Steps not listed here (parsing, mask files, annotation) need little and request nothing.
+TASK_MEMORY_GB = {'saige.step_one': 24,
+                  'saige.step_two_inputs': 2,
+                  'saige.step_two': 8,
+                  'saige.bgen': 4,
+                  'saige.markers': 8,
+                  'regenie.step_one': 32,
+                  'regenie.bgen': 4,
+                  'regenie.step_two': 8,
+                  'regenie.markers': 8,
+                  'staar.null': 16,
+                  'staar.genes': 6,
+                  'bolt.dosage': 4,
+                  'bolt.masks': 4,
+                  'bolt.bgen': 4}
+FULL_COHORT_SAMPLES = 470000
+MIN_MEMORY_FRACTION = 0.25
 
 
 class ToolRunner(ABC):
@@ -10,10 +46,179 @@ class ToolRunner(ABC):
         self._association_pack = association_pack
         self._output_prefix = output_prefix
         self._outputs = []
+        # Shared by every phenotype so transcript / VEP annotations are only loaded once
+        self._annotation_engine = AnnotationEngine(association_pack.threads)
+        # Filled in as needed by _get_sample_count()
+        self._sample_count = None
+        self._mask_sizes: Dict[Tuple[str, str], Tuple[Optional[int], Optional[int], int]] = {}
+        # The stage of run_tool() currently being profiled
+        self._current_stage = None
 
     def get_outputs(self) -> List[str]:
         return self._outputs
 
+    # When more than one phenotype is provided (batch mode), genotype data is prepared once and shared, but every
+    # phenotype gets its own set of outputs named like <output_prefix>.<phenoname>.*
+    def _get_output_prefix(self, phenoname: str) -> str:
+        if len(self._association_pack.pheno_names) == 1:
+            return self._output_prefix
+        else:
+            return f'{self._output_prefix}.{phenoname}'
+
+    # Open a bgzipped, tabix-indexed output table. Rows are compressed as they are written and the .tbi is written on
+    # close(), giving the same files as writing a tsv and running 'bgzip' and 'tabix -S 1 -s 2 -b 3 -e <end_col>'.
+    # Gene tables use start/end (end_col = 4), marker tables a single position (end_col = 3).
+    def _open_indexed_output(self, path: str, end_col: int) -> BGZFWriter:
+        return BGZFWriter(path, threads=self._association_pack.threads,
+                          index=TabixIndex(seq_col=2, begin_col=3, end_col=end_col, skip_lines=1))
+
+    # Path of the Parquet copy of an output table (<prefix>.stats.tsv.gz -> <prefix>.stats.parquet) if --parquet_outputs
+    # was requested, otherwise None
+    def _get_parquet_path(self, tsv_path: str) -> Optional[str]:
+        if not self._association_pack.parquet_outputs:
+            return None
+        return tsv_path[:-len('.tsv.gz')] + '.parquet'
+
+    # Write a finished gene table as Parquet (see ParquetTableWriter) if --parquet_outputs was requested. 'tsv_path' is
+    # the table's TSV output. Returns the outputs written.
+    def _write_parquet_output(self, tsv_path: str, table: pd.DataFrame, chromosome_column: str = 'chrom') -> List[str]:
+
+        parquet_path = self._get_parquet_path(tsv_path)
+        if parquet_path is None:
+            return []
+        with ParquetTableWriter(parquet_path, chromosome_column) as parquet_out:
+            parquet_out.write(table)
+        return [parquet_path]
+
+    # Tools whose final tables are written by general_utilities (STAAR, GLM) get Parquet copies made by re-reading each
+    # '*.stats.tsv.gz' output. Returns 'outputs' plus the Parquet outputs written.
+    def _add_parquet_outputs(self, outputs: List[str]) -> List[str]:
+
+        parquet_outputs = []
+        for output in outputs:
+            if self._association_pack.parquet_outputs and output.endswith('.stats.tsv.gz'):
+                table = read_table(output, sep='\t')
+                parquet_outputs.extend(self._write_parquet_output(output, table,
+                                                                  'chrom' if 'chrom' in table.columns else 'CHROM'))
+        return outputs + parquet_outputs
+
+    # Append one run's log to a combined log under a header line. Runners call this from TaskGraph.run()'s 'on_finish'
+    # so that combined logs are written while other runs are still going – sections are in the order runs finished.
+    @staticmethod
+    def _append_log(combined_log: IO, header: str, log_path: str) -> None:
+        combined_log.write(header)
+        with open(log_path, 'r') as current_log:
+            shutil.copyfileobj(current_log, combined_log)
+        combined_log.flush()
+
+    # Mark the start of a stage of run_tool() (e.g. 'saige.annotate') in the profile. The previous stage ends here.
+    def _start_stage(self, stage: str) -> None:
+        self.end_stage()
+        self._current_stage = PROFILER.begin(stage, 'stage')
+
+    def end_stage(self) -> None:
+        if self._current_stage is not None:
+            PROFILER.end(self._current_stage)
+            self._current_stage = None
+
+    # Write the run's profile (see Profiler) and add it to the outputs
+    def write_profile(self) -> None:
+        self._outputs.extend(PROFILER.write(self._output_prefix))
+
+    # A TaskGraph for this tool's steps that orders and records jobs using the run time history, and checkpoints them
+    # if requested
+    def _new_task_graph(self, error_message: str) -> TaskGraph:
+        return TaskGraph(self._association_pack.threads, error_message=error_message,
+                         history=self._association_pack.job_history,
+                         checkpoints=self._association_pack.checkpoint_store)
+
+    # Number of variants and genes (None if not known) and bytes of mask files for one mask and chromosome. Variants and
+    # genes are counted from the STAAR variants table or, for SAIGE, the group file – whichever was extracted.
+    def _get_mask_size(self, tarball_prefix: str, chromosome: str) -> Tuple[Optional[int], Optional[int], int]:
+
+        if (tarball_prefix, chromosome) not in self._mask_sizes:
+            mask_files = list(Path('.').glob(f'{tarball_prefix}.{chromosome}.*'))
+            variants_table = Path(f'{tarball_prefix}.{chromosome}.variants_table.STAAR.tsv')
+            group_file = Path(f'{tarball_prefix}.{chromosome}.SAIGE.groupFile.txt')
+            variants = None
+            genes = None
+            if variants_table.exists():
+                with variants_table.open('r') as variants_file:
+                    gene_column = variants_file.readline().rstrip('\n').split('\t').index('ENST')
+                    gene_ids = set()
+                    variants = 0
+                    for line in variants_file:
+                        gene_ids.add(line.split('\t')[gene_column])
+                        variants += 1
+                    genes = len(gene_ids)
+            elif group_file.exists():
+                # One line per gene: the gene ID and then its variants
+                with group_file.open('r') as group:
+                    genes = 0
+                    variants = 0
+                    for line in group:
+                        genes += 1
+                        variants += len(line.rstrip('\n').split('\t')) - 1
+            self._mask_sizes[(tarball_prefix, chromosome)] = (variants, genes,
+                                                              sum(mask_file.stat().st_size for mask_file in mask_files))
+
+        return self._mask_sizes[(tarball_prefix, chromosome)]
+
+    # Checkpoint (see CheckpointStore) for a null model fit through the null model store, keyed on the null model.
+    # None when checkpointing is off, so the phenotype file is not hashed for nothing.
+    def _null_model_checkpoint(self, tool: str, phenonames: List[str], files: Dict[str, str]) -> Optional[Checkpoint]:
+
+        if not self._association_pack.checkpoint_store.enabled:
+            return None
+        null_model_key = self._association_pack.null_model_store.get_key(tool, phenonames,
+                                                                         self._association_pack.pheno_names)
+        return Checkpoint(files=files, inputs=[null_model_key])
+
+    # Checkpoint for any other task, keyed on the checksums of the tarballs of the masks it reads (if any)
+    def _checkpoint(self, files: Optional[Dict[str, str]] = None, tarball_prefixes: Iterable[str] = (),
+                    save_result: bool = False) -> Optional[Checkpoint]:
+
+        if not self._association_pack.checkpoint_store.enabled:
+            return None
+        return Checkpoint(files={} if files is None else files,
+                          inputs=self._association_pack.derived_cache.get_tarball_keys(list(tarball_prefixes)),
+                          save_result=save_result)
+
+    def _get_sample_count(self) -> int:
+        if self._sample_count is None:
+            with Path('SAMPLES_Include.txt').open('r') as sample_file:
+                self._sample_count = sum(1 for _ in sample_file)
+        return self._sample_count
+
+    # Memory (in bytes) to request for a task running 'step' (see TASK_MEMORY_GB)
+    def _estimate_memory(self, step: str) -> int:
+        if step not in TASK_MEMORY_GB:
+            return 0
+        scale = max(self._get_sample_count() / FULL_COHORT_SAMPLES, MIN_MEMORY_FRACTION)
+        return int(TASK_MEMORY_GB[step] * scale * 1024 ** 3)
+
+    # Describe a job for the run time history (see JobHistory)
+    def _describe_job(self, step: str, chromosome: Optional[str] = None,
+                      tarball_prefixes: Iterable[str] = ()) -> dict:
+
+        job = {'step': step, 'chromosome': chromosome, 'masks': 0, 'variants': None, 'genes': None,
+               'input_bytes': 0, 'samples': self._get_sample_count()}
+        for tarball_prefix in tarball_prefixes:
+            variants, genes, input_bytes = self._get_mask_size(tarball_prefix, chromosome)
+            job['masks'] += 1
+            job['input_bytes'] += input_bytes
+            if variants is not None:
+                job['variants'] = (job['variants'] or 0) + variants
+                job['genes'] = (job['genes'] or 0) + genes
+        return job
+
+    # Every null model fit (or restored) by run_tool() is saved as a single output so that it can be reused with
+    # --null_model
+    def bundle_null_models(self) -> None:
+        bundle_path = self._association_pack.null_model_store.write_bundle(self._output_prefix)
+        if bundle_path is not None:
+            self._outputs.append(bundle_path)
+
     @abstractmethod
     def run_tool(self) -> None:
         pass
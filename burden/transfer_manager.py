@@ -0,0 +1,369 @@
+import hashlib
+import shutil
+import threading
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor, Future
+from pathlib import Path
+from typing import Dict, List, Union, Optional, TypedDict, Tuple, BinaryIO, Callable, Any, Type
+
+import dxpy
+
+from burden.resource_cache import ResourceCache
+
+
+# A TypedDict holding the information we need about a remote file before we transfer it. 'parts' is an ordered list of
+# (size, md5) tuples, which is how DNANexus stores checksums for multipart uploads. We use the same layout for local
+# files so that checksum verification is identical regardless of transport.
+class FileDescription(TypedDict):
+    id: str
+    name: str
+    size: int
+    parts: List[Tuple[int, str]]
+
+
+# Any class that can describe and download a file identified by a string ID can be used by the TransferManager. This is
+# what makes the transport pluggable.
+class TransferBackend(ABC):
+
+    @abstractmethod
+    def describe(self, file_id: str) -> FileDescription:
+        pass
+
+    @abstractmethod
+    def download(self, file_id: str, destination: Path) -> None:
+        pass
+
+    # Open the remote file as a readable binary stream (for consumers that never need the whole file on disk)
+    @abstractmethod
+    def open_stream(self, file_id: str) -> BinaryIO:
+        pass
+
+
+# The default backend – this just wraps the standard dxpy file download functions. dxpy keeps a single, process-wide
+# connection pool, so every worker thread in the TransferManager reuses the same set of open HTTPS connections.
+class DXTransferBackend(TransferBackend):
+
+    def describe(self, file_id: str) -> FileDescription:
+
+        description = dxpy.DXFile(file_id).describe(fields={'id': True, 'name': True, 'size': True, 'parts': True})
+
+        # Parts are returned as a dict keyed on part index (as a str) – make sure we order them numerically
+        parts = []
+        for part_index in sorted(description['parts'], key=int):
+            part = description['parts'][part_index]
+            parts.append((part['size'], part['md5']))
+
+        return {'id': description['id'],
+                'name': description['name'],
+                'size': description['size'],
+                'parts': parts}
+
+    def download(self, file_id: str, destination: Path) -> None:
+        dxpy.download_dxfile(file_id, f'{destination}')
+
+    def open_stream(self, file_id: str) -> BinaryIO:
+        return dxpy.open_dxfile(file_id, mode='rb')
+
+
+# A backend that 'downloads' files from a local directory. file_ids are either paths relative to 'root' or absolute
+# paths. This exists so transfer throughput (and everything downstream of the TransferManager) can be benchmarked
+# offline without a DNANexus project.
+class LocalTransferBackend(TransferBackend):
+
+    def __init__(self, root: Union[str, Path] = '.', part_size: int = 64 * 1024 * 1024):
+        self._root = Path(root)
+        self._part_size = part_size
+
+    def resolve(self, file_id: str) -> Path:
+        file_path = self._root / file_id
+        if not file_path.exists():
+            raise FileNotFoundError(f'Local file {file_id} not found in {self._root}')
+        return file_path
+
+    def describe(self, file_id: str) -> FileDescription:
+
+        file_path = self.resolve(file_id)
+        parts = []
+        with file_path.open('rb') as file_reader:
+            while True:
+                part = file_reader.read(self._part_size)
+                if len(part) == 0:
+                    break
+                parts.append((len(part), hashlib.md5(part).hexdigest()))
+
+        return {'id': file_id,
+                'name': file_path.name,
+                'size': file_path.stat().st_size,
+                'parts': parts}
+
+    def download(self, file_id: str, destination: Path) -> None:
+        shutil.copyfile(self.resolve(file_id), destination)
+
+    def open_stream(self, file_id: str) -> BinaryIO:
+        return self.resolve(file_id).open('rb')
+
+
+# Wraps a stream and calculates the same per-part md5s as TransferManager._check_file() while the consumer reads. If
+# 'tee' is provided, every byte read is also written to it (this is how streamed files end up in the ResourceCache).
+class _TransferStream:
+
+    def __init__(self, stream: BinaryIO, description: FileDescription, verify_checksums: bool,
+                 tee: Optional[BinaryIO] = None):
+        self._stream = stream
+        self._verify_checksums = verify_checksums
+        self._tee = tee
+        self._parts = description['parts']
+        self._expected_size = description['size']
+        self._current_part = 0
+        self._part_remaining = self._parts[0][0] if len(self._parts) > 0 else 0
+        self._part_hash = hashlib.md5()
+        self._bytes_read = 0
+
+    def read(self, size: int = -1) -> bytes:
+        data = self._stream.read() if size < 0 else self._stream.read(size)
+        self._bytes_read += len(data)
+        if self._tee is not None:
+            self._tee.write(data)
+        if self._verify_checksums:
+            self._update_checksum(data)
+        return data
+
+    def _update_checksum(self, data: bytes) -> None:
+        view = memoryview(data)
+        while len(view) > 0 and self._current_part < len(self._parts):
+            taken = view[:self._part_remaining]
+            self._part_hash.update(taken)
+            self._part_remaining -= len(taken)
+            view = view[len(taken):]
+            if self._part_remaining == 0:
+                if self._part_hash.hexdigest() != self._parts[self._current_part][1]:
+                    raise IOError(f'Checksum mismatch in part {self._current_part + 1} of stream')
+                self._current_part += 1
+                self._part_hash = hashlib.md5()
+                if self._current_part < len(self._parts):
+                    self._part_remaining = self._parts[self._current_part][0]
+
+    # Consumers (e.g. tarfile) may stop before the end of the stream – read whatever is left and confirm we saw
+    # every byte
+    def finish(self) -> None:
+        while len(self.read(8 * 1024 * 1024)) > 0:
+            pass
+        if self._bytes_read != self._expected_size:
+            raise IOError(f'Size mismatch for stream (expected {self._expected_size}, found {self._bytes_read})')
+
+    def close(self) -> None:
+        self._stream.close()
+        if self._tee is not None:
+            self._tee.close()
+
+
+# A single place to queue ALL file transfers required by this module. Transfers run on a bounded pool of worker threads
+# and return a Future, so callers can queue everything they will eventually need up front and only block (via wait())
+# on the files they need right now. Each transfer is retried with exponential backoff and, once complete, checked
+# against the per-part checksums of the remote file.
+#
+# If a ResourceCache is provided, every transfer is first looked up in the cache (keyed on file ID + checksum) and a
+# hit is linked into place instead of being transferred. Misses are added to the cache once they have been verified.
+class TransferManager:
+
+    def __init__(self, backend: Optional[TransferBackend] = None, max_workers: int = 4, max_retries: int = 3,
+                 backoff: float = 2.0, verify_checksums: bool = True, cache: Optional[ResourceCache] = None):
+
+        self._backend = DXTransferBackend() if backend is None else backend
+        self._cache = cache
+        self._max_retries = max_retries
+        self._backoff = backoff
+        self._verify_checksums = verify_checksums
+
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='transfer')
+        self._transfers: Dict[Path, Future] = {}
+        self._descriptions: Dict[str, FileDescription] = {}
+        self._lock = threading.Lock()
+
+    # Remote files are keyed on their ID AND a checksum built from the per-part md5s, so a file that has been
+    # replaced under the same ID is never served from the cache.
+    @staticmethod
+    def get_cache_key(description: FileDescription) -> str:
+        checksum = hashlib.md5()
+        for part_size, part_md5 in description['parts']:
+            checksum.update(f'{part_size}:{part_md5};'.encode())
+        return f'{description["id"]}.{description["size"]}.{checksum.hexdigest()}'
+
+    @staticmethod
+    def get_file_id(file: Union[dxpy.DXFile, str]) -> str:
+        return file.get_id() if isinstance(file, dxpy.DXFile) else file
+
+    # describe() is called by both ingestion code (e.g. to get a tarball name) and the transfer itself, so memoise it
+    # to avoid repeated API calls.
+    def describe(self, file: Union[dxpy.DXFile, str]) -> FileDescription:
+
+        file_id = self.get_file_id(file)
+        with self._lock:
+            if file_id in self._descriptions:
+                return self._descriptions[file_id]
+
+        description = self._backend.describe(file_id)
+        with self._lock:
+            self._descriptions[file_id] = description
+        return description
+
+    # Queue a file for download to 'destination'. Queueing the same destination twice returns the original Future
+    def queue(self, file: Union[dxpy.DXFile, str], destination: Union[str, Path]) -> Future:
+
+        file_id = self.get_file_id(file)
+        destination = Path(destination)
+        with self._lock:
+            if destination not in self._transfers:
+                self._transfers[destination] = self._executor.submit(self._transfer, file_id, destination)
+            return self._transfers[destination]
+
+    # Block until the requested destinations have been downloaded and verified. Returns the same paths for convenience
+    # (or, for streamed transfers, whatever the consumer returned)
+    def wait(self, *destinations: Union[str, Path]) -> List[Any]:
+
+        finished = []
+        for destination in destinations:
+            destination = Path(destination)
+            with self._lock:
+                if destination not in self._transfers:
+                    raise dxpy.AppError(f'No transfer has been queued for {destination}')
+                transfer = self._transfers[destination]
+            finished.append(transfer.result())
+        return finished
+
+    # Queue a file to be passed as a stream to 'consumer' rather than written to disk. 'key' names the transfer for
+    # wait(). The Future resolves to whatever 'consumer' returns. Because a retry re-runs 'consumer' from the start of
+    # the stream, consumers must be safe to run more than once.
+    #
+    # 'content_errors' are the exceptions 'consumer' raises when the file itself is bad (e.g. tarfile.ReadError). If the
+    # rest of the stream then downloads intact, retrying would only fail the same way, so the error is raised as is.
+    def queue_stream(self, file: Union[dxpy.DXFile, str], consumer: Callable[[BinaryIO], Any],
+                     key: Union[str, Path], content_errors: Tuple[Type[Exception], ...] = ()) -> Future:
+
+        file_id = self.get_file_id(file)
+        key = Path(key)
+        with self._lock:
+            if key not in self._transfers:
+                self._transfers[key] = self._executor.submit(self._stream_transfer, file_id, consumer,
+                                                             content_errors)
+            return self._transfers[key]
+
+    def wait_all(self) -> None:
+        with self._lock:
+            destinations = list(self._transfers.keys())
+        self.wait(*destinations)
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=True)
+
+    def _transfer(self, file_id: str, destination: Path) -> Path:
+
+        description = self.describe(file_id)
+        destination.parent.mkdir(parents=True, exist_ok=True)
+
+        cache_key = self.get_cache_key(description)
+        if self._cache is not None and self._cache.fetch(cache_key, {'data': destination}):
+            return destination
+
+        for attempt in range(1, self._max_retries + 1):
+            try:
+                self._backend.download(file_id, destination)
+                if self._verify_checksums:
+                    self._check_file(destination, description)
+                if self._cache is not None:
+                    self._cache.store(cache_key, {'data': destination})
+                return destination
+            except Exception as err:
+                if attempt == self._max_retries:
+                    raise dxpy.AppError(f'Transfer of {file_id} to {destination} failed after {attempt} attempts: '
+                                        f'{err}')
+                wait_time = self._backoff ** attempt
+                print(f'Transfer of {file_id} failed (attempt {attempt}) – retrying in {wait_time:0.0f}s')
+                time.sleep(wait_time)
+
+    def _stream_transfer(self, file_id: str, consumer: Callable[[BinaryIO], Any],
+                         content_errors: Tuple[Type[Exception], ...] = ()) -> Any:
+
+        description = self.describe(file_id)
+
+        # On a cache hit just stream from the cached copy
+        cache_key = self.get_cache_key(description)
+        if self._cache is not None:
+            cached_path = self._cache.get_path(cache_key, 'data')
+            if cached_path is not None:
+                with cached_path.open('rb') as cached_stream:
+                    return consumer(cached_stream)
+
+        for attempt in range(1, self._max_retries + 1):
+            staging = None if self._cache is None else self._cache.stage()
+            tee = None if staging is None else (staging / 'data').open('wb')
+            stream = _TransferStream(self._backend.open_stream(file_id), description, self._verify_checksums, tee)
+            try:
+                result = consumer(stream)
+                stream.finish()
+                stream.close()
+                if staging is not None:
+                    self._cache.commit(cache_key, staging)
+                return result
+            except Exception as err:
+                is_content_error = isinstance(err, content_errors) and self._is_intact(stream)
+                if staging is not None:
+                    self._cache.discard(staging)
+                if is_content_error:
+                    raise
+                if attempt == self._max_retries:
+                    raise dxpy.AppError(f'Streamed transfer of {file_id} failed after {attempt} attempts: {err}')
+                wait_time = self._backoff ** attempt
+                print(f'Streamed transfer of {file_id} failed (attempt {attempt}) – retrying in {wait_time:0.0f}s')
+                time.sleep(wait_time)
+            finally:
+                stream.close()
+
+    # Whether the rest of a stream a consumer gave up on downloads, and (with verify_checksums) matches its checksums
+    @staticmethod
+    def _is_intact(stream: _TransferStream) -> bool:
+        try:
+            stream.finish()
+            return True
+        except Exception:
+            return False
+
+    # Check the downloaded file part-by-part against the md5s we got from describe()
+    @staticmethod
+    def _check_file(file_path: Path, description: FileDescription) -> None:
+
+        found_size = file_path.stat().st_size
+        if found_size != description['size']:
+            raise IOError(f'Size mismatch for {file_path} (expected {description["size"]}, found {found_size})')
+
+        with file_path.open('rb') as file_reader:
+            for part_number, (part_size, part_md5) in enumerate(description['parts']):
+                part_hash = hashlib.md5()
+                remaining = part_size
+                while remaining > 0:
+                    chunk = file_reader.read(min(remaining, 8 * 1024 * 1024))
+                    if len(chunk) == 0:
+                        break
+                    part_hash.update(chunk)
+                    remaining -= len(chunk)
+                if part_hash.hexdigest() != part_md5:
+                    raise IOError(f'Checksum mismatch for {file_path} in part {part_number + 1}')
+
+
+# Queue every file in 'file_ids' and report how fast the manager moved them. Mostly intended to be run against a
+# LocalTransferBackend to tune max_workers without touching DNANexus.
+def benchmark_transfers(manager: TransferManager, file_ids: List[str], destination_dir: Union[str, Path]) -> float:
+
+    destination_dir = Path(destination_dir)
+    start_time = time.perf_counter()
+    destinations = [manager.queue(file_id, destination_dir / f'{n}.{manager.describe(file_id)["name"]}')
+                    for n, file_id in enumerate(file_ids)]
+    for transfer in destinations:
+        transfer.result()
+    elapsed = time.perf_counter() - start_time
+
+    total_bytes = sum(manager.describe(file_id)['size'] for file_id in file_ids)
+    throughput = total_bytes / elapsed / (1024 * 1024)
+    print(f'{"Transferred MiB/s":{65}}: {throughput:0.2f}')
+    return throughput
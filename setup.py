@@ -4,11 +4,14 @@ setup(
     name='burden',
     version='',
     packages=['burden', 'burden.tool_runners'],
+    package_data={'burden': ['resources/*.R']},
     url='',
     license='',
     author='ejgardner',
     author_email='',
     description='',
-    install_requires=['pandas>1.4', 'dxpy>0.326.1'],
+    install_requires=['pandas>1.4', 'dxpy>0.326.1', 'numpy>1.21', 'scipy>1.7', 'statsmodels>0.13', 'patsy>0.5'],
+    # --parquet_outputs, and faster VEP annotation
+    extras_require={'parquet': ['pyarrow>7.0']},
     python_requires='>=3'
 )
@@ -0,0 +1,43 @@
+import io
+
+import pandas as pd
+
+from burden.annotation import AnnotationEngine, MarkerSpill
+
+
+def _write_vep(vep_dir, chromosome, positions):
+    pd.DataFrame({'varID': [f'{chromosome}:{position}:A:T' for position in positions],
+                  'CHROM': chromosome,
+                  'POS': positions,
+                  'SIFT': 'tolerated',
+                  'POLYPHEN': 'benign'}).to_csv(vep_dir / f'{chromosome}.filtered.vep.tsv.gz', sep='\t', index=False)
+
+
+def test_markers_are_joined_per_chromosome(tmp_path, monkeypatch):
+
+    monkeypatch.chdir(tmp_path)
+    _write_vep(tmp_path, '1', [10, 20])
+    _write_vep(tmp_path, '2', [5])
+    markers = pd.DataFrame({'varID': ['2:5:A:T', '1:20:A:T'], 'p_val': [0.5, 0.01]})
+
+    loaded = []
+
+    def load_markers(chromosome):
+        loaded.append(chromosome)
+        return markers[markers['varID'].str.startswith(f'{chromosome}:')]
+
+    marker_out = io.StringIO()
+    AnnotationEngine(1, tmp_path).write_annotated_markers(['1', '2'], load_markers, marker_out)
+    written = pd.read_csv(io.StringIO(marker_out.getvalue()), sep='\t')
+    assert loaded == ['1', '2']
+    assert written['varID'].tolist() == ['1:10:A:T', '1:20:A:T', '2:5:A:T']
+    assert written['p_val'].tolist()[1:] == [0.01, 0.5]
+
+
+def test_empty_spill_writes_nothing(tmp_path, monkeypatch):
+
+    monkeypatch.chdir(tmp_path)
+    marker_out = io.StringIO()
+    MarkerSpill(AnnotationEngine(1, tmp_path)).write(marker_out)
+    assert marker_out.getvalue() == ''
+    assert list(tmp_path.iterdir()) == []
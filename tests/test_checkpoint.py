@@ -0,0 +1,96 @@
+import shutil
+from pathlib import Path
+
+import dxpy
+import pytest
+
+from burden import checkpoint
+from burden.checkpoint import Checkpoint, CheckpointStore
+
+
+# A DNAnexus folder kept in a local directory, standing in for the dxpy calls CheckpointStore makes
+class _FakeRemote:
+
+    def __init__(self, directory: Path):
+        self.directory = directory
+        self.directory.mkdir()
+
+    def upload_local_file(self, filename, name, project, folder, parents, wait_on_close):
+        shutil.copyfile(filename, self.directory / name)
+
+    def find_data_objects(self, name, **kwargs):
+        return [{'id': remote_path.name, 'describe': {'name': remote_path.name}}
+                for remote_path in sorted(self.directory.glob(name))]
+
+    def download_dxfile(self, dxid, filename, project):
+        shutil.copyfile(self.directory / dxid, filename)
+
+
+@pytest.fixture
+def remote(tmp_path, monkeypatch):
+    fake_remote = _FakeRemote(tmp_path / 'remote')
+    monkeypatch.setattr(checkpoint.dxpy, 'upload_local_file', fake_remote.upload_local_file)
+    monkeypatch.setattr(checkpoint.dxpy, 'find_data_objects', fake_remote.find_data_objects)
+    monkeypatch.setattr(checkpoint.dxpy, 'download_dxfile', fake_remote.download_dxfile)
+    return fake_remote
+
+
+def _save_unit(store: CheckpointStore, working_dir: Path) -> Checkpoint:
+    (working_dir / 'step_one.rda').write_text('model')
+    unit = Checkpoint(files={'step_one.rda': str(working_dir / 'step_one.rda')}, save_result=True)
+    store.save(store.get_key('step_one', [], []), 'step_one', unit, {'genes': 3})
+    return unit
+
+
+def test_restore_from_local_directory(tmp_path):
+
+    store = CheckpointStore(tmp_path / 'checkpoints', 'run')
+    unit = _save_unit(store, tmp_path)
+    (tmp_path / 'step_one.rda').unlink()
+
+    restarted = CheckpointStore(tmp_path / 'checkpoints', 'run')
+    assert restarted.restore(restarted.get_key('step_one', [], []), unit) == (True, {'genes': 3})
+    assert (tmp_path / 'step_one.rda').read_text() == 'model'
+
+    # A different run never matches
+    other_run = CheckpointStore(tmp_path / 'checkpoints', 'other_run')
+    assert other_run.restore(other_run.get_key('step_one', [], []), unit) == (False, None)
+
+
+def test_corrupt_unit_is_redone(tmp_path):
+
+    store = CheckpointStore(tmp_path / 'checkpoints', 'run')
+    unit = _save_unit(store, tmp_path)
+    key = store.get_key('step_one', [], [])
+    (tmp_path / 'checkpoints' / 'units' / key / 'step_one.rda').write_text('truncated')
+    assert store.restore(key, unit) == (False, None)
+
+
+def test_restore_from_remote_folder_on_a_new_instance(tmp_path, remote):
+
+    first_instance = tmp_path / 'first'
+    first_instance.mkdir()
+    store = CheckpointStore(first_instance / 'checkpoints', 'run', 'project-1:/checkpoints/')
+    unit = _save_unit(store, first_instance)
+    assert len(list(remote.directory.iterdir())) == 1
+    assert list(first_instance.glob('checkpoints/*.tar')) == []
+
+    # Nothing from the first instance survives except the remote folder
+    shutil.rmtree(first_instance)
+    second_instance = tmp_path / 'second'
+    second_instance.mkdir()
+    restarted = CheckpointStore(second_instance / 'checkpoints', 'run', 'project-1:/checkpoints')
+    unit.files = {'step_one.rda': str(second_instance / 'step_one.rda')}
+    assert restarted.restore(restarted.get_key('step_one', [], []), unit) == (True, {'genes': 3})
+    assert (second_instance / 'step_one.rda').read_text() == 'model'
+
+    # Units of other runs in the same folder are not downloaded
+    other_run = CheckpointStore(tmp_path / 'other', 'other_run', 'project-1:/checkpoints')
+    assert other_run.restore(other_run.get_key('step_one', [], []), unit) == (False, None)
+
+
+def test_remote_folder_without_project(tmp_path, monkeypatch):
+
+    monkeypatch.setattr(checkpoint.dxpy, 'PROJECT_CONTEXT_ID', None)
+    with pytest.raises(dxpy.AppError, match='No project'):
+        CheckpointStore(tmp_path / 'checkpoints', 'run', '/checkpoints')
@@ -0,0 +1,53 @@
+from pathlib import Path
+from typing import List
+
+import pytest
+
+from burden.derived_cache import DerivedCache
+from burden.resource_cache import ResourceCache
+
+
+@pytest.fixture
+def derived_cache(tmp_path, monkeypatch) -> DerivedCache:
+    monkeypatch.chdir(tmp_path)
+    Path('SAMPLES_Include.txt').write_text('1000000\n1000001\n')
+    return DerivedCache(ResourceCache(tmp_path / 'cache', max_bytes=1 << 30),
+                        {'mask_a': 'checksum_a', 'mask_b': 'checksum_b'})
+
+
+# Stand-in for a combined artifact: every mask's genes, named by the mask's position in 'tarball_prefixes'
+def _load_combined(derived_cache: DerivedCache, tarball_prefixes: List[str], builds: List[List[str]]) -> List[str]:
+
+    combined_path = Path('combined.1.groupFile.txt')
+
+    def build() -> None:
+        builds.append(tarball_prefixes)
+        combined_path.write_text(''.join(f'ENST00000000001.{mask_number}\t{tarball_prefix}\n'
+                                         for mask_number, tarball_prefix in enumerate(tarball_prefixes)))
+
+    derived_cache.load_or_build('saige_inputs', tarball_prefixes, '1', {'groupFile.txt': str(combined_path)}, build,
+                                options={'combine_masks': True})
+    return combined_path.read_text().splitlines()
+
+
+def test_same_masks_hit_cache(derived_cache):
+
+    builds = []
+    first = _load_combined(derived_cache, ['mask_a', 'mask_b'], builds)
+    Path('combined.1.groupFile.txt').unlink()
+    second = _load_combined(derived_cache, ['mask_a', 'mask_b'], builds)
+    assert len(builds) == 1
+    assert first == second
+
+
+# Entries are keyed on the ordered list of tarballs, so combined artifacts (which number masks by position) are rebuilt
+# when the same masks come in a different order
+def test_reordered_masks_are_rebuilt(derived_cache):
+
+    builds = []
+    _load_combined(derived_cache, ['mask_a', 'mask_b'], builds)
+    Path('combined.1.groupFile.txt').unlink()
+    reordered = _load_combined(derived_cache, ['mask_b', 'mask_a'], builds)
+    assert builds == [['mask_a', 'mask_b'], ['mask_b', 'mask_a']]
+    assert reordered == ['ENST00000000001.0\tmask_b', 'ENST00000000001.1\tmask_a']
+
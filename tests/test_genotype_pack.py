@@ -0,0 +1,73 @@
+import dxpy
+import numpy as np
+import pandas as pd
+import pytest
+
+from burden.genotype_pack import GenotypePack
+
+
+# Three genes over four samples, as load_tarball_linear_model() returns them (one row per carrier)
+def _genotype_table() -> pd.DataFrame:
+    index = pd.MultiIndex.from_tuples([('ENST02', 'sample_3'), ('ENST01', 'sample_1'), ('ENST02', 'sample_1'),
+                                       ('ENST03', 'sample_4'), ('ENST01', 'sample_2')], names=['ENST', 'FID'])
+    return pd.DataFrame({'gt': [2.0, 1.0, 1.0, 1.0, 2.0]}, index=index)
+
+
+def _dense(genotype_table: pd.DataFrame) -> pd.DataFrame:
+    return genotype_table['gt'].unstack(fill_value=0.0)
+
+
+def test_matrix_matches_table():
+
+    genotype_table = _genotype_table()
+    genotype_pack = GenotypePack.from_table(genotype_table)
+    expected = _dense(genotype_table)
+
+    assert list(genotype_pack.genes) == ['ENST01', 'ENST02', 'ENST03']
+    assert list(genotype_pack.samples) == list(expected.columns)
+    np.testing.assert_array_equal(genotype_pack.get_matrix().toarray(), expected.to_numpy())
+
+
+def test_save_and_load_round_trip(tmp_path):
+
+    genotype_pack = GenotypePack.from_table(_genotype_table())
+    prefix = str(tmp_path / 'mask')
+    genotype_pack.save(prefix)
+    loaded = GenotypePack.load(prefix)
+
+    assert list(loaded.genes) == list(genotype_pack.genes)
+    assert list(loaded.samples) == list(genotype_pack.samples)
+    np.testing.assert_array_equal(loaded.get_matrix().toarray(), genotype_pack.get_matrix().toarray())
+    # Packs must load without pickle, so that they can be memory-mapped
+    for path in GenotypePack.get_paths(prefix).values():
+        assert np.load(path, allow_pickle=False).dtype != object
+
+
+# Samples are reordered to the given index; carriers not in it are dropped, and samples without carriers are empty
+def test_matrix_on_other_samples():
+
+    genotype_pack = GenotypePack.from_table(_genotype_table())
+    samples = pd.Index(['sample_5', 'sample_2', 'sample_1', 'sample_3'])
+    matrix = genotype_pack.get_matrix(samples).toarray()
+
+    expected = _dense(_genotype_table()).reindex(columns=samples, fill_value=0.0)
+    np.testing.assert_array_equal(matrix, expected.to_numpy())
+    assert matrix.dtype == np.float64
+
+
+def test_gene_table_matches_table():
+
+    genotype_table = _genotype_table()
+    genotype_pack = GenotypePack.from_table(genotype_table)
+    gene_table = genotype_pack.get_gene_table('ENST01')
+
+    expected = genotype_table.loc[['ENST01']].sort_index()
+    pd.testing.assert_frame_equal(gene_table.sort_index(), expected)
+
+
+def test_rejects_non_integer_genotypes():
+
+    genotype_table = _genotype_table()
+    genotype_table['gt'] = genotype_table['gt'] / 2
+    with pytest.raises(dxpy.AppError):
+        GenotypePack.from_table(genotype_table)
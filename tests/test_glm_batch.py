@@ -0,0 +1,63 @@
+import numpy as np
+import pandas as pd
+import pytest
+import statsmodels.api as sm
+from scipy import sparse
+
+from burden.glm_batch import ResidualMatrix, get_null_design, get_null_formula, score_all_genes
+from general_utilities.linear_model.linear_model import LinearModelPack
+
+
+# A null model as linear_model_null() builds it: phenotypes and covariates indexed on FID, the full formula, and the
+# residuals of the covariate-only fit in 'null_table'
+def _null_model(formula: str, n_samples: int = 500, seed: int = 1) -> LinearModelPack:
+
+    rng = np.random.default_rng(seed)
+    phenotypes = pd.DataFrame({'age': rng.normal(50, 10, n_samples),
+                               'sex': rng.integers(0, 2, n_samples),
+                               'has_var': 0},
+                              index=pd.Index([f'{sample}' for sample in range(n_samples)], name='FID'))
+    phenotypes['pheno'] = 0.05 * phenotypes['age'] + phenotypes['sex'] + rng.normal(size=n_samples)
+    phenotypes.loc[phenotypes.index[:10], 'pheno'] = np.nan
+    null_results = sm.GLM.from_formula('pheno ~ age + C(sex)', data=phenotypes, family=sm.families.Gaussian(),
+                                       missing='drop').fit()
+    return LinearModelPack(phenotypes, sm.families.Gaussian(), formula,
+                           null_table=null_results.resid_response.to_frame('resid'))
+
+
+@pytest.mark.parametrize('formula', ['pheno ~ age + C(sex) + has_var', 'pheno~has_var+age+C(sex)'])
+def test_null_formula_drops_only_has_var(formula):
+
+    null_model = _null_model(formula)
+    assert [term.name() for term in get_null_formula(null_model).rhs_termlist] == ['Intercept', 'age', 'C(sex)']
+    response, design = get_null_design(null_model)
+    assert list(design.columns) == ['Intercept', 'C(sex)[T.1]', 'age']
+    assert len(response) == len(design) == 490
+
+
+def test_residual_matrix_uses_null_model_residuals():
+
+    null_model = _null_model('pheno ~ age + C(sex) + has_var')
+    residual_matrix = ResidualMatrix({'pheno': null_model})
+    assert residual_matrix.n_model[0] == 490
+    np.testing.assert_allclose(residual_matrix.residuals[residual_matrix.observed[:, 0], 0],
+                               null_model.null_table['resid'].to_numpy())
+
+
+def test_scores_match_residual_regression():
+
+    null_model = _null_model('pheno ~ age + C(sex) + has_var')
+    residual_matrix = ResidualMatrix({'pheno': null_model})
+    rng = np.random.default_rng(2)
+    genotypes = (rng.random((3, len(residual_matrix.samples))) < 0.05).astype(np.float64)
+
+    results, refits = score_all_genes(residual_matrix, pd.Index(['ENST1', 'ENST2', 'ENST3']),
+                                      sparse.csr_matrix(genotypes), 'mask', False, screen_threshold=0)
+    assert refits == []
+    for gene_index, row in enumerate(results):
+        data = pd.DataFrame({'resid': null_model.null_table['resid'],
+                             'has_var': pd.Series(genotypes[gene_index], index=residual_matrix.samples)})
+        expected = sm.OLS.from_formula('resid ~ has_var', data=data.dropna()).fit()
+        assert row['effect'] == pytest.approx(expected.params['has_var'], rel=1e-8)
+        assert row['std_err'] == pytest.approx(expected.bse['has_var'], rel=1e-8)
+        assert row['n_model'] == 490
@@ -0,0 +1,101 @@
+import numpy as np
+import pytest
+import statsmodels.api as sm
+from scipy import sparse
+from scipy.optimize import minimize_scalar
+from scipy.special import expit
+from scipy.stats import chi2
+
+from burden.glm_logistic import BatchedLogisticRegression, LogisticNullModel, fit_firth
+
+
+# 4 carriers (all affected – complete separation) and 20 non-carriers (5 affected)
+def _separated_table():
+    genotypes = np.array([1.0] * 4 + [0.0] * 20)
+    response = np.array([1.0] * 4 + [1.0] * 5 + [0.0] * 15)
+    return np.ones((len(response), 1)), genotypes, response
+
+
+def _null_model(design: np.ndarray, response: np.ndarray) -> LogisticNullModel:
+    coefficients = sm.GLM(response, design, family=sm.families.Binomial()).fit().params
+    firth_coefficients, _, _ = fit_firth(design, response, coefficients)
+    return LogisticNullModel(design, response, sparse.identity(len(response), format='csr'), coefficients,
+                             firth_coefficients)
+
+
+def _penalised_log_likelihood(design: np.ndarray, response: np.ndarray, coefficients: np.ndarray) -> float:
+    eta = design @ coefficients
+    fitted = expit(eta)
+    information = (design * (fitted * (1 - fitted))[:, np.newaxis]).T @ design
+    return (response * eta - np.logaddexp(0, eta)).sum() + 0.5 * np.linalg.slogdet(information)[1]
+
+
+# For a single binary covariate, logistf's estimate is the log odds ratio of the 2 x 2 table with 0.5 added to every
+# cell, and its standard error comes from the fitted cell probabilities
+def test_firth_matches_logistf_on_separated_table():
+
+    intercept, genotypes, response = _separated_table()
+    design = np.column_stack([intercept, genotypes])
+    coefficients, covariance, _ = fit_firth(design, response, np.zeros(2))
+
+    carrier_affected = 4.5 / 5.0
+    noncarrier_affected = 5.5 / 21.0
+    assert coefficients[0] == pytest.approx(np.log(5.5 / 15.5), abs=1e-6)
+    assert coefficients[1] == pytest.approx(np.log((4.5 / 0.5) / (5.5 / 15.5)), abs=1e-6)
+    expected_variance = 1 / (4 * carrier_affected * (1 - carrier_affected)) + \
+        1 / (20 * noncarrier_affected * (1 - noncarrier_affected))
+    assert np.sqrt(covariance[1, 1]) == pytest.approx(np.sqrt(expected_variance), rel=1e-5)
+
+
+# logistf's penalised likelihood ratio test compares against the same design with the genotype effect fixed at 0
+def test_firth_likelihood_ratio_uses_restricted_full_design():
+
+    intercept, genotypes, response = _separated_table()
+    design = np.column_stack([intercept, genotypes])
+    null_model = _null_model(intercept, response)
+    effect, std_err, p_val_full = BatchedLogisticRegression._fit_firth(null_model, genotypes)
+
+    full_log_likelihood = _penalised_log_likelihood(design, response, np.array([np.log(5.5 / 15.5), effect]))
+    restricted = minimize_scalar(lambda beta: -_penalised_log_likelihood(design, response, np.array([beta, 0.0])),
+                                 bounds=(-10, 10), method='bounded', options={'xatol': 1e-10})
+    expected_p = chi2.sf(2 * (full_log_likelihood + restricted.fun), 1)
+    assert p_val_full == pytest.approx(expected_p, rel=1e-4)
+
+    # A covariate-only null fit carries a different penalty, and so a different (wrong) statistic
+    _, _, covariate_only_log_likelihood = fit_firth(intercept, response, np.zeros(1))
+    assert chi2.sf(2 * (full_log_likelihood - covariate_only_log_likelihood), 1) != pytest.approx(expected_p, rel=1e-2)
+
+
+def test_irls_matches_statsmodels():
+
+    rng = np.random.default_rng(1)
+    n_samples = 2000
+    design = np.column_stack([np.ones(n_samples), rng.normal(size=n_samples), rng.integers(0, 2, n_samples)])
+    genotypes = np.zeros((n_samples, 3))
+    for gene_index, carriers in enumerate([40, 80, 120]):
+        genotypes[rng.choice(n_samples, carriers, replace=False), gene_index] = 1
+    response = rng.binomial(1, expit(-1 + 0.3 * design[:, 1] + 0.8 * genotypes[:, 0] - 0.5 * genotypes[:, 2]))
+    response = response.astype(np.float64)
+
+    null_model = _null_model(design, response)
+    coefficients, covariance, converged = BatchedLogisticRegression._fit_irls(null_model, genotypes,
+                                                                              np.ones(3, dtype=bool))
+    assert converged.all()
+    for gene_index in range(3):
+        expected = sm.GLM(response, np.column_stack([design, genotypes[:, gene_index]]),
+                          family=sm.families.Binomial()).fit()
+        np.testing.assert_allclose(coefficients[gene_index], expected.params, rtol=1e-6, atol=1e-8)
+        np.testing.assert_allclose(np.sqrt(np.diag(covariance[gene_index])), expected.bse, rtol=1e-5)
+
+
+def test_fit_batch_falls_back_to_firth_for_separated_genes():
+
+    intercept, genotypes, response = _separated_table()
+    null_model = _null_model(intercept, response)
+    logistic_regression = BatchedLogisticRegression.__new__(BatchedLogisticRegression)
+    logistic_regression._null_models = [null_model]
+
+    genotype_matrix = sparse.csr_matrix(genotypes[np.newaxis, :])
+    rows = logistic_regression.fit_batch(genotype_matrix, [(0, 0, {'n_car': 4, 'n_car_affected': 4})])
+    assert rows[0]['effect'] == pytest.approx(np.log((4.5 / 0.5) / (5.5 / 15.5)), abs=1e-4)
+    assert 0 < rows[0]['p_val_full'] < 1
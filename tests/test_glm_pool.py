@@ -0,0 +1,50 @@
+import numpy as np
+import pandas as pd
+import pytest
+import statsmodels.api as sm
+from scipy import sparse
+
+from burden.glm_batch import ResidualMatrix
+from burden.glm_pool import GLMProcessPool
+from general_utilities.linear_model.linear_model import LinearModelPack
+
+
+def _null_model(n_samples: int = 300) -> LinearModelPack:
+
+    rng = np.random.default_rng(1)
+    phenotypes = pd.DataFrame({'age': rng.normal(50, 10, n_samples), 'has_var': 0},
+                              index=pd.Index([f'{sample}' for sample in range(n_samples)], name='FID'))
+    phenotypes['pheno'] = 0.05 * phenotypes['age'] + rng.normal(size=n_samples)
+    null_results = sm.GLM.from_formula('pheno ~ age', data=phenotypes, family=sm.families.Gaussian()).fit()
+    return LinearModelPack(phenotypes, sm.families.Gaussian(), 'pheno ~ age + has_var',
+                           null_table=null_results.resid_response.to_frame('resid'))
+
+
+def test_fits_match_statsmodels_and_close_cleans_up(tmp_path, monkeypatch):
+
+    monkeypatch.chdir(tmp_path)
+    null_model = _null_model()
+    residual_matrix = ResidualMatrix({'pheno': null_model})
+    genotypes = np.zeros((2, len(residual_matrix.samples)))
+    genotypes[0, :30] = 1
+    genotypes[1, 100:120] = 2
+
+    with GLMProcessPool(residual_matrix, {'pheno': null_model}, 2) as refit_pool:
+        refit_pool.submit('mask', sparse.csr_matrix(genotypes), [(0, 0, {'ENST': 'ENST1'}), (1, 0, {'ENST': 'ENST2'})])
+        rows = {row['ENST']: row for row in refit_pool.collect()}
+        assert len(list(tmp_path.iterdir())) == 1
+
+    data = null_model.phenotypes.assign(has_var=genotypes[1])
+    expected = sm.GLM.from_formula('pheno ~ age + has_var', data=data, family=sm.families.Gaussian()).fit()
+    assert rows['ENST2']['effect'] == pytest.approx(expected.params['has_var'])
+    assert rows['ENST2']['std_err'] == pytest.approx(expected.bse['has_var'])
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_failed_start_leaves_nothing_behind(tmp_path, monkeypatch):
+
+    monkeypatch.chdir(tmp_path)
+    residual_matrix = ResidualMatrix({'pheno': _null_model()})
+    with pytest.raises(KeyError):
+        GLMProcessPool(residual_matrix, {}, 2)
+    assert list(tmp_path.iterdir()) == []
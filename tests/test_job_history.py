@@ -0,0 +1,37 @@
+import pytest
+
+from burden.job_history import DEFAULT_SECONDS_PER_UNIT, JobHistory
+
+
+def _job(variants=None, input_bytes=0, chromosome='1'):
+    return {'step': 'saige.step_two', 'chromosome': chromosome, 'masks': 1, 'variants': variants, 'genes': None,
+            'input_bytes': input_bytes, 'samples': 1000}
+
+
+def test_estimates_only_use_the_same_unit(tmp_path):
+
+    history = JobHistory(tmp_path / 'job_history.jsonl')
+    history.record(_job(variants=100), 10)
+    history.record(_job(variants=300), 30)
+    history.record(_job(input_bytes=1000), 1000)
+    history.save()
+
+    reloaded = JobHistory(tmp_path / 'job_history.jsonl')
+    # 0.1ms per variant x sample, whatever the byte-sized job took
+    assert reloaded.estimate(_job(variants=200)) == pytest.approx(20)
+    # 1s per byte, whatever the variant-sized jobs took
+    assert reloaded.estimate(_job(input_bytes=50)) == pytest.approx(50)
+
+
+def test_estimates_without_history_or_size(tmp_path):
+
+    history = JobHistory(None)
+    assert history.estimate(_job(variants=10)) == pytest.approx(10 * 1000 * DEFAULT_SECONDS_PER_UNIT['variant_samples'])
+    assert history.estimate(_job(input_bytes=10)) == pytest.approx(10 * DEFAULT_SECONDS_PER_UNIT['input_bytes'])
+    assert history.estimate(_job()) is None
+
+    history.record(_job(chromosome='1'), 5)
+    history.record(_job(chromosome='2'), 7)
+    history.record(_job(variants=10), 1000)
+    assert history.estimate(_job(chromosome='2')) == 7
+    assert history.estimate(_job(chromosome='3')) == 6
@@ -0,0 +1,37 @@
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+from burden.parquet_writer import ParquetTableWriter, get_float32_columns
+
+
+def test_float32_columns_must_round_trip_exactly():
+
+    table = pd.DataFrame({'small_counts': [1.0, 2.0, np.nan, 2.0 ** 24],
+                          'large_counts': [1.0, 2.0, np.nan, 2.0 ** 24 + 1],
+                          'positions': np.array([100, 16777217, 3, 4], dtype=np.int64),
+                          'written_stats': [1.23456e-05, 0.1, -2.5, np.nan],
+                          'computed_stats': [np.pi, 0.1, -2.5, np.nan],
+                          'tiny_p_values': [1e-50, 0.5, 0.1, 0.01]})
+    assert get_float32_columns(table) == {'small_counts', 'written_stats'}
+
+
+def test_row_groups_dictionary_encoding_and_float32(tmp_path):
+
+    table = pd.DataFrame({'ENST': ['ENST1', 'ENST2', 'ENST3'],
+                          'chrom': ['1', '1', '2'],
+                          'p_val': [0.5, 1e-50, 0.25],
+                          'effect': [0.125, -0.5, 1.5]})
+    parquet_path = tmp_path / 'genes.parquet'
+    with ParquetTableWriter(parquet_path, 'chrom') as parquet_out:
+        parquet_out.write(table)
+
+    parquet_file = pq.ParquetFile(parquet_path)
+    assert parquet_file.num_row_groups == 2
+    schema = parquet_file.schema_arrow
+    assert str(schema.field('p_val').type) == 'double'
+    assert str(schema.field('effect').type) == 'float'
+    assert str(schema.field('ENST').type).startswith('dictionary')
+    read_back = parquet_file.read().to_pandas()
+    np.testing.assert_array_equal(read_back['effect'].to_numpy(dtype=np.float64), table['effect'])
+    np.testing.assert_array_equal(read_back['p_val'], table['p_val'])
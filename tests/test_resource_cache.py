@@ -0,0 +1,79 @@
+import os
+import socket
+import stat
+from pathlib import Path
+
+from burden.resource_cache import ResourceCache
+
+
+def _store(cache: ResourceCache, tmp_path: Path, key: str, content: str) -> None:
+    source = tmp_path / f'{key}.source'
+    source.write_text(content)
+    cache.store(key, {'data': source})
+
+
+def test_fetch_returns_cached_copy(tmp_path):
+
+    cache = ResourceCache(tmp_path / 'cache', max_bytes=1 << 20)
+    _store(cache, tmp_path, 'entry', 'cached data')
+    destination = tmp_path / 'work' / 'data.txt'
+    assert cache.fetch('entry', {'data': destination})
+    assert destination.read_text() == 'cached data'
+    assert not cache.fetch('missing', {'data': tmp_path / 'missing.txt'})
+
+
+def test_cached_files_are_read_only(tmp_path):
+
+    cache = ResourceCache(tmp_path / 'cache', max_bytes=1 << 20)
+    _store(cache, tmp_path, 'entry', 'cached data')
+    destination = tmp_path / 'data.txt'
+    cache.fetch('entry', {'data': destination})
+    write_bits = stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH
+    assert destination.stat().st_mode & write_bits == 0
+    assert cache.get_path('entry', 'data').stat().st_mode & write_bits == 0
+
+
+# Fetching across filesystems (where hardlinks fail) copies, so evicting the entry later cannot leave a dangling link
+def test_fetch_copies_when_hardlink_fails(tmp_path, monkeypatch):
+
+    cache = ResourceCache(tmp_path / 'cache', max_bytes=1 << 20, min_age=0)
+    _store(cache, tmp_path, 'entry', 'cached data')
+
+    def no_link(source, destination):
+        raise OSError('cross-device link')
+
+    monkeypatch.setattr(os, 'link', no_link)
+    destination = tmp_path / 'data.txt'
+    assert cache.fetch('entry', {'data': destination})
+    assert not destination.is_symlink()
+
+    monkeypatch.undo()
+    cache_small = ResourceCache(tmp_path / 'cache', max_bytes=0, min_age=0)
+    _store(cache_small, tmp_path, 'other', 'other data')
+    assert cache_small.get_path('entry', 'data') is None
+    assert destination.read_text() == 'cached data'
+
+
+def test_stale_staging_is_removed(tmp_path):
+
+    cache = ResourceCache(tmp_path / 'cache', max_bytes=1 << 20)
+    staging_dir = tmp_path / 'cache' / 'staging'
+    live = cache.stage()
+    (staging_dir / f'{socket.gethostname()}.999999999.abc').mkdir()
+    (staging_dir / 'legacy').mkdir()
+    (staging_dir / 'otherhost.1.abc').mkdir()
+
+    ResourceCache(tmp_path / 'cache', max_bytes=1 << 20)
+    assert sorted(staging.name for staging in staging_dir.iterdir()) == sorted([live.name, 'otherhost.1.abc'])
+
+
+def test_eviction_removes_least_recently_used(tmp_path):
+
+    cache = ResourceCache(tmp_path / 'cache', max_bytes=15, min_age=0)
+    _store(cache, tmp_path, 'first', '0123456789')
+    first_entry = tmp_path / 'cache' / 'entries' / 'first'
+    last_used = first_entry.stat().st_mtime - 100
+    os.utime(first_entry, (last_used, last_used))
+    _store(cache, tmp_path, 'second', '0123456789')
+    assert cache.get_path('first', 'data') is None
+    assert cache.get_path('second', 'data') is not None
@@ -0,0 +1,98 @@
+import subprocess
+import sys
+
+import dxpy
+import pytest
+
+from burden import staar_pool
+from burden.staar_pool import STAARWorker, STAARWorkerPool
+
+# Speaks the staar_worker.R protocol. Jobs for chromosome 'hang' never answer, jobs for 'slow' take 2s, jobs for
+# 'error' fail in "STAAR", and jobs for 'flaky' crash the first worker to run them.
+FAKE_WORKER = '''
+import os, sys, time
+for line in sys.stdin:
+    fields = line.rstrip('\\n').split('\\t')
+    if fields[0] == 'PING':
+        print('PONG', flush=True)
+    elif fields[0] == 'QUIT':
+        break
+    elif fields[-1] == 'hang':
+        time.sleep(600)
+    elif fields[-1] == 'slow':
+        time.sleep(2)
+        print('DONE', flush=True)
+    elif fields[-1] == 'flaky' and not os.path.exists('crashed'):
+        open('crashed', 'w').close()
+        sys.exit(1)
+    elif fields[-1] == 'error':
+        print('ERROR\\tnull model not found', flush=True)
+    else:
+        print('DONE', flush=True)
+'''
+
+
+@pytest.fixture
+def fake_workers(tmp_path, monkeypatch):
+
+    monkeypatch.chdir(tmp_path)
+    started = []
+
+    def start_fake_worker(worker: STAARWorker) -> None:
+        worker._starts += 1
+        worker._name = f'fake_worker_{worker._starts}'
+        worker._process = subprocess.Popen([sys.executable, '-c', FAKE_WORKER], stdin=subprocess.PIPE,
+                                           stdout=subprocess.PIPE, text=True, bufsize=1)
+        started.append(worker._name)
+
+    monkeypatch.setattr(STAARWorker, '_start', start_fake_worker)
+    monkeypatch.setattr(staar_pool.subprocess, 'run', lambda *args, **kwargs: None)
+    return started
+
+
+@pytest.fixture
+def pool(fake_workers):
+    with STAARWorkerPool(1, job_timeout=1) as staar_worker_pool:
+        yield staar_worker_pool, fake_workers
+
+
+def test_jobs_run_on_one_long_lived_worker(pool):
+
+    staar_worker_pool, started = pool
+    assert staar_worker_pool.run_genes('mask', '1', 'pheno') == ('mask', '1', 'pheno')
+    assert staar_worker_pool.run_genes('mask', '2', 'pheno') == ('mask', '2', 'pheno')
+    assert started == ['fake_worker_1']
+
+
+def test_crashed_worker_is_restarted_and_the_job_retried(pool):
+
+    staar_worker_pool, started = pool
+    assert staar_worker_pool.run_genes('mask', 'flaky', 'pheno') == ('mask', 'flaky', 'pheno')
+    assert started == ['fake_worker_1', 'fake_worker_2']
+
+
+def test_hung_job_is_killed_and_fails_after_its_attempts(pool):
+
+    staar_worker_pool, started = pool
+    with pytest.raises(dxpy.AppError, match='did not finish within 1s'):
+        staar_worker_pool.run_genes('mask', 'hang', 'pheno')
+    assert len(started) == staar_pool.STAAR_JOB_ATTEMPTS
+
+    # The pool still works afterwards
+    assert staar_worker_pool.run_genes('mask', '1', 'pheno') == ('mask', '1', 'pheno')
+
+
+def test_staar_errors_are_not_retried(pool):
+
+    staar_worker_pool, started = pool
+    with pytest.raises(dxpy.AppError, match='null model not found'):
+        staar_worker_pool.run_genes('mask', 'error', 'pheno')
+    assert started == ['fake_worker_1']
+
+
+# Without --staar_job_timeout_hours, long jobs are left to finish
+def test_jobs_are_not_timed_out_by_default(fake_workers):
+
+    with STAARWorkerPool(1) as staar_worker_pool:
+        assert staar_worker_pool.run_genes('mask', 'slow', 'pheno') == ('mask', 'slow', 'pheno')
+    assert fake_workers == ['fake_worker_1']
@@ -0,0 +1,137 @@
+import gzip
+import random
+import struct
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import pytest
+
+from burden.bgzf import BGZFWriter
+from burden.tabix import TabixIndex
+
+DATA_DIR = Path(__file__).parent / 'data'
+
+# (reference file, 1-based end column) – as ToolRunner._open_indexed_output() writes gene and marker outputs
+REFERENCES = [('genes.tsv.gz', 4), ('markers.tsv.gz', 3)]
+
+
+def _write_indexed(tmp_path: Path, reference: str, end_col: int, threads: int = 1) -> Path:
+    output_path = tmp_path / reference
+    with BGZFWriter(output_path, threads=threads,
+                    index=TabixIndex(seq_col=2, begin_col=3, end_col=end_col, skip_lines=1)) as output:
+        output.write(gzip.decompress((DATA_DIR / reference).read_bytes()))
+    return output_path
+
+
+@pytest.mark.parametrize('reference, end_col', REFERENCES)
+@pytest.mark.parametrize('threads', [1, 4])
+def test_matches_htslib(tmp_path, reference, end_col, threads):
+
+    output_path = _write_indexed(tmp_path, reference, end_col, threads)
+    assert output_path.read_bytes() == (DATA_DIR / reference).read_bytes()
+    assert Path(f'{output_path}.tbi').read_bytes() == (DATA_DIR / f'{reference}.tbi').read_bytes()
+
+
+# A minimal tabix reader, following the .tbi specification, to query the index BGZFWriter / TabixIndex wrote
+class _TabixReader:
+
+    def __init__(self, path: Path):
+
+        index = gzip.decompress(Path(f'{path}.tbi').read_bytes())
+        n_ref, _, self._seq_col, self._begin_col, self._end_col = struct.unpack_from('<5i', index, 4)
+        names_length, = struct.unpack_from('<i', index, 32)
+        offset = 36
+        names = index[offset:offset + names_length].split(b'\x00')[:n_ref]
+        offset += names_length
+
+        self._references: Dict[str, Tuple[Dict[int, List[Tuple[int, int]]], List[int]]] = {}
+        for name in names:
+            n_bin, = struct.unpack_from('<i', index, offset)
+            offset += 4
+            bins = {}
+            for _ in range(n_bin):
+                bin_number, n_chunk = struct.unpack_from('<Ii', index, offset)
+                offset += 8
+                bins[bin_number] = [struct.unpack_from('<QQ', index, offset + 16 * chunk) for chunk in range(n_chunk)]
+                offset += 16 * n_chunk
+            n_intv, = struct.unpack_from('<i', index, offset)
+            offset += 4
+            linear = list(struct.unpack_from(f'<{n_intv}Q', index, offset))
+            offset += 8 * n_intv
+            self._references[name.decode()] = (bins, linear)
+
+        # Uncompressed data, and where each BGZF block starts in it (by compressed offset)
+        compressed = path.read_bytes()
+        self._data = gzip.decompress(compressed)
+        self._block_starts = {}
+        compressed_offset = uncompressed_offset = 0
+        while compressed_offset < len(compressed):
+            block_size = struct.unpack_from('<H', compressed, compressed_offset + 16)[0] + 1
+            self._block_starts[compressed_offset] = uncompressed_offset
+            uncompressed_offset += struct.unpack_from('<I', compressed, compressed_offset + block_size - 4)[0]
+            compressed_offset += block_size
+
+    def _to_data_offset(self, virtual_offset: int) -> int:
+        return self._block_starts[virtual_offset >> 16] + (virtual_offset & 0xffff)
+
+    @staticmethod
+    def _get_bins(begin: int, end: int) -> List[int]:
+        end -= 1
+        bins = [0]
+        for first, shift in [(1, 26), (9, 23), (73, 20), (585, 17), (4681, 14)]:
+            bins.extend(range(first + (begin >> shift), first + (end >> shift) + 1))
+        return bins
+
+    # Lines overlapping the 0-based, half-open region [begin, end)
+    def fetch(self, name: str, begin: int, end: int) -> List[str]:
+
+        bins, linear = self._references[name]
+        min_offset = linear[begin >> 14] if begin >> 14 < len(linear) else 0
+        found = {}
+        for bin_number in self._get_bins(begin, end):
+            for chunk_begin, chunk_end in bins.get(bin_number, []):
+                if chunk_end <= min_offset:
+                    continue
+                line_offset = self._to_data_offset(chunk_begin)
+                chunk_stop = self._to_data_offset(chunk_end)
+                while line_offset < chunk_stop:
+                    line_end = self._data.index(b'\n', line_offset) + 1
+                    fields = self._data[line_offset:line_end].decode().rstrip('\n').split('\t')
+                    line_begin = int(fields[self._begin_col - 1]) - 1
+                    line_stop = int(fields[self._end_col - 1])
+                    if fields[self._seq_col - 1] == name and line_begin < end and line_stop > begin:
+                        found[line_offset] = '\t'.join(fields)
+                    line_offset = line_end
+        return [found[line_offset] for line_offset in sorted(found)]
+
+
+@pytest.mark.parametrize('reference, end_col', REFERENCES)
+def test_region_queries(tmp_path, reference, end_col):
+
+    output_path = _write_indexed(tmp_path, reference, end_col)
+    reader = _TabixReader(output_path)
+    lines = gzip.decompress(output_path.read_bytes()).decode().splitlines()[1:]
+    records = [(fields[1], int(fields[2]) - 1, int(fields[end_col - 1]), line)
+               for line, fields in ((line, line.split('\t')) for line in lines)]
+
+    rng = random.Random(1)
+    regions = [('1', 0, 1), ('2', 0, 300_000_000), ('X', 155_000_000, 160_000_000)]
+    for _ in range(100):
+        begin = rng.randrange(0, 250_000_000)
+        regions.append((rng.choice(['1', '2', 'X']), begin, begin + rng.choice([1, 1_000, 100_000, 5_000_000])))
+
+    for name, begin, end in regions:
+        expected = [line for record_name, record_begin, record_end, line in records
+                    if record_name == name and record_begin < end and record_end > begin]
+        assert reader.fetch(name, begin, end) == expected, (name, begin, end)
+
+
+@pytest.mark.parametrize('reference, end_col', REFERENCES)
+def test_htslib_reads_the_index(tmp_path, reference, end_col):
+
+    pysam = pytest.importorskip('pysam')
+    output_path = _write_indexed(tmp_path, reference, end_col)
+    reader = _TabixReader(output_path)
+    with pysam.TabixFile(str(output_path)) as tabix_file:
+        for name, begin, end in [('1', 1_000_000, 9_000_000), ('2', 50_000_000, 50_500_000), ('X', 0, 200_000_000)]:
+            assert list(tabix_file.fetch(name, begin, end)) == reader.fetch(name, begin, end)
@@ -0,0 +1,120 @@
+import gzip
+import io
+import shutil
+import subprocess
+import tarfile
+from pathlib import Path
+
+import dxpy
+import pytest
+
+from burden.tarball_extractor import stream_extract_tarball
+from burden.transfer_manager import LocalTransferBackend, TransferManager
+
+
+class _CountingBackend(LocalTransferBackend):
+
+    def __init__(self, root: Path, fail_reads: int = 0):
+        super().__init__(root, part_size=1024)
+        self.opened = 0
+        self._fail_reads = fail_reads
+
+    def open_stream(self, file_id: str):
+        self.opened += 1
+        if self.opened <= self._fail_reads:
+            return _FailingStream()
+        return super().open_stream(file_id)
+
+
+class _FailingStream(io.RawIOBase):
+
+    def read(self, size: int = -1) -> bytes:
+        raise ConnectionError('connection reset')
+
+
+def _write_tarball(path: Path) -> bytes:
+    tar_bytes = io.BytesIO()
+    with tarfile.open(fileobj=tar_bytes, mode='w') as tar:
+        for name in ['mask.SAIGE.bcf', 'mask.BOLT.bgen']:
+            member = tarfile.TarInfo(name)
+            member.size = 4
+            tar.addfile(member, io.BytesIO(b'data'))
+    path.write_bytes(gzip.compress(tar_bytes.getvalue()))
+    return tar_bytes.getvalue()
+
+
+def _manager(backend: LocalTransferBackend) -> TransferManager:
+    return TransferManager(backend, max_workers=1, backoff=0)
+
+
+def test_streams_only_the_tool_members(tmp_path):
+
+    _write_tarball(tmp_path / 'masks.tar.gz')
+    output_dir = tmp_path / 'out'
+    output_dir.mkdir()
+    with (tmp_path / 'masks.tar.gz').open('rb') as tarball:
+        names = stream_extract_tarball(tarball, 'saige', output_dir=output_dir)
+    assert names == ['mask.SAIGE.bcf', 'mask.BOLT.bgen']
+    assert [path.name for path in output_dir.iterdir()] == ['mask.SAIGE.bcf']
+
+
+@pytest.mark.skipif(shutil.which('zstd') is None, reason='needs the zstd binary')
+def test_external_decompressor(tmp_path):
+
+    tar_bytes = _write_tarball(tmp_path / 'masks.tar.gz')
+    compressed = subprocess.run(['zstd', '-cq'], input=tar_bytes, stdout=subprocess.PIPE, check=True).stdout
+    output_dir = tmp_path / 'out'
+    output_dir.mkdir()
+    assert stream_extract_tarball(io.BytesIO(compressed), None, output_dir=output_dir) == \
+        ['mask.SAIGE.bcf', 'mask.BOLT.bgen']
+
+    # A truncated zstd frame fails in the decompressor, and is reported as a bad tarball
+    with pytest.raises(tarfile.ReadError):
+        stream_extract_tarball(io.BytesIO(compressed[:len(compressed) // 2]), None, output_dir=output_dir)
+
+
+@pytest.mark.skipif(shutil.which('zstd') is None, reason='needs the zstd binary')
+def test_external_decompressor_raises_read_errors(tmp_path):
+
+    tar_bytes = _write_tarball(tmp_path / 'masks.tar.gz')
+    compressed = subprocess.run(['zstd', '-cq'], input=tar_bytes, stdout=subprocess.PIPE, check=True).stdout
+
+    class _BreaksMidway(io.BytesIO):
+        def read(self, size: int = -1) -> bytes:
+            if self.tell() > 8:
+                raise ConnectionError('connection reset')
+            return super().read(min(size, 4))
+
+    with pytest.raises(ConnectionError):
+        stream_extract_tarball(_BreaksMidway(compressed), None, output_dir=tmp_path)
+
+
+def test_bad_tarball_is_not_retried(tmp_path):
+
+    (tmp_path / 'masks.tar.gz').write_bytes(gzip.compress(b'not a tar file' * 1000))
+    backend = _CountingBackend(tmp_path)
+    transfer_manager = _manager(backend)
+    transfer_manager.queue_stream('masks.tar.gz', lambda stream: stream_extract_tarball(stream, 'saige'),
+                                  'masks.tar.gz', content_errors=(tarfile.ReadError,))
+    with pytest.raises(tarfile.ReadError):
+        transfer_manager.wait('masks.tar.gz')
+    assert backend.opened == 1
+
+
+def test_failed_downloads_are_retried(tmp_path, monkeypatch):
+
+    monkeypatch.chdir(tmp_path)
+    _write_tarball(tmp_path / 'masks.tar.gz')
+    backend = _CountingBackend(tmp_path, fail_reads=1)
+    transfer_manager = _manager(backend)
+    transfer_manager.queue_stream('masks.tar.gz', lambda stream: stream_extract_tarball(stream, 'saige'),
+                                  'masks.tar.gz', content_errors=(tarfile.ReadError,))
+    assert transfer_manager.wait('masks.tar.gz') == [['mask.SAIGE.bcf', 'mask.BOLT.bgen']]
+    assert backend.opened == 2
+
+    backend = _CountingBackend(tmp_path, fail_reads=3)
+    transfer_manager = _manager(backend)
+    transfer_manager.queue_stream('masks.tar.gz', lambda stream: stream_extract_tarball(stream, 'saige'),
+                                  'masks.tar.gz', content_errors=(tarfile.ReadError,))
+    with pytest.raises(dxpy.AppError, match='after 3 attempts'):
+        transfer_manager.wait('masks.tar.gz')
@@ -0,0 +1,129 @@
+import threading
+import time
+from pathlib import Path
+
+import dxpy
+import pytest
+
+from burden.checkpoint import Checkpoint, CheckpointStore
+from burden.task_graph import TaskGraph
+
+
+class _ConcurrencyCounter:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.running = 0
+        self.most_running = 0
+
+    def run(self, value: int) -> int:
+        with self._lock:
+            self.running += 1
+            self.most_running = max(self.most_running, self.running)
+        time.sleep(0.05)
+        with self._lock:
+            self.running -= 1
+        return value
+
+
+def test_dependencies_run_first():
+
+    finished = []
+    task_graph = TaskGraph(threads=4)
+    first = task_graph.add_task('first', lambda: finished.append('first') or 1)
+    task_graph.add_task('second', lambda: finished.append('second') or 2, dependencies=[first])
+    results = task_graph.run()
+    assert finished == ['first', 'second']
+    assert results == {'first': 1, 'second': 2}
+
+
+@pytest.mark.parametrize('task_memory, expected_most_running', [(60, 1), (40, 2), (0, 4)])
+def test_memory_budget_limits_concurrency(task_memory, expected_most_running):
+
+    counter = _ConcurrencyCounter()
+    task_graph = TaskGraph(threads=4, memory=100)
+    for task_number in range(4):
+        task_graph.add_task(('task', task_number), counter.run, memory=task_memory, value=task_number)
+    results = task_graph.run()
+    assert counter.most_running == expected_most_running
+    assert sorted(results.values()) == [0, 1, 2, 3]
+
+
+def test_request_larger_than_budget_still_runs():
+
+    task_graph = TaskGraph(threads=2, memory=100)
+    task_graph.add_task('large', lambda: 'done', memory=1000)
+    assert task_graph.run() == {'large': 'done'}
+
+
+def test_on_finish_sees_every_task():
+
+    seen = []
+    task_graph = TaskGraph(threads=2)
+    for task_number in range(3):
+        task_graph.add_task(task_number, lambda value: value * 2, value=task_number)
+    task_graph.run(on_finish=lambda name, result: seen.append((name, result)))
+    assert sorted(seen) == [(0, 0), (1, 2), (2, 4)]
+
+
+def test_failure_raises_app_error():
+
+    def fail():
+        raise ValueError('broken')
+
+    task_graph = TaskGraph(threads=2, error_message='A test task failed')
+    task_graph.add_task('fails', fail)
+    with pytest.raises(dxpy.AppError, match='A test task failed'):
+        task_graph.run()
+
+
+def test_unknown_dependency_and_cycle():
+
+    task_graph = TaskGraph(threads=1)
+    task_graph.add_task('orphan', lambda: None, dependencies=['missing'])
+    with pytest.raises(dxpy.AppError, match='unknown task'):
+        task_graph.run()
+
+    task_graph = TaskGraph(threads=1)
+    task_graph.add_task('a', lambda: None, dependencies=['b'])
+    task_graph.add_task('b', lambda: None, dependencies=['a'])
+    with pytest.raises(dxpy.AppError, match='cycle'):
+        task_graph.run()
+
+
+# The marker path of the SAIGE / REGENIE runners: the bgen task (not checkpointed) also downloads the VEP table that
+# annotation reads, and the marker tests are checkpointed
+def _run_marker_graph(working_dir: Path, runs: list) -> dict:
+
+    def prepare_bgen():
+        runs.append('bgen')
+        (working_dir / 'chr1.filtered.vep.tsv.gz').write_text('vep')
+
+    def run_markers():
+        runs.append('markers')
+        (working_dir / 'chr1.markers.txt').write_text('markers')
+
+    def annotate_markers():
+        runs.append('annotate')
+        return (working_dir / 'chr1.markers.txt').read_text() + (working_dir / 'chr1.filtered.vep.tsv.gz').read_text()
+
+    task_graph = TaskGraph(threads=2, checkpoints=CheckpointStore(working_dir / 'checkpoints', 'run'))
+    bgen_ready = task_graph.add_task('bgen', prepare_bgen)
+    markers = task_graph.add_task('markers', run_markers, dependencies=[bgen_ready],
+                                  checkpoint=Checkpoint(files={'markers.txt': str(working_dir / 'chr1.markers.txt')}))
+    task_graph.add_task('annotate', annotate_markers, dependencies=[markers, bgen_ready])
+    return task_graph.run()
+
+
+def test_resumed_marker_tests_still_prepare_annotation(tmp_path):
+
+    runs = []
+    assert _run_marker_graph(tmp_path, runs)['annotate'] == 'markersvep'
+    assert runs == ['bgen', 'markers', 'annotate']
+
+    # A new instance: only the checkpoints survive
+    (tmp_path / 'chr1.markers.txt').unlink()
+    (tmp_path / 'chr1.filtered.vep.tsv.gz').unlink()
+    runs = []
+    assert _run_marker_graph(tmp_path, runs)['annotate'] == 'markersvep'
+    assert runs == ['bgen', 'annotate']